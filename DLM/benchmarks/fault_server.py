@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""Range server that injects faults, for resilience benchmarks.
+
+Works like range_server.py, plus a `profile` query parameter naming one
+of PROFILES. A profile gives each fault the probability that a request
+gets it; at most one fault is injected per request. The dice are seeded
+with the URL and the number of requests seen for it, so a run replays
+the same schedule as long as the client asks in the same order.
+
+    /bytes/16777216?profile=resets&download=1
+
+Faults:
+    reset       connection reset (RST) somewhere in the body
+    stall       body stops for STALL_SECONDS, then continues
+    throttle    429 with Retry-After
+    unavailable 503 with Retry-After
+    bad_range   206 with a Content-Range (and body) starting later than asked for
+    truncate    body ends early, connection closed cleanly
+    etag        the file changes every ETAG_EVERY requests (new ETag and content)
+    slow_ttfb   SLOW_TTFB_SECONDS before the response headers
+
+    python benchmarks/fault_server.py --port 8000
+"""
+import sys
+import time
+import random
+import socket
+import struct
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+
+from range_server import RangeHandler, RangeServer, expected_content
+
+STALL_SECONDS = 3.0
+RETRY_AFTER_SECONDS = 1
+SLOW_TTFB_SECONDS = 2.0
+ETAG_EVERY = 4
+# Content of version v of a file starts this many bytes further into the pattern
+VERSION_SHIFT = 4099
+# Bytes a bad_range response skips
+BAD_RANGE_SHIFT = 64 * 1024
+
+PROFILES = {
+    'baseline': {},
+    'resets': {'reset': 0.3},
+    'stalls': {'stall': 0.3},
+    'throttled': {'throttle': 0.3},
+    'unavailable': {'unavailable': 0.3},
+    'bad-range': {'bad_range': 0.3},
+    'truncated': {'truncate': 0.3},
+    'etag-change': {'etag': 1.0},
+    'slow-ttfb': {'slow_ttfb': 0.5},
+    'mixed': {'reset': 0.1, 'stall': 0.05, 'throttle': 0.05, 'truncate': 0.05, 'slow_ttfb': 0.1},
+}
+
+
+def version_content(version, offset, length):
+    """Bytes offset to offset + length of version `version` of a file"""
+    return expected_content(offset + version * VERSION_SHIFT, length)
+
+
+class FaultHandler(RangeHandler):
+
+    def plan(self):
+        """Fault for this request (or None) and the version of the file it sees"""
+        url = urlparse(self.path)
+        profile = PROFILES.get(parse_qs(url.query).get('profile', ['baseline'])[0], {})
+        with self.server.lock:
+            count = self.server.request_counts.get(self.path, 0)
+            self.server.request_counts[self.path] = count + 1
+        rng = random.Random(f"{self.path}:{count}")
+        version = count // ETAG_EVERY if 'etag' in profile else 0
+        for fault, probability in profile.items():
+            if fault != 'etag' and rng.random() < probability:
+                return fault, version, rng
+        return None, version, rng
+
+    def send_status(self, code):
+        body = f"{code} injected\n".encode()
+        self.send_response(code)
+        self.send_header('Retry-After', str(RETRY_AFTER_SECONDS))
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def respond(self, with_body):
+        options = self.parse_request_options()
+        if options is None:
+            self.send_error(404)
+            return
+        fault, version, rng = self.plan()
+        if fault in ('throttle', 'unavailable'):
+            self.send_status(429 if fault == 'throttle' else 503)
+            return
+        if fault == 'slow_ttfb':
+            time.sleep(SLOW_TTFB_SECONDS)
+        if options['latency']:
+            time.sleep(options['latency'])
+
+        byte_range = self.requested_range(options)
+        if byte_range is None:
+            self.send_response(416)
+            self.send_header('Content-Range', f"bytes */{options['size']}")
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        first, last, partial = byte_range
+        if fault == 'bad_range' and partial:
+            first = min(first + BAD_RANGE_SHIFT, last)
+        self.send_response(206 if partial else 200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(last - first + 1))
+        self.send_header('ETag', f'"v{version}"')
+        if options['ranges']:
+            self.send_header('Accept-Ranges', 'bytes')
+        if partial:
+            self.send_header('Content-Range', f"bytes {first}-{last}/{options['size']}")
+        self.end_headers()
+        if not with_body:
+            return
+
+        length = last - first + 1
+        offset = first + version * VERSION_SHIFT
+        if fault in ('reset', 'truncate', 'stall'):
+            # The fault hits somewhere in the body
+            cut = rng.randrange(length)
+            self.send_body(offset, cut, options['bandwidth'])
+            if fault == 'reset':
+                self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+                self.connection.close()
+                self.close_connection = True
+                return
+            if fault == 'truncate':
+                self.close_connection = True
+                return
+            time.sleep(STALL_SECONDS)
+            offset += cut
+            length -= cut
+        self.send_body(offset, length, options['bandwidth'])
+
+    def do_HEAD(self):
+        self.respond(with_body=False)
+
+    def do_GET(self):
+        self.respond(with_body=True)
+
+
+class FaultServer(RangeServer):
+
+    def __init__(self, address=('127.0.0.1', 0), **options):
+        super().__init__(address, FaultHandler, **options)
+        self.lock = threading.Lock()
+        self.request_counts = {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve generated files with injected faults")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000, help="Port (0: pick a free one and print it)")
+    args = parser.parse_args()
+
+    server = FaultServer((args.host, args.port))
+    print(server.server_address[1], flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
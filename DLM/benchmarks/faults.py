@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""Resilience benchmark: goodput of the download engine under injected faults.
+
+Starts benchmarks/fault_server.py in its own process and runs one
+scenario per fault profile (see fault_server.PROFILES). Every scenario
+downloads the same files with a fresh DownloadEngine and reports the
+wall time, how many downloads completed with the right content, how
+many completed with wrong content or failed, the goodput (MB/s of
+correct files) relative to the baseline scenario, and the engine's
+retry counts. Exits with 1 if any download completed with wrong content:
+faults may slow a download down or fail it, never corrupt it.
+
+    python benchmarks/faults.py
+    python benchmarks/faults.py --scenarios baseline,resets,mixed --downloads 16 --json faults.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+
+DLM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS_DIR = os.path.join(DLM_DIR, 'benchmarks')
+sys.path.insert(0, DLM_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from download_engine import DownloadEngine, DownloadStatus  # noqa: E402
+from range_server import parse_size  # noqa: E402
+from fault_server import PROFILES, version_content  # noqa: E402
+
+
+def start_server():
+    """Start fault_server.py in its own process, returns (process, base URL)"""
+    process = subprocess.Popen([sys.executable, os.path.join(BENCHMARKS_DIR, 'fault_server.py'), '--port', '0'],
+                               stdout=subprocess.PIPE, text=True)
+    port = int(process.stdout.readline())
+    return process, f"http://127.0.0.1:{port}"
+
+
+def matches_a_version(path, size, max_version=16):
+    """Whether the file is one whole version of the served file"""
+    if os.path.getsize(path) != size:
+        return False
+    with open(path, 'rb') as f:
+        head = f.read(min(size, 4096))
+        for version in range(max_version):
+            if head != version_content(version, 0, len(head)):
+                continue
+            f.seek(0)
+            offset = 0
+            while offset < size:
+                data = f.read(1024 * 1024)
+                if data != version_content(version, offset, len(data)):
+                    return False
+                offset += len(data)
+            return True
+    return False
+
+
+def run_scenario(name, base_url, args):
+    """Download args.downloads files under one fault profile and return the measurements"""
+    save_path = tempfile.mkdtemp(prefix='pdm_faults_')
+    engine = DownloadEngine(max_concurrent_downloads=args.concurrency, max_threads_per_download=args.threads)
+    finished = threading.Event()
+    done = []
+
+    def on_finished(download_item):
+        done.append(download_item.id)
+        if len(done) >= args.downloads:
+            finished.set()
+
+    for event_type in ('completed', 'error', 'canceled'):
+        engine.register_callback(event_type, on_finished)
+
+    items = [{'url': f"{base_url}/bytes/{args.size}?profile={name}&download={i}", 'filename': f"{i}.bin"}
+             for i in range(args.downloads)]
+    start = time.perf_counter()
+    download_ids = engine.add_downloads(items, save_path)
+    timed_out = not finished.wait(args.timeout)
+    wall = time.perf_counter() - start
+
+    counts = {'correct': 0, 'corrupt': 0, 'failed': 0, 'unfinished': 0}
+    errors = {}
+    for download_id, item in zip(download_ids, items):
+        download_item = engine.get_download_info(download_id)
+        if download_item.status == DownloadStatus.COMPLETED:
+            correct = matches_a_version(os.path.join(save_path, item['filename']), args.size)
+            counts['correct' if correct else 'corrupt'] += 1
+        elif download_item.status == DownloadStatus.ERROR:
+            counts['failed'] += 1
+            errors[download_item.error_message] = errors.get(download_item.error_message, 0) + 1
+        else:
+            counts['unfinished'] += 1
+    retries = engine.metrics_snapshot()['retries']
+    engine.shutdown()
+    shutil.rmtree(save_path, ignore_errors=True)
+
+    return dict(counts,
+                scenario=name,
+                profile=PROFILES[name],
+                downloads=args.downloads,
+                seconds=wall,
+                timed_out=timed_out,
+                goodput_mb_per_second=counts['correct'] * args.size / 1024 / 1024 / wall,
+                retries=retries,
+                errors=errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure download goodput under injected faults")
+    parser.add_argument('--scenarios', default=','.join(PROFILES),
+                        help=f"Fault profiles to run (default: all of {', '.join(PROFILES)})")
+    parser.add_argument('--size', type=parse_size, default='16M', help="Size of every file")
+    parser.add_argument('--downloads', type=int, default=8, help="Files per scenario")
+    parser.add_argument('-c', '--concurrency', type=int, default=3, help="max_concurrent_downloads")
+    parser.add_argument('-t', '--threads', type=int, default=4, help="max_threads_per_download")
+    parser.add_argument('--timeout', type=float, default=120.0, help="Seconds a scenario may take")
+    parser.add_argument('--json', help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    scenarios = args.scenarios.split(',')
+    unknown = [name for name in scenarios if name not in PROFILES]
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+
+    import requests  # noqa: F401 - the engine imports it on first use, keep that out of the first scenario
+    server, base_url = start_server()
+    results = []
+    try:
+        for name in scenarios:
+            result = run_scenario(name, base_url, args)
+            results.append(result)
+            baseline = results[0]['goodput_mb_per_second'] if results[0]['scenario'] == 'baseline' else None
+            line = (f"{name}: {result['seconds']:.1f} s, {result['correct']}/{result['downloads']} correct, "
+                    f"{result['corrupt']} corrupt, {result['failed']} failed")
+            if result['unfinished']:
+                line += f", {result['unfinished']} unfinished"
+            line += f", goodput {result['goodput_mb_per_second']:.1f} MB/s"
+            if baseline:
+                line += f" ({result['goodput_mb_per_second'] / baseline * 100:.0f}% of baseline)"
+            if result['retries']:
+                line += ", retries " + ", ".join(f"{cls} {count}" for cls, count in sorted(result['retries'].items()))
+            print(line, flush=True)
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'size': args.size, 'concurrency': args.concurrency, 'threads': args.threads,
+                       'results': results}, f, indent=2)
+    return 0 if all(result['corrupt'] == 0 for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""Load benchmark for the browser integration server.
+
+Starts a BrowserIntegrationServer on a free port, then has a number of
+client threads POST download requests at it and reports requests per
+second and response latency percentiles. By default every client keeps
+one HTTP/1.1 connection open; --no-keep-alive opens a connection per
+request like the extension's fetch() without connection reuse.
+
+    python benchmarks/integration_server.py --clients 8 --requests 2000
+    python benchmarks/integration_server.py --callback-delay 0.05 --json results.json
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+import http.client
+
+DLM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, DLM_DIR)
+
+from browser_integration import BrowserIntegrationServer  # noqa: E402
+
+
+def run_client(port, requests, keep_alive, latencies, errors):
+    """POST requests to the server and record each response time"""
+    connection = None
+    body = json.dumps({'url': 'http://example.com/file.bin', 'referrer': 'http://example.com/'})
+    headers = {'Content-Type': 'application/json'}
+    for i in range(requests):
+        if connection is None:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        start = time.perf_counter()
+        try:
+            connection.request('POST', '/', body, headers)
+            response = connection.getresponse()
+            response.read()
+            ok = response.status == 200
+        except (OSError, http.client.HTTPException):
+            ok = False
+        latencies.append(time.perf_counter() - start)
+        if not ok:
+            errors.append(i)
+        if not ok or not keep_alive:
+            connection.close()
+            connection = None
+    if connection is not None:
+        connection.close()
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure browser integration server throughput")
+    parser.add_argument('--clients', type=int, default=8, help="Concurrent client connections")
+    parser.add_argument('--requests', type=int, default=1000, help="Requests per client")
+    parser.add_argument('--no-keep-alive', action='store_true', help="Open a new connection for every request")
+    parser.add_argument('--callback-delay', type=float, default=0.0,
+                        help="Seconds the download callback takes (simulates a slow add_download)")
+    parser.add_argument('--json', help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    logging.getLogger('browser_integration').setLevel(logging.WARNING)
+    received = []
+
+    def download_callback(url, filename=None, referrer=None):
+        if args.callback_delay:
+            time.sleep(args.callback_delay)
+        received.append(url)
+
+    server = BrowserIntegrationServer(port=0, download_callback=download_callback)
+    if not server.start():
+        return 1
+
+    latencies = [[] for _ in range(args.clients)]
+    errors = []
+    threads = [threading.Thread(target=run_client,
+                                args=(server.port, args.requests, not args.no_keep_alive, latencies[i], errors))
+               for i in range(args.clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    accepted = len(received)
+    server.stop()
+
+    values = sorted(value for client in latencies for value in client)
+    total = len(values)
+    results = {
+        'clients': args.clients,
+        'requests': total,
+        'keep_alive': not args.no_keep_alive,
+        'callback_delay': args.callback_delay,
+        'errors': len(errors),
+        'seconds': elapsed,
+        'requests_per_second': total / elapsed,
+        'latency_ms': {name: percentile(values, fraction) * 1000
+                       for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0))},
+        'processed_during_run': accepted,
+        'processed': len(received),
+    }
+    print(f"{total} requests from {args.clients} clients in {elapsed:.2f} s: "
+          f"{results['requests_per_second']:.0f} req/s, {len(errors)} errors")
+    print("latency: " + ", ".join(f"{name} {value:.2f} ms" for name, value in results['latency_ms'].items()))
+    print(f"processed by the callback: {accepted} during the run, {len(received)} after stop")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
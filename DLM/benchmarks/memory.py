@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""Memory benchmark: bytes per queued download.
+
+Queues N downloads in an engine that never starts them and reports the
+memory held per item (tracemalloc) against a budget.
+
+    python benchmarks/memory.py --items 100000
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from download_engine import DownloadEngine
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure memory per queued download")
+    parser.add_argument('--items', type=int, default=100000, help="Number of downloads to queue")
+    parser.add_argument('--budget', type=int, default=640, help="Budget in bytes per queued item")
+    parser.add_argument('--json', help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    save_path = tempfile.mkdtemp(prefix='pdm_memory_')
+    # No download slots, so everything stays queued
+    engine = DownloadEngine(max_concurrent_downloads=0)
+    urls = [f"https://mirror{i % 50}.example.com/pub/releases/{i // 1000}/file-{i}.tar.gz"
+            for i in range(args.items)]
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for url in urls:
+        engine.add_download(url, save_path)
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    engine.shutdown()
+
+    per_item = (after - before) / args.items
+    results = {'items': args.items, 'bytes_total': after - before, 'bytes_per_item': per_item,
+               'peak_bytes': peak - before, 'budget': args.budget}
+    print(f"{args.items} queued downloads: {(after - before) / 1024 / 1024:.1f} MB, "
+          f"{per_item:.0f} bytes per item (budget {args.budget})")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    return 0 if per_item <= args.budget else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
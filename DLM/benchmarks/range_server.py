@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""Local HTTP server for download benchmarks.
+
+Serves generated files of any size: GET /bytes/<size> returns <size>
+bytes of a repeating pseudo-random pattern (see expected_content), with
+Range support, so nothing has to be kept in memory or on disk. Query
+parameters change the behavior per URL, command line options set the
+defaults:
+
+    ranges=0           no Accept-Ranges header, Range requests get the full body
+    latency=0.05       seconds before the response headers of every request
+    bandwidth=1000000  bytes per second per connection
+
+    python benchmarks/range_server.py --port 8000 --latency 0.02 --bandwidth 10M
+
+Connections are kept alive (HTTP/1.1). The port is printed as the first
+line on stdout, so --port 0 can be used by scripts.
+"""
+import re
+import sys
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# Content of every file: this block repeated
+PATTERN = random.Random(0).randbytes(64 * 1024)
+# Any WRITE_SIZE slice of the content starts in the first half of this
+DOUBLE_PATTERN = memoryview(PATTERN * 2)
+WRITE_SIZE = 64 * 1024
+
+RANGE_PATTERN = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+def parse_size(text):
+    """'64M' -> 67108864, also K and G (powers of 1024)"""
+    text = str(text).strip().upper()
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def expected_content(offset, length):
+    """Bytes offset to offset + length of every served file"""
+    start = offset % len(PATTERN)
+    repeats = (start + length) // len(PATTERN) + 1
+    return (PATTERN * repeats)[start:start + length]
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def parse_request_options(self):
+        """Size and options of the requested file, None if the path is unknown"""
+        url = urlparse(self.path)
+        match = re.match(r'/bytes/(\d+)', url.path)
+        if match is None:
+            return None
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        defaults = self.server.options
+        return {
+            'size': int(match.group(1)),
+            'ranges': params.get('ranges', '1' if defaults['ranges'] else '0') != '0',
+            'latency': float(params.get('latency', defaults['latency'])),
+            'bandwidth': parse_size(params.get('bandwidth', defaults['bandwidth'])),
+        }
+
+    def requested_range(self, options):
+        """(first, last) byte to send and whether it's a partial response, None if unsatisfiable"""
+        size = options['size']
+        header = self.headers.get('Range')
+        match = RANGE_PATTERN.match(header.strip()) if header and options['ranges'] else None
+        if match is None or not (match.group(1) or match.group(2)):
+            return 0, size - 1, False
+        if match.group(1):
+            first = int(match.group(1))
+            last = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+        else:
+            first, last = max(size - int(match.group(2)), 0), size - 1
+        if first >= size or first > last:
+            return None
+        return first, last, True
+
+    def send_headers(self, options):
+        """Send the status line and headers, returns the byte range of the body or None"""
+        if options is None:
+            self.send_error(404)
+            return None
+        if options['latency']:
+            time.sleep(options['latency'])
+        byte_range = self.requested_range(options)
+        if byte_range is None:
+            self.send_response(416)
+            self.send_header('Content-Range', f"bytes */{options['size']}")
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+        first, last, partial = byte_range
+        self.send_response(206 if partial else 200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(last - first + 1))
+        if options['ranges']:
+            self.send_header('Accept-Ranges', 'bytes')
+        if partial:
+            self.send_header('Content-Range', f"bytes {first}-{last}/{options['size']}")
+        self.end_headers()
+        return first, last
+
+    def do_HEAD(self):
+        self.send_headers(self.parse_request_options())
+
+    def do_GET(self):
+        options = self.parse_request_options()
+        byte_range = self.send_headers(options)
+        if byte_range is None:
+            return
+        first, last = byte_range
+        self.send_body(first, last - first + 1, options['bandwidth'])
+
+    def send_body(self, offset, length, bandwidth):
+        """Write length bytes of content from offset, paced to bandwidth bytes per second (0: unlimited)"""
+        start = time.monotonic()
+        sent = 0
+        try:
+            while sent < length:
+                position = (offset + sent) % len(PATTERN)
+                count = min(WRITE_SIZE, length - sent, len(PATTERN))
+                self.wfile.write(DOUBLE_PATTERN[position:position + count])
+                sent += count
+                if bandwidth:
+                    ahead = sent / bandwidth - (time.monotonic() - start)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except (ConnectionError, OSError):
+            # The client went away (canceled or retrying)
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RangeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address=('127.0.0.1', 0), handler=RangeHandler, ranges=True, latency=0.0, bandwidth=0):
+        super().__init__(address, handler)
+        self.options = {'ranges': ranges, 'latency': latency, 'bandwidth': bandwidth}
+
+    def handle_error(self, request, client_address):
+        # Clients drop connections whose response they rejected or stopped reading, that's no server error
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """Serve in a background thread"""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve generated files with Range support for benchmarks")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000, help="Port (0: pick a free one and print it)")
+    parser.add_argument('--no-ranges', action='store_true', help="Don't advertise or honor Range requests")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds before each response")
+    parser.add_argument('--bandwidth', default='0', help="Bytes per second per connection, e.g. 10M (0: unlimited)")
+    args = parser.parse_args()
+
+    server = RangeServer((args.host, args.port), ranges=not args.no_ranges, latency=args.latency,
+                         bandwidth=parse_size(args.bandwidth))
+    print(server.server_address[1], flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
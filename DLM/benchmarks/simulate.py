@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""Discrete-event simulation of the download engine's scheduling.
+
+Replays a workload of downloads through the engine's own scheduling
+decisions (scheduling.py: queue order, segment planning, queue polling)
+in virtual time, against modeled hosts:
+
+    bandwidth        bytes per second of the host, shared by its connections
+    rtt              round trip time in seconds
+    max_connections  requests the host serves at once, others wait for a free one
+    per_connection   bytes per second one connection gets at most (server throttling)
+    tls              whether a new connection costs a TLS round trip
+
+Connections are kept alive per host like the engine's sessions, the
+probe (HEAD) runs in the queue processor like _start_download, and
+bandwidth is shared max-min fair between the transfers of a host and
+the client link. Reports makespan, mean and p95 completion time, queue
+wait and Jain's fairness index of the per-download throughput, for
+every combination of the policy options.
+
+    python benchmarks/simulate.py --downloads 200 --hosts 4 --concurrency 1,3,6 --threads 1,4,8
+    python benchmarks/simulate.py --workload workload.json --queue-poll 0.5,0 --json results.json
+    python benchmarks/simulate.py --downloads 50 --save-workload workload.json
+
+Workload files are JSON: {"hosts": {name: {host options}}, "downloads":
+[{"host": name, "size": bytes, "arrival": seconds, "priority": n, "ranges": true}, ...]}.
+"""
+import os
+import sys
+import json
+import heapq
+import random
+import argparse
+import itertools
+
+DLM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, DLM_DIR)
+sys.path.insert(0, os.path.join(DLM_DIR, 'benchmarks'))
+
+from scheduling import QUEUE_POLL_INTERVAL, queue_order, use_segments, plan_segments  # noqa: E402
+from range_server import parse_size  # noqa: E402
+
+HOST_DEFAULTS = {'bandwidth': 20 * 1024 * 1024, 'rtt': 0.05, 'max_connections': 0, 'per_connection': 0,
+                 'tls': True}
+EPSILON = 1e-9
+
+
+class Transfer:
+    """Body of one segment (or whole file) in flight"""
+    __slots__ = ('download', 'host', 'remaining', 'rate')
+
+    def __init__(self, download, host, size):
+        self.download = download
+        self.host = host
+        self.remaining = size
+        self.rate = 0.0
+
+
+def share_bandwidth(transfers, hosts, client_bandwidth):
+    """Max-min fair rates: raise all unfrozen transfers equally until a link or a transfer's cap is full"""
+    links = {}
+    for transfer in transfers:
+        bandwidth = hosts[transfer.host]['bandwidth']
+        if bandwidth:
+            links.setdefault(('host', transfer.host), [bandwidth, []])[1].append(transfer)
+        if client_bandwidth:
+            links.setdefault(('client',), [client_bandwidth, []])[1].append(transfer)
+    for transfer in transfers:
+        transfer.rate = 0.0
+    active = set(transfers)
+    while active:
+        step = float('inf')
+        for capacity, members in links.values():
+            unfrozen = sum(1 for transfer in members if transfer in active)
+            if unfrozen:
+                step = min(step, capacity / unfrozen)
+        for transfer in active:
+            cap = hosts[transfer.host]['per_connection']
+            if cap:
+                step = min(step, cap - transfer.rate)
+        if step == float('inf'):
+            raise ValueError("Transfers without any bandwidth limit, set the host bandwidth")
+        for transfer in active:
+            transfer.rate += step
+        for link in links.values():
+            link[0] -= step * sum(1 for transfer in link[1] if transfer in active)
+        frozen = set()
+        for capacity, members in links.values():
+            if capacity <= EPSILON:
+                frozen.update(members)
+        for transfer in active:
+            cap = hosts[transfer.host]['per_connection']
+            if cap and transfer.rate >= cap - EPSILON:
+                frozen.add(transfer)
+        active -= frozen
+
+
+class Simulation:
+    """One run of a workload under one policy (concurrency, threads, chunk size, queue poll interval)"""
+
+    def __init__(self, workload, concurrency, threads, chunk_size, queue_poll=QUEUE_POLL_INTERVAL,
+                 client_bandwidth=0, pool_size=10):
+        self.hosts = {name: dict(HOST_DEFAULTS, **options) for name, options in workload['hosts'].items()}
+        self.downloads = [dict(download, index=i, start=None, finish=None, parts=0)
+                          for i, download in enumerate(workload['downloads'])]
+        self.concurrency = concurrency
+        self.threads = threads
+        self.chunk_size = chunk_size
+        self.queue_poll = queue_poll
+        self.client_bandwidth = client_bandwidth
+        self.pool_size = max(threads, pool_size)
+
+        self.now = 0.0
+        self.timers = []
+        self.sequence = itertools.count()
+        self.queue = []
+        self.tickets = itertools.count()
+        self.active = 0
+        self.processor = 'waiting'  # waiting on the queue, 'busy' probing, 'sleeping' until the next poll
+        self.transfers = []
+        self.idle_connections = {name: 0 for name in self.hosts}
+        self.host_requests = {name: 0 for name in self.hosts}
+        self.host_waiting = {name: [] for name in self.hosts}
+
+    def at(self, time, action, *args):
+        heapq.heappush(self.timers, (time, next(self.sequence), action, args))
+
+    def run(self):
+        for download in self.downloads:
+            self.at(download.get('arrival', 0.0), self.arrive, download)
+        while self.timers or self.transfers:
+            if self.transfers:
+                share_bandwidth(self.transfers, self.hosts, self.client_bandwidth)
+                transfer_end = self.now + min(transfer.remaining / transfer.rate for transfer in self.transfers)
+            else:
+                transfer_end = float('inf')
+            timer_end = self.timers[0][0] if self.timers else float('inf')
+            end = min(transfer_end, timer_end)
+            for transfer in self.transfers:
+                transfer.remaining -= transfer.rate * (end - self.now)
+            self.now = end
+            done = [transfer for transfer in self.transfers if transfer.remaining <= transfer.rate * EPSILON + EPSILON]
+            if done:
+                self.transfers = [transfer for transfer in self.transfers if transfer not in done]
+                for transfer in done:
+                    self.release_connection(transfer.host)
+                    self.segment_done(transfer.download)
+            while self.timers and self.timers[0][0] <= self.now:
+                _, _, action, args = heapq.heappop(self.timers)
+                action(*args)
+        return self.report()
+
+    # Queue processor, as in DownloadEngine._process_queue and _start_download
+
+    def arrive(self, download):
+        heapq.heappush(self.queue, (queue_order(download.get('priority', 0), next(self.tickets)), download['index']))
+        if self.processor == 'waiting':
+            self.process_queue()
+
+    def process_queue(self):
+        if self.active < self.concurrency:
+            if not self.queue:
+                self.processor = 'waiting'
+                return
+            _, index = heapq.heappop(self.queue)
+            download = self.downloads[index]
+            self.active += 1
+            download['start'] = self.now
+            self.processor = 'busy'
+            self.request(download['host'], self.probe_done, download)
+        elif self.queue_poll:
+            self.processor = 'sleeping'
+            self.at(self.now + self.queue_poll, self.process_queue)
+        else:
+            # Woken as soon as a slot frees up
+            self.processor = 'waiting'
+
+    def probe_done(self, download):
+        self.release_connection(download['host'])
+        size = download['size']
+        if use_segments(download.get('ranges', True), size, self.threads):
+            segments = plan_segments(size, self.threads, self.chunk_size)
+        else:
+            segments = [(0, size - 1)]
+        download['parts'] = len(segments)
+        for start_byte, end_byte in segments:
+            self.request(download['host'], self.first_byte, download, end_byte - start_byte + 1)
+        self.process_queue()
+
+    def first_byte(self, download, size):
+        self.transfers.append(Transfer(download, download['host'], size))
+
+    def segment_done(self, download):
+        download['parts'] -= 1
+        if download['parts'] == 0:
+            download['finish'] = self.now
+            self.active -= 1
+            if self.processor == 'waiting':
+                self.process_queue()
+
+    # Hosts and kept-alive connections
+
+    def request(self, host, on_response, *args):
+        """Send a request once the host accepts one, on_response runs when its first byte arrives"""
+        limit = self.hosts[host]['max_connections']
+        if limit and self.host_requests[host] >= limit:
+            self.host_waiting[host].append((on_response, args))
+            return
+        self.host_requests[host] += 1
+        options = self.hosts[host]
+        delay = options['rtt']
+        if self.idle_connections[host]:
+            self.idle_connections[host] -= 1
+        else:
+            delay += options['rtt'] * (2 if options['tls'] else 1)
+        self.at(self.now + delay, on_response, *args)
+
+    def release_connection(self, host):
+        self.host_requests[host] -= 1
+        self.idle_connections[host] = min(self.idle_connections[host] + 1, self.pool_size)
+        if self.host_waiting[host]:
+            on_response, args = self.host_waiting[host].pop(0)
+            self.request(host, on_response, *args)
+
+    def report(self):
+        completion = sorted(download['finish'] - download.get('arrival', 0.0) for download in self.downloads)
+        throughput = [download['size'] / max(download['finish'] - download.get('arrival', 0.0), EPSILON)
+                      for download in self.downloads]
+        first_arrival = min(download.get('arrival', 0.0) for download in self.downloads)
+        return {
+            'makespan': max(download['finish'] for download in self.downloads) - first_arrival,
+            'mean_completion': sum(completion) / len(completion),
+            'p95_completion': completion[min(len(completion) - 1, int(len(completion) * 0.95))],
+            'mean_queue_wait': sum(download['start'] - download.get('arrival', 0.0)
+                                   for download in self.downloads) / len(self.downloads),
+            'fairness': sum(throughput) ** 2 / (len(throughput) * sum(value * value for value in throughput)),
+        }
+
+
+def generate_workload(args):
+    """Random workload: log-normal sizes around --median-size, Poisson arrivals, hosts with the given options"""
+    rng = random.Random(args.seed)
+    hosts = {f"host{i}": {'bandwidth': parse_size(args.host_bandwidth), 'rtt': args.rtt,
+                          'max_connections': args.max_connections, 'per_connection': parse_size(args.per_connection),
+                          'tls': not args.no_tls}
+             for i in range(args.hosts)}
+    median = parse_size(args.median_size)
+    arrival = 0.0
+    downloads = []
+    for _ in range(args.downloads):
+        if args.arrival_rate:
+            arrival += rng.expovariate(args.arrival_rate)
+        downloads.append({'host': f"host{rng.randrange(args.hosts)}",
+                          'size': max(1, int(rng.lognormvariate(0, 1) * median)),
+                          'arrival': round(arrival, 6), 'priority': 0,
+                          'ranges': rng.random() >= args.no_range_share})
+    return {'hosts': hosts, 'downloads': downloads}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate the engine's scheduling policies in virtual time")
+    parser.add_argument('--workload', help="Workload JSON file (default: generate one)")
+    parser.add_argument('--save-workload', help="Write the generated workload to this file")
+    parser.add_argument('--downloads', type=int, default=100, help="Generated downloads")
+    parser.add_argument('--hosts', type=int, default=4, help="Generated hosts")
+    parser.add_argument('--median-size', default='20M', help="Median size of generated downloads")
+    parser.add_argument('--arrival-rate', type=float, default=0.0,
+                        help="Generated downloads per second (0: all at once)")
+    parser.add_argument('--no-range-share', type=float, default=0.1,
+                        help="Share of generated downloads from servers without Range support")
+    parser.add_argument('--host-bandwidth', default='20M', help="Bandwidth of generated hosts (bytes/s)")
+    parser.add_argument('--per-connection', default='2M', help="Per connection throttle of generated hosts (0: none)")
+    parser.add_argument('--rtt', type=float, default=0.05, help="Round trip time of generated hosts")
+    parser.add_argument('--max-connections', type=int, default=8, help="Connection cap of generated hosts (0: none)")
+    parser.add_argument('--no-tls', action='store_true', help="Generated hosts use plain HTTP")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--client-bandwidth', default='100M', help="Bandwidth of the client link (0: unlimited)")
+    parser.add_argument('--concurrency', default='3', help="Values of max_concurrent_downloads, e.g. 1,3,6")
+    parser.add_argument('--threads', default='5', help="Values of max_threads_per_download")
+    parser.add_argument('--chunk-sizes', default='1M', help="Values of chunk_size (smallest segment)")
+    parser.add_argument('--queue-poll', default=str(QUEUE_POLL_INTERVAL),
+                        help="Values of the queue processor's poll interval (0: woken when a slot frees)")
+    parser.add_argument('--json', help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    if args.workload:
+        with open(args.workload) as f:
+            workload = json.load(f)
+    else:
+        workload = generate_workload(args)
+        if args.save_workload:
+            with open(args.save_workload, 'w') as f:
+                json.dump(workload, f, indent=2)
+
+    total = sum(download['size'] for download in workload['downloads'])
+    print(f"{len(workload['downloads'])} downloads, {total / 1024 / 1024:.0f} MB, {len(workload['hosts'])} hosts")
+    results = []
+    for concurrency, threads, chunk_size, queue_poll in itertools.product(
+            [int(value) for value in args.concurrency.split(',')], [int(value) for value in args.threads.split(',')],
+            [parse_size(value) for value in args.chunk_sizes.split(',')],
+            [float(value) for value in args.queue_poll.split(',')]):
+        simulation = Simulation(workload, concurrency, threads, chunk_size, queue_poll,
+                                client_bandwidth=parse_size(args.client_bandwidth))
+        result = dict(simulation.run(), concurrency=concurrency, threads=threads, chunk_size=chunk_size,
+                      queue_poll=queue_poll)
+        results.append(result)
+        print(f"concurrency {concurrency}, {threads} threads, {chunk_size / 1024 / 1024:g} MB segments, "
+              f"poll {queue_poll:g} s: makespan {result['makespan']:.1f} s, "
+              f"mean completion {result['mean_completion']:.1f} s (p95 {result['p95_completion']:.1f} s), "
+              f"queue wait {result['mean_queue_wait']:.1f} s, fairness {result['fairness']:.3f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'downloads': len(workload['downloads']), 'bytes': total, 'results': results}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""Startup benchmark: time-to-first-window and time-to-first-byte of the GUI.
+
+Launches the app repeatedly with PDM_STARTUP_PROFILE=1 and a URL served by a
+local HTTP server, reads the startup milestones it prints on stderr and
+compares the medians against a budget.
+
+    python benchmarks/startup.py --runs 5 --offscreen
+    python benchmarks/startup.py --app dist/PyDownloadManager.exe
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+DLM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAYLOAD = b'\0' * (4 * 1024 * 1024)
+
+
+class PayloadHandler(BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(PAYLOAD)))
+        self.end_headers()
+
+    def do_GET(self):
+        self.do_HEAD()
+        try:
+            self.wfile.write(PAYLOAD)
+        except ConnectionError:
+            pass  # the app is killed right after its first byte
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_payload_server():
+    server = HTTPServer(('127.0.0.1', 0), PayloadHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/payload.bin"
+
+
+def run_once(command, url, offscreen, timeout):
+    """Launch the app once and return the milestones relative to process spawn"""
+    home = tempfile.mkdtemp(prefix='pdm_startup_')
+    # A private runtime dir keeps the launch from being forwarded to a running instance
+    env = dict(os.environ, PDM_STARTUP_PROFILE='1', HOME=home, USERPROFILE=home, XDG_RUNTIME_DIR=home)
+    if offscreen:
+        env['QT_QPA_PLATFORM'] = 'offscreen'
+
+    spawn_time = time.time()
+    process = subprocess.Popen(command + [url], cwd=DLM_DIR, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    marks = {}
+    timer = threading.Timer(timeout, process.kill)
+    timer.start()
+    try:
+        for line in process.stderr:
+            if line.startswith('PDM_STARTUP '):
+                _, name, stamp = line.split()
+                marks[name] = float(stamp) - spawn_time
+                if name == 'first_byte':
+                    break
+    finally:
+        timer.cancel()
+        process.kill()
+        process.wait()
+    return marks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure PyDownload Manager startup time")
+    parser.add_argument('--runs', type=int, default=5, help="Number of launches")
+    parser.add_argument('--app', help="Executable to launch instead of 'python main.py' (e.g. the PyInstaller bundle)")
+    parser.add_argument('--offscreen', action='store_true', help="Use Qt's offscreen platform (no display needed)")
+    parser.add_argument('--timeout', type=float, default=30.0, help="Seconds to wait for each launch")
+    parser.add_argument('--budget-window', type=float, default=1.5, help="Budget for time-to-first-window in seconds")
+    parser.add_argument('--budget-first-byte', type=float, default=2.5, help="Budget for time-to-first-byte in seconds")
+    parser.add_argument('--json', help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    command = [args.app] if args.app else [sys.executable, os.path.join(DLM_DIR, 'main.py')]
+    server, url = start_payload_server()
+
+    runs = []
+    for i in range(args.runs):
+        marks = run_once(command, url, args.offscreen, args.timeout)
+        runs.append(marks)
+        print(f"run {i + 1}: " + ", ".join(f"{name}={value * 1000:.0f} ms" for name, value in marks.items()))
+    server.shutdown()
+
+    results = {'runs': runs, 'median': {}, 'budget': {
+        'first_window': args.budget_window, 'first_byte': args.budget_first_byte}}
+    over_budget = False
+    for name, budget in results['budget'].items():
+        values = [marks[name] for marks in runs if name in marks]
+        if len(values) < len(runs):
+            print(f"{name}: missing in {len(runs) - len(values)} run(s)")
+            over_budget = True
+        if not values:
+            continue
+        median = statistics.median(values)
+        results['median'][name] = median
+        status = 'ok' if median <= budget else 'OVER BUDGET'
+        print(f"{name}: median {median * 1000:.0f} ms, min {min(values) * 1000:.0f} ms, "
+              f"max {max(values) * 1000:.0f} ms (budget {budget * 1000:.0f} ms) {status}")
+        over_budget = over_budget or median > budget
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    return 1 if over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""Throughput benchmark of the download engine against a local range server.
+
+Runs a matrix of file size x threads per download x segment size
+(DownloadEngine's chunk_size) x concurrent downloads. Every cell runs in
+a fresh process, so its CPU time and peak RSS belong to the engine
+alone; the server (benchmarks/range_server.py) runs in its own process.
+A cell downloads `concurrency` files at once, `--rounds` times, and
+reports MB/s, CPU seconds per GB, peak RSS and completion time
+percentiles. Results go to a JSON file that --compare reads back, to
+spot regressions between commits.
+
+    python benchmarks/throughput.py
+    python benchmarks/throughput.py --sizes 16M,256M --threads 1,4,8 --chunk-sizes 1M --concurrency 1,4
+    python benchmarks/throughput.py --latency 0.05 --bandwidth 20M --json after.json --compare before.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import itertools
+import threading
+import subprocess
+
+DLM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS_DIR = os.path.join(DLM_DIR, 'benchmarks')
+sys.path.insert(0, DLM_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from range_server import parse_size, expected_content  # noqa: E402
+
+CELL_KEYS = ('size', 'threads', 'chunk_size', 'concurrency')
+
+# Pause between rounds in seconds, not part of the measurements
+QUEUE_SETTLE_TIME = 0.6
+
+
+def size_list(text):
+    return [parse_size(value) for value in text.split(',')]
+
+
+def int_list(text):
+    return [int(value) for value in text.split(',')]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, None where the resource module is missing"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KB elsewhere
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def verify_file(path, size):
+    """Compare a downloaded file with the served content"""
+    if os.path.getsize(path) != size:
+        return False
+    with open(path, 'rb') as f:
+        offset = 0
+        while offset < size:
+            data = f.read(1024 * 1024)
+            if data != expected_content(offset, len(data)):
+                return False
+            offset += len(data)
+    return True
+
+
+def run_cell(cell, base_url, rounds, timeout):
+    """Download the cell's files `rounds` times in this process and return the measurements"""
+    from download_engine import DownloadEngine
+    import requests  # noqa: F401 - the engine imports it on first use, keep that out of the measurements
+
+    save_path = tempfile.mkdtemp(prefix='pdm_throughput_')
+    engine = DownloadEngine(max_concurrent_downloads=cell['concurrency'],
+                            max_threads_per_download=cell['threads'], chunk_size=cell['chunk_size'])
+    finished = {}
+    all_finished = threading.Event()
+    expected = 0
+
+    def on_finished(download_item):
+        finished[download_item.id] = time.perf_counter()
+        if len(finished) >= expected:
+            all_finished.set()
+
+    engine.register_callback('completed', on_finished)
+    engine.register_callback('error', on_finished)
+
+    completion_times = []
+    errors = 0
+    verified = True
+    wall = 0.0
+    cpu_start = time.process_time()
+    try:
+        for round_index in range(rounds):
+            items = [{'url': f"{base_url}/bytes/{cell['size']}?download={round_index}-{i}",
+                      'filename': f"{round_index}-{i}.bin"} for i in range(cell['concurrency'])]
+            expected += len(items)
+            all_finished.clear()
+            start = time.perf_counter()
+            download_ids = engine.add_downloads(items, save_path)
+            if not all_finished.wait(timeout):
+                raise RuntimeError(f"Round {round_index + 1} didn't finish within {timeout} s")
+            wall += max(finished[download_id] for download_id in download_ids) - start
+            for download_id in download_ids:
+                completion_times.append(finished[download_id] - start)
+                download_item = engine.get_download_info(download_id)
+                if download_item.error_message:
+                    errors += 1
+            if round_index == 0:
+                # Checked outside the timed part of the round
+                verified = verify_file(os.path.join(save_path, items[0]['filename']), cell['size'])
+            for item in items:
+                path = os.path.join(save_path, item['filename'])
+                if os.path.exists(path):
+                    os.remove(path)
+            # The queue processor polls every 0.5 s while all slots are busy; let it get back to
+            # waiting on the queue, so every round starts from the same state
+            time.sleep(QUEUE_SETTLE_TIME)
+    finally:
+        cpu = time.process_time() - cpu_start
+        engine.shutdown()
+        shutil.rmtree(save_path, ignore_errors=True)
+
+    total_bytes = cell['size'] * cell['concurrency'] * rounds
+    return dict(cell,
+                rounds=rounds,
+                bytes=total_bytes,
+                seconds=wall,
+                mb_per_second=total_bytes / 1024 / 1024 / wall if wall else 0.0,
+                cpu_seconds=cpu,
+                cpu_seconds_per_gb=cpu / (total_bytes / 1024 ** 3),
+                peak_rss_mb=peak_rss_mb(),
+                completion_seconds={name: percentile(completion_times, fraction) for name, fraction in
+                                    (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0))},
+                errors=errors,
+                verified=verified)
+
+
+def start_server(args):
+    """Start range_server.py in its own process, returns (process, base URL)"""
+    command = [sys.executable, os.path.join(BENCHMARKS_DIR, 'range_server.py'), '--port', '0',
+               '--latency', str(args.latency), '--bandwidth', str(args.bandwidth)]
+    if args.no_ranges:
+        command.append('--no-ranges')
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    port = int(process.stdout.readline())
+    return process, f"http://127.0.0.1:{port}"
+
+
+def run_cell_process(cell, base_url, args):
+    """Run one cell in a fresh interpreter and return its results"""
+    command = [sys.executable, os.path.abspath(__file__), '--cell', json.dumps(cell), '--url', base_url,
+               '--rounds', str(args.rounds), '--timeout', str(args.timeout)]
+    output = subprocess.run(command, stdout=subprocess.PIPE, text=True, check=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=DLM_DIR, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def cell_key(result):
+    return tuple(result[key] for key in CELL_KEYS)
+
+
+def format_cell(result):
+    return (f"{result['size'] / 1024 / 1024:g} MB x{result['concurrency']}, "
+            f"{result['threads']} threads, {result['chunk_size'] / 1024 / 1024:g} MB segments")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure download engine throughput against a local server")
+    parser.add_argument('--sizes', type=size_list, default='8M,64M', help="File sizes, e.g. 8M,64M,1G")
+    parser.add_argument('--threads', type=int_list, default='1,4,8', help="Values of max_threads_per_download")
+    parser.add_argument('--chunk-sizes', type=size_list, default='1M,4M',
+                        help="Values of chunk_size (smallest segment)")
+    parser.add_argument('--concurrency', type=int_list, default='1,4', help="Downloads running at once")
+    parser.add_argument('--rounds', type=int, default=3, help="Repetitions of each cell")
+    parser.add_argument('--latency', type=float, default=0.0, help="Server latency before each response in seconds")
+    parser.add_argument('--bandwidth', default='0', help="Server bandwidth per connection, e.g. 20M (0: unlimited)")
+    parser.add_argument('--no-ranges', action='store_true', help="Server without Range support")
+    parser.add_argument('--timeout', type=float, default=600.0, help="Seconds a round may take")
+    parser.add_argument('--json', help="Write results to this JSON file")
+    parser.add_argument('--compare', help="Results JSON of an earlier run to compare MB/s against")
+    parser.add_argument('--cell', help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.cell:
+        # Child process of a matrix run
+        print(json.dumps(run_cell(json.loads(args.cell), args.url, args.rounds, args.timeout)))
+        return 0
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {cell_key(result): result for result in json.load(f)['results']}
+
+    server, base_url = start_server(args)
+    results = []
+    try:
+        for size, threads, chunk_size, concurrency in itertools.product(args.sizes, args.threads,
+                                                                        args.chunk_sizes, args.concurrency):
+            cell = {'size': size, 'threads': threads, 'chunk_size': chunk_size, 'concurrency': concurrency}
+            result = run_cell_process(cell, base_url, args)
+            results.append(result)
+            line = (f"{format_cell(result)}: {result['mb_per_second']:.1f} MB/s, "
+                    f"{result['cpu_seconds_per_gb']:.2f} CPU s/GB, "
+                    f"p50 {result['completion_seconds']['p50']:.2f} s, "
+                    f"max {result['completion_seconds']['max']:.2f} s")
+            if result['peak_rss_mb'] is not None:
+                line += f", peak RSS {result['peak_rss_mb']:.0f} MB"
+            before = baseline.get(cell_key(result))
+            if before and before['mb_per_second']:
+                line += f" ({(result['mb_per_second'] / before['mb_per_second'] - 1) * 100:+.0f}% MB/s)"
+            if result['errors'] or not result['verified']:
+                line += f" [{result['errors']} errors, verified: {result['verified']}]"
+            print(line, flush=True)
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'commit': git_commit(), 'python': platform.python_version(), 'platform': platform.platform(),
+                       'server': {'latency': args.latency, 'bandwidth': parse_size(args.bandwidth),
+                                  'ranges': not args.no_ranges},
+                       'results': results}, f, indent=2)
+
+    return 1 if any(result['errors'] or not result['verified'] for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
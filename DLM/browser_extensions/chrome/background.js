@@ -110,6 +110,39 @@ function sendDownloadToPDM(url, filename, referrer) {
   });
 }
 
+// Send several downloads to PyDownload Manager in one request
+function sendDownloadsToPDM(links, referrer) {
+  const items = links.map(link => ({ url: link.url, filename: link.filename, referrer }));
+  
+  // Try native messaging first
+  if (window.nativePort) {
+    try {
+      window.nativePort.postMessage({ items });
+      return true;
+    } catch (error) {
+      console.error('Native messaging failed:', error);
+    }
+  }
+  
+  // Fall back to the HTTP batch endpoint
+  return fetch(config.serverUrl + '/batch', {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json'
+    },
+    body: JSON.stringify({ items })
+  })
+  .then(response => response.json())
+  .then(data => {
+    console.log('Downloads sent to PyDownload Manager:', data);
+    return data.status === 'success';
+  })
+  .catch(error => {
+    console.error('Failed to send downloads to PyDownload Manager:', error);
+    return false;
+  });
+}
+
 // Intercept downloads
 chrome.downloads.onCreated.addListener((downloadItem) => {
   if (!config.enabled) return;
@@ -153,10 +186,8 @@ chrome.runtime.onMessage.addListener((message, sender, sendResponse) => {
     sendDownloadToPDM(message.url, message.filename, sender.tab.url);
     sendResponse({ success: true });
   } else if (message.action === 'downloadLinks') {
-    // Download multiple links from content script
-    message.links.forEach(link => {
-      sendDownloadToPDM(link.url, link.filename, sender.tab.url);
-    });
+    // Download multiple links from content script in one request
+    sendDownloadsToPDM(message.links, sender.tab.url);
     sendResponse({ success: true, count: message.links.length });
   } else if (message.action === 'getConfig') {
     // Return current configuration
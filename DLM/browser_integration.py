@@ -1,82 +1,274 @@
 import os
 import json
 import socket
+import queue
 import threading
 import time
 import sys
 import logging
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import parse_qs, urlparse
 
+from control_api import ControlAPI, ProgressBroadcaster
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('browser_integration')
 
 
+# Largest request bodies accepted from the extension, for one download and for a batch
+MAX_BODY_SIZE = 64 * 1024
+MAX_BATCH_BODY_SIZE = 16 * 1024 * 1024
+
+# Path of the batch endpoint, POST {"items": [{"url": ..., "filename": ..., "referrer": ...}, ...]}
+BATCH_PATH = '/batch'
+
+# Paths the browser extension calls, the only ones answered with CORS headers
+EXTENSION_PATHS = ('/', BATCH_PATH)
+
+# Path of the Server-Sent Events stream of download changes
+EVENTS_PATH = '/events'
+
+# Path of the Prometheus metrics of the engine
+METRICS_PATH = '/metrics'
+
+# Path of the profiler, POST /profile?seconds=30&mode=sample answers with collapsed stacks
+PROFILE_PATH = '/profile'
+
+# Seconds between keep-alive comments on an idle event stream
+HEARTBEAT_INTERVAL = 15
+
+
 class DownloadInterceptor(BaseHTTPRequestHandler):
-    """HTTP request handler for intercepting download requests from browser extensions"""
-    
-    def __init__(self, *args, download_callback=None, **kwargs):
-        self.download_callback = download_callback
-        super().__init__(*args, **kwargs)
-    
+    """HTTP request handler for intercepting download requests from browser extensions.
+
+    Speaks HTTP/1.1, so the extension can keep one connection open for
+    many requests. The handler only parses and checks the request and
+    hands it to the server's work queue; adding the download happens on
+    the server's worker thread, so the response doesn't wait for it.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, Nagle would hold the body back on a reused connection
+    disable_nagle_algorithm = True
+    # Idle keep-alive connections are closed after this many seconds
+    timeout = 30
+
+    def do_GET(self):
+        """Handle status requests, metrics and the event stream"""
+        url = urlparse(self.path)
+        if url.path == EVENTS_PATH:
+            self.stream_events()
+        elif url.path == METRICS_PATH:
+            self.send_metrics()
+        else:
+            self.handle_control('GET', url)
+
     def do_POST(self):
         """Handle POST requests from browser extensions"""
-        content_length = int(self.headers['Content-Length'])
+        url = urlparse(self.path)
+        batch = url.path == BATCH_PATH
+        # A request without Content-Length or Transfer-Encoding has no body (e.g. curl -X POST)
+        default_length = '' if 'Transfer-Encoding' in self.headers else '0'
+        try:
+            content_length = int(self.headers.get('Content-Length', default_length))
+        except ValueError:
+            self.send_json(411, {'status': 'error', 'message': 'Content-Length required'})
+            return
+        if content_length < 0 or content_length > (MAX_BATCH_BODY_SIZE if batch else MAX_BODY_SIZE):
+            # The body is not read, so the connection can't be reused
+            self.send_json(413, {'status': 'error', 'message': 'Request too large'}, close=True)
+            return
         post_data = self.rfile.read(content_length)
-        
+
         try:
-            data = json.loads(post_data.decode('utf-8'))
-            logger.info(f"Received download request: {data['url']}")
-            
-            # Call the download callback if available
-            if self.download_callback and 'url' in data:
-                self.download_callback(data['url'], data.get('filename', None), data.get('referrer', None))
-                
-                # Send success response
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps({'status': 'success'}).encode('utf-8'))
-            else:
-                # Send error response
-                self.send_response(400)
-                self.send_header('Content-type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps({'status': 'error', 'message': 'Invalid request'}).encode('utf-8'))
-        
-        except Exception as e:
+            data = json.loads(post_data.decode('utf-8')) if post_data else None
+        except (UnicodeDecodeError, ValueError) as e:
             logger.error(f"Error processing download request: {str(e)}")
-            self.send_response(500)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_json(400, {'status': 'error', 'message': 'Invalid JSON'})
+            return
+
+        if url.path == PROFILE_PATH:
+            self.send_profile(url)
+        elif url.path not in EXTENSION_PATHS:
+            self.handle_control('POST', url, data)
+        elif batch and isinstance(data, dict) and isinstance(data.get('items'), list):
+            # Items are checked by the engine when the batch is added
+            logger.info(f"Received batch download request: {len(data['items'])} items")
+            self.server.work_queue.put(data['items'])
+            self.send_json(200, {'status': 'success', 'count': len(data['items'])})
+        elif not batch and isinstance(data, dict) and isinstance(data.get('url'), str):
+            logger.info(f"Received download request: {data['url']}")
+            self.server.work_queue.put(data)
+            self.send_json(200, {'status': 'success'})
+        else:
+            self.send_json(400, {'status': 'error', 'message': 'Invalid request'})
+
+    def handle_control(self, method, url, data=None):
+        """Answer a control API request.
+
+        These responses have no CORS header: the extension doesn't need one,
+        and web pages must not be able to read or control the downloads.
+        """
+        if self.server.control_api is None:
+            self.send_json(404, {'status': 'error', 'message': 'Not found'}, cors=False)
+            return
+        if self.reject_cross_origin():
+            return
+        code, body = self.server.control_api.handle(method, url.path, url.query, data)
+        self.send_json(code, body, cors=False)
+
+    def reject_cross_origin(self):
+        """Refuse a request sent by a web page, returns True if it was refused.
+
+        Browsers send an Origin header with every cross-origin POST, also
+        with the simple ones that skip the CORS preflight; curl and scripts
+        send none.
+        """
+        if self.headers.get('Origin') is None:
+            return False
+        self.send_json(403, {'status': 'error', 'message': 'Cross-origin requests are not allowed'}, cors=False)
+        return True
+
+    def send_metrics(self):
+        """Answer a Prometheus scrape, without a CORS header like the control API"""
+        if self.server.control_api is None:
+            self.send_json(404, {'status': 'error', 'message': 'Not found'}, cors=False)
+            return
+        payload = self.server.control_api.metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_profile(self, url):
+        """Profile the engine and answer with the collapsed stacks, without a CORS header like the control API"""
+        if self.server.control_api is None:
+            self.send_json(404, {'status': 'error', 'message': 'Not found'}, cors=False)
+            return
+        if self.reject_cross_origin():
+            return
+        code, body = self.server.control_api.profile(url.query)
+        if code != 200:
+            self.send_json(code, body, cors=False)
+            return
+        payload = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def stream_events(self):
+        """Send download changes as Server-Sent Events until the client goes away.
+
+        The first event ('snapshot') lists the downloads that aren't finished,
+        every following 'progress' event holds the changes since the one
+        before, see ProgressBroadcaster.
+        """
+        broadcaster = self.server.broadcaster
+        if broadcaster is None:
+            self.send_json(404, {'status': 'error', 'message': 'Not found'}, cors=False)
+            return
+        # The stream has no length, it ends with the connection
+        self.close_connection = True
+        subscription, snapshot = broadcaster.subscribe()
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Connection', 'close')
             self.end_headers()
-            self.wfile.write(json.dumps({'status': 'error', 'message': str(e)}).encode('utf-8'))
-    
+            self.write_event('snapshot', snapshot)
+            while True:
+                deltas = subscription.take(HEARTBEAT_INTERVAL)
+                if deltas is None:
+                    break
+                if deltas:
+                    self.write_event('progress', deltas)
+                else:
+                    # Lets proxies and the client know the stream is alive
+                    self.wfile.write(b': keep-alive\n\n')
+        except (OSError, ValueError):
+            pass  # client disconnected
+        finally:
+            broadcaster.unsubscribe(subscription)
+
+    def write_event(self, event_type, data):
+        self.wfile.write(f"event: {event_type}\ndata: {json.dumps(data)}\n\n".encode('utf-8'))
+
     def do_OPTIONS(self):
-        """Handle OPTIONS requests for CORS"""
+        """Answer CORS preflights for the extension's paths, other paths get no CORS headers"""
+        if urlparse(self.path).path not in EXTENSION_PATHS:
+            self.send_json(404, {'status': 'error', 'message': 'Not found'}, cors=False)
+            return
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Content-Length', '0')
         self.end_headers()
-    
+
+    def send_json(self, code, body, close=False, cors=True):
+        """Send a JSON response with a Content-Length, so the connection stays usable"""
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-type', 'application/json')
+        if cors:
+            self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Content-Length', str(len(payload)))
+        if close:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(payload)
+
     def log_message(self, format, *args):
         """Override to use our logger instead of printing to stderr"""
         logger.debug("%s - - [%s] %s" % (self.client_address[0], self.log_date_time_string(), format % args))
 
 
+class IntegrationHTTPServer(ThreadingHTTPServer):
+    """Threaded HTTP server feeding accepted requests to a work queue"""
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, work_queue, control_api=None, broadcaster=None):
+        self.work_queue = work_queue
+        self.control_api = control_api
+        self.broadcaster = broadcaster
+        super().__init__(server_address, DownloadInterceptor)
+
+
 class BrowserIntegrationServer:
-    """Server for handling browser extension integration"""
+    """Server for handling browser extension integration.
+
+    Each connection is served by its own thread, so a slow client doesn't
+    hold up the others. Requests are passed to download_callback one by one
+    on a single worker thread, in the order they arrived. Batches go to
+    batch_callback(items) in one call, or item by item to download_callback
+    if there is no batch_callback.
+
+    With a download_engine the server also offers the control API
+    (/downloads, see ControlAPI) and the event stream (/events).
+    """
     
-    def __init__(self, host='127.0.0.1', port=8765, download_callback=None):
+    def __init__(self, host='127.0.0.1', port=8765, download_callback=None, batch_callback=None,
+                 download_engine=None):
         self.host = host
         self.port = port
         self.download_callback = download_callback
+        self.batch_callback = batch_callback
+        self.control_api = None
+        self.broadcaster = None
+        if download_engine is not None:
+            self.control_api = ControlAPI(download_engine)
+            self.broadcaster = ProgressBroadcaster(download_engine)
         self.server = None
         self.server_thread = None
+        self.work_queue = queue.SimpleQueue()
+        self.worker_thread = None
         self.running = False
     
     def start(self):
@@ -85,11 +277,16 @@ class BrowserIntegrationServer:
             logger.warning("Server is already running")
             return False
         
-        # Create a custom request handler with our callback
-        handler = lambda *args, **kwargs: DownloadInterceptor(*args, download_callback=self.download_callback, **kwargs)
-        
         try:
-            self.server = HTTPServer((self.host, self.port), handler)
+            self.server = IntegrationHTTPServer((self.host, self.port), self.work_queue, self.control_api,
+                                                self.broadcaster)
+            # Port 0 picks a free port
+            self.port = self.server.server_address[1]
+            self.worker_thread = threading.Thread(target=self._process_requests)
+            self.worker_thread.daemon = True
+            self.worker_thread.start()
+            if self.broadcaster is not None:
+                self.broadcaster.start()
             self.server_thread = threading.Thread(target=self.server.serve_forever)
             self.server_thread.daemon = True
             self.server_thread.start()
@@ -108,7 +305,13 @@ class BrowserIntegrationServer:
         
         if self.server:
             self.server.shutdown()
+            if self.broadcaster is not None:
+                # Ends the open event streams
+                self.broadcaster.stop()
             self.server.server_close()
+            # Requests accepted before the shutdown are still added
+            self.work_queue.put(None)
+            self.worker_thread.join(timeout=5.0)
             self.running = False
             logger.info("Browser integration server stopped")
     
@@ -116,6 +319,24 @@ class BrowserIntegrationServer:
         """Check if the server is running"""
         return self.running
 
+    def _process_requests(self):
+        """Pass queued requests to the download callback (worker thread)"""
+        while True:
+            data = self.work_queue.get()
+            if data is None:
+                break
+            try:
+                if isinstance(data, list) and self.batch_callback:
+                    self.batch_callback(data)
+                elif isinstance(data, list) and self.download_callback:
+                    for item in data:
+                        if isinstance(item, dict) and isinstance(item.get('url'), str):
+                            self.download_callback(item['url'], item.get('filename'), item.get('referrer'))
+                elif self.download_callback:
+                    self.download_callback(data['url'], data.get('filename', None), data.get('referrer', None))
+            except Exception as e:
+                logger.error(f"Error processing download request: {str(e)}")
+
 
 class NativeMessagingHost:
     """Native messaging host for deeper browser integration"""
@@ -189,7 +410,9 @@ class BrowserIntegration:
     
     def __init__(self, download_callback=None):
         self.download_manager_gui = download_callback
-        self.server = BrowserIntegrationServer(download_callback=self._handle_download)
+        self.server = BrowserIntegrationServer(download_callback=self._handle_download,
+                                               batch_callback=self._handle_downloads,
+                                               download_engine=getattr(download_callback, 'download_engine', None))
         self.native_host = NativeMessagingHost(download_callback=self._handle_download)
         self.manifest_paths = self._get_manifest_paths()
         
@@ -221,6 +444,11 @@ class BrowserIntegration:
         if self.download_manager_gui:
             self.download_manager_gui.add_download_from_browser(url, filename, referrer)
     
+    def _handle_downloads(self, items):
+        """Handle a batch download request from browser"""
+        if self.download_manager_gui:
+            self.download_manager_gui.add_downloads_from_browser(items)
+    
     def _get_manifest_paths(self):
         """Get paths for browser extension manifests"""
         paths = {}
@@ -313,17 +541,14 @@ class BrowserIntegration:
         success = {}
         app_name = 'com.pydownloadmanager.native'
         
-        # Get the path to the native messaging host executable or script
+        # The native host is a small Qt-free shim that forwards messages to the running
+        # instance (starting it if needed) instead of a whole new application
         if getattr(sys, 'frozen', False):
-            # Running as compiled executable
+            # Running as compiled executable, main.py switches to the shim when started by the browser
             host_path = sys.executable
         else:
             # Running as script
-            host_path = os.path.abspath(sys.argv[0])
-            
-        # Ensure the path is properly escaped for JSON
-        if os.name == 'nt':
-            host_path = host_path.replace('\\', '\\\\')
+            host_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'native_host.py')
         
         # Create manifest for each browser
         for browser, manifest_dir in self.manifest_paths.items():
@@ -331,6 +556,13 @@ class BrowserIntegration:
                 if not os.path.exists(manifest_dir):
                     os.makedirs(manifest_dir, exist_ok=True)
                 
+                # Windows can't run a .py file directly as the native host
+                browser_host_path = host_path
+                if os.name == 'nt' and not getattr(sys, 'frozen', False):
+                    browser_host_path = os.path.join(manifest_dir, f'{app_name}.bat')
+                    with open(browser_host_path, 'w') as f:
+                        f.write(f'@echo off\r\n"{sys.executable}" "{host_path}" %*\r\n')
+                
                 # Get the extension ID from the manifest.json file if possible
                 extension_id = '[extension-id]'  # Default placeholder
                 chrome_ext_dir = self.install_chrome_extension()
@@ -351,7 +583,7 @@ class BrowserIntegration:
                 manifest = {
                     'name': app_name,
                     'description': 'PyDownload Manager Native Messaging Host',
-                    'path': host_path,
+                    'path': browser_host_path,
                     'type': 'stdio',
                     'allowed_origins': [
                         f'chrome-extension://{extension_id}/' if browser in ['chrome', 'edge'] else
@@ -0,0 +1,361 @@
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import threading
+
+from download_engine import DownloadEngine, DownloadStatus, FINISHED_STATES
+from browser_integration import BrowserIntegrationServer
+from history import DownloadHistory, RetentionPolicy, DEFAULT_HISTORY_PATH
+from store import DownloadStore, DEFAULT_STORE_PATH
+from instance import InstanceClient, InstanceServer, handle_download_request
+from profiling import PROFILE_MODES, MAX_PROFILE_DURATION, write_collapsed
+from utils import is_valid_url, estimate_time_remaining
+
+# Chrome trace of the download timeline, written when tracing stops
+DEFAULT_TRACE_PATH = 'pdm-trace.json'
+
+# Collapsed stacks of a profile, written when it ends
+DEFAULT_PROFILE_PATH = 'pdm-profile.txt'
+
+
+class HeadlessDownloadManager:
+    """Runs the download engine without any GUI and reports progress as JSON lines"""
+
+    def __init__(self, save_path, max_concurrent_downloads=3, max_threads_per_download=5, output=None,
+                 store_path=None, workers=0):
+        self.save_path = save_path
+        self.output = output or sys.stdout
+        self.output_lock = threading.Lock()
+        if workers:
+            # Downloads are sharded over engine processes, each with its own interpreter lock
+            from engine_process import ProcessDownloadEngine
+            self.download_engine = ProcessDownloadEngine(max_concurrent_downloads=max_concurrent_downloads,
+                                                         max_threads_per_download=max_threads_per_download,
+                                                         store_path=store_path, workers=workers)
+        else:
+            self.download_engine = DownloadEngine(max_concurrent_downloads=max_concurrent_downloads,
+                                                  max_threads_per_download=max_threads_per_download)
+            if store_path:
+                self.download_engine.set_store(DownloadStore(store_path))
+        self.server = None
+        self.instance_server = None
+        self.input_done = threading.Event()
+        self.trace_path = DEFAULT_TRACE_PATH
+        self.tracing = False
+        self.toggle_tracing = threading.Event()
+        self.profile_path = DEFAULT_PROFILE_PATH
+        self.profile_duration = 30.0
+        self.profile_mode = 'sample'
+        self.profile_requested = threading.Event()
+        self.register_callbacks()
+
+    def register_callbacks(self):
+        """Register callbacks with the download engine"""
+        for event_type in ('added', 'started', 'paused', 'resumed', 'completed', 'error', 'canceled', 'evicted'):
+            self.download_engine.register_callback(event_type, self._make_event_handler(event_type))
+
+    def _make_event_handler(self, event_type):
+        def handler(download_item):
+            self.emit(event_type, download_item)
+        return handler
+
+    def emit(self, event_type, download_item=None, **fields):
+        """Write one JSON line to the output"""
+        record = {'event': event_type, 'time': round(time.time(), 3)}
+        if download_item is not None:
+            record.update({
+                'id': download_item.id,
+                'url': download_item.url,
+                'filename': download_item.filename,
+                'status': download_item.status.value,
+                'downloaded': download_item.downloaded_size,
+                'total': download_item.total_size,
+                'progress': round(download_item.progress, 2),
+                'speed': round(download_item.speed, 1),
+            })
+            if download_item.error_message:
+                record['error'] = download_item.error_message
+        record.update(fields)
+        line = json.dumps(record)
+        with self.output_lock:
+            self.output.write(line + '\n')
+            self.output.flush()
+
+    def add_download(self, url, filename=None, referrer=None):
+        """Add a download, same signature as the browser integration callback"""
+        if not is_valid_url(url):
+            self.emit('rejected', url=url, error='Invalid URL')
+            return None
+        return self.download_engine.add_download(url, self.save_path, filename, referrer)
+
+    def add_downloads(self, items):
+        """Add a batch of downloads (dicts with url, filename, referrer), skipped items are reported"""
+        download_ids = self.download_engine.add_downloads(items, self.save_path)
+        for item, download_id in zip(items, download_ids):
+            if download_id is None:
+                url = item.get('url') if isinstance(item, dict) else None
+                self.emit('rejected', url=url, error='Invalid or duplicate URL')
+        return download_ids
+    
+    def add_from_stream(self, stream):
+        """Add downloads from a stream with one URL (or JSON object) per line"""
+        for line in stream:
+            try:
+                entry = parse_url_line(line)
+            except ValueError as e:
+                self.emit('rejected', line=line.strip(), error=str(e))
+                continue
+            if entry is not None:
+                self.add_download(entry.get('url', ''), entry.get('filename'), entry.get('referrer'))
+
+    def start_server(self, host='127.0.0.1', port=8765):
+        """Start the browser integration server feeding this engine"""
+        self.server = BrowserIntegrationServer(host=host, port=port, download_callback=self.add_download,
+                                               batch_callback=self.add_downloads,
+                                               download_engine=self.download_engine)
+        if not self.server.start():
+            raise RuntimeError(f"Could not start integration server on {host}:{port}")
+        self.emit('server', host=host, port=port)
+
+    def start_instance_server(self):
+        """Accept downloads forwarded by the native messaging shim and other CLI calls"""
+        self.instance_server = InstanceServer(
+            lambda message: handle_download_request(message, self.add_download, self.add_downloads))
+        if not self.instance_server.start():
+            raise RuntimeError("Another PyDownload Manager instance is already running")
+
+    def set_tracing(self, enabled):
+        """Start or stop recording download spans, stopping writes them to self.trace_path"""
+        self.tracing = enabled
+        self.download_engine.set_tracing(enabled)
+        if enabled:
+            self.emit('tracing', enabled=True)
+        else:
+            events = self.download_engine.export_trace(self.trace_path)
+            self.emit('tracing', enabled=False, path=self.trace_path, events=events)
+
+    def report_progress(self):
+        """Emit a progress line for every active download"""
+        # Process engines copy progress from their shared tables here
+        self.download_engine.take_changed_ids()
+        _, active = self.download_engine.get_downloads(status=DownloadStatus.DOWNLOADING)
+        for download_item in active:
+            self.emit('progress', download_item, eta=estimate_time_remaining(
+                download_item.downloaded_size, download_item.total_size, download_item.speed))
+
+    def is_idle(self):
+        """Check if every known download reached a final state"""
+        counts = self.download_engine.get_status_counts()
+        return all(count == 0 for status, count in counts.items() if status not in FINISHED_STATES)
+
+    def start_profile(self):
+        """Profile the engine for self.profile_duration seconds, then write the stacks to self.profile_path"""
+        if not self.download_engine.start_profile(self.profile_duration, self.profile_mode):
+            self.emit('profile', error='A profile is already running')
+            return
+        self.emit('profile', mode=self.profile_mode, seconds=self.profile_duration)
+        writer = threading.Thread(target=self._write_profile)
+        writer.daemon = True
+        writer.start()
+
+    def _write_profile(self):
+        try:
+            count = write_collapsed(self.profile_path, self.download_engine.profile_stacks())
+        except (OSError, RuntimeError) as e:
+            self.emit('profile', error=str(e))
+            return
+        self.emit('profile', path=self.profile_path, stacks=count)
+
+    def run(self, daemon=False, interval=1.0):
+        """Report progress until all downloads finished (or forever in daemon mode)"""
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+        if hasattr(signal, 'SIGUSR1'):
+            # kill -USR1 starts or stops tracing, handled in this loop since emit() takes a lock
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.toggle_tracing.set())
+        if hasattr(signal, 'SIGUSR2'):
+            # kill -USR2 profiles the engine for a while
+            signal.signal(signal.SIGUSR2, lambda signum, frame: self.profile_requested.set())
+        try:
+            while not stop.wait(interval):
+                if self.toggle_tracing.is_set():
+                    self.toggle_tracing.clear()
+                    self.set_tracing(not self.tracing)
+                if self.profile_requested.is_set():
+                    self.profile_requested.clear()
+                    self.start_profile()
+                self.report_progress()
+                if not daemon and self.input_done.is_set() and self.is_idle():
+                    break
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shutdown()
+
+        return 1 if self.download_engine.count_downloads(status=DownloadStatus.ERROR) else 0
+
+    def shutdown(self):
+        """Stop the server and the download engine"""
+        if self.instance_server is not None:
+            self.instance_server.stop()
+        if self.server is not None and self.server.is_running():
+            self.server.stop()
+        if self.tracing:
+            self.set_tracing(False)
+        self.download_engine.shutdown()
+        self.emit('shutdown')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='pydownloadmanager',
+                                     description="Headless PyDownload Manager (no GUI)")
+    parser.add_argument('urls', nargs='*', help="URLs to download")
+    parser.add_argument('-i', '--input-file', action='append', default=[],
+                        help="File with one URL per line ('-' for stdin), can be repeated")
+    parser.add_argument('-o', '--save-path', default=os.path.expanduser('~/Downloads'),
+                        help="Directory to save downloads to")
+    parser.add_argument('-c', '--max-concurrent', type=int, default=3,
+                        help="Maximum concurrent downloads")
+    parser.add_argument('-t', '--threads', type=int, default=5,
+                        help="Threads per download")
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help="Seconds between progress lines")
+    parser.add_argument('-d', '--daemon', action='store_true',
+                        help="Keep running and accept downloads from stdin and the browser extension")
+    parser.add_argument('--no-server', action='store_true',
+                        help="Don't start the browser integration server in daemon mode")
+    parser.add_argument('--no-forward', action='store_true',
+                        help="Download in this process even if an instance is already running")
+    parser.add_argument('--keep-finished', type=int,
+                        help="Finished downloads kept in memory before moving to the history (daemon default 1000)")
+    parser.add_argument('--keep-age', type=float,
+                        help="Seconds a finished download stays in memory before moving to the history")
+    parser.add_argument('--store', help=f"SQLite file keeping the queue and history (daemon default {DEFAULT_STORE_PATH})")
+    parser.add_argument('--no-store', action='store_true', help="Don't persist downloads in daemon mode")
+    parser.add_argument('-w', '--workers', type=int, default=0,
+                        help="Run the downloads in this many engine processes (default: in this process)")
+    parser.add_argument('--speed-limit', type=int, default=0, help="Total speed limit in KB/s (default: unlimited)")
+    parser.add_argument('--history', default=DEFAULT_HISTORY_PATH,
+                        help="History file for evicted downloads when running without a store")
+    parser.add_argument('--trace', action='store_true',
+                        help="Record a timeline of the downloads from the start (SIGUSR1 starts or stops it)")
+    parser.add_argument('--trace-file', default=DEFAULT_TRACE_PATH,
+                        help="Chrome trace file written when tracing stops")
+    parser.add_argument('--profile-file', default=DEFAULT_PROFILE_PATH,
+                        help="Collapsed stack file written when a profile (SIGUSR2) ends")
+    parser.add_argument('--profile-seconds', type=float, default=30.0, help="Duration of a profile")
+    parser.add_argument('--profile-mode', choices=PROFILE_MODES, default='sample',
+                        help="'sample': CPU time of all threads by stack, 'functions': time in the engine's hot functions")
+    parser.add_argument('--host', default='127.0.0.1', help="Integration server address")
+    parser.add_argument('--port', type=int, default=8765, help="Integration server port")
+    return parser
+
+
+def parse_url_line(line):
+    """Parse one input line: a URL or a JSON object, None for blank lines and comments"""
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    if line.startswith('{'):
+        return json.loads(line)
+    return {'url': line}
+
+
+def read_url_entries(stream):
+    """Parse a stream with one URL (or JSON object) per line into request items"""
+    return [entry for entry in map(parse_url_line, stream) if entry is not None]
+
+
+def forward_to_running_instance(args):
+    """Send the URLs to an already running instance, returns None if there is none"""
+    try:
+        client = InstanceClient(timeout=2.0)
+    except OSError:
+        return None
+
+    items = [{'url': url} for url in args.urls]
+    for path in args.input_file or (['-'] if not args.urls and not sys.stdin.isatty() else []):
+        if path == '-':
+            items.extend(read_url_entries(sys.stdin))
+        else:
+            with open(path, 'r', encoding='utf-8') as f:
+                items.extend(read_url_entries(f))
+    try:
+        response = client.request({'items': items}) if items else {'status': 'success', 'count': 0}
+    finally:
+        client.close()
+    print(json.dumps({'event': 'forwarded', 'time': round(time.time(), 3), **response}))
+    return 0 if response.get('status') == 'success' else 1
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if not 0 < args.profile_seconds <= MAX_PROFILE_DURATION:
+        parser.error(f"--profile-seconds must be between 0 and {MAX_PROFILE_DURATION}")
+
+    # A running instance (GUI or daemon) takes the downloads instead of a second engine
+    if not args.daemon and not args.no_forward:
+        result = forward_to_running_instance(args)
+        if result is not None:
+            return result
+
+    os.makedirs(args.save_path, exist_ok=True)
+    # Daemons keep their queue across restarts
+    store_path = args.store or (DEFAULT_STORE_PATH if args.daemon and not args.no_store else None)
+    manager = HeadlessDownloadManager(args.save_path, args.max_concurrent, args.threads,
+                                      store_path=store_path, workers=args.workers)
+    engine = manager.download_engine
+    engine.speed_limit = args.speed_limit * 1024
+    manager.trace_path = args.trace_file
+    manager.profile_path = args.profile_file
+    manager.profile_duration = args.profile_seconds
+    manager.profile_mode = args.profile_mode
+    if args.trace:
+        manager.set_tracing(True)
+
+    # Long running daemons move finished downloads out of memory
+    keep_finished = args.keep_finished
+    if keep_finished is None and args.daemon:
+        keep_finished = 1000
+    if keep_finished is not None or args.keep_age is not None:
+        engine.set_retention_policy(RetentionPolicy(max_items=keep_finished, max_age=args.keep_age),
+                                    engine.store or DownloadHistory(args.history))
+
+    if store_path:
+        engine.restore_from_store()
+
+    if args.daemon:
+        manager.start_instance_server()
+        if not args.no_server:
+            manager.start_server(args.host, args.port)
+
+    for url in args.urls:
+        manager.add_download(url)
+
+    input_files = list(args.input_file)
+    if not args.urls and not input_files and not sys.stdin.isatty():
+        input_files.append('-')
+
+    def read_inputs():
+        for path in input_files:
+            if path == '-':
+                manager.add_from_stream(sys.stdin)
+            else:
+                with open(path, 'r', encoding='utf-8') as f:
+                    manager.add_from_stream(f)
+        manager.input_done.set()
+
+    # stdin can stay open in daemon mode, so read inputs in the background
+    reader = threading.Thread(target=read_inputs)
+    reader.daemon = True
+    reader.start()
+
+    return manager.run(daemon=args.daemon, interval=args.interval)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
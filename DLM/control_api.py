@@ -0,0 +1,257 @@
+import threading
+from itertools import chain
+from urllib.parse import parse_qs
+
+from download_engine import DownloadStatus, FINISHED_STATES
+from metrics import render_metrics
+from profiling import render_collapsed
+from registry import get_host
+
+# Fields of a download sent by the control API and the event stream
+DOWNLOAD_FIELDS = ('status', 'filename', 'downloaded_size', 'total_size', 'progress', 'speed', 'priority',
+                   'error_message')
+
+# Engine events that change a download's fields
+STREAM_EVENTS = ('added', 'started', 'paused', 'resumed', 'completed', 'error', 'canceled', 'priority')
+
+ACTIONS = ('pause', 'resume', 'cancel')
+
+
+def download_values(download_item):
+    """Current values of DOWNLOAD_FIELDS, rounded so that the stream only sends visible changes"""
+    return (download_item.status.value, download_item.filename, download_item.downloaded_size,
+            download_item.total_size, round(download_item.progress, 1), int(download_item.speed),
+            download_item.priority, download_item.error_message)
+
+
+def download_to_json(download_item):
+    """JSON-ready description of a download"""
+    record = dict(zip(DOWNLOAD_FIELDS, download_values(download_item)))
+    record['id'] = download_item.id
+    record['url'] = download_item.url
+    record['host'] = get_host(download_item.url)
+    return record
+
+
+class Subscription:
+    """Pending changes for one stream client.
+
+    Deltas of the same download are merged until the client takes them,
+    so a slow client gets fewer, larger updates instead of a backlog.
+    """
+
+    def __init__(self):
+        self.pending = {}
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def push(self, deltas):
+        with self.condition:
+            for delta in deltas:
+                merged = self.pending.get(delta['id'])
+                if merged is None:
+                    self.pending[delta['id']] = dict(delta)
+                else:
+                    merged.update(delta)
+            self.condition.notify()
+
+    def take(self, timeout):
+        """Wait for changes, returns a list of deltas (empty on timeout) or None once closed"""
+        with self.condition:
+            if not self.pending and not self.closed:
+                self.condition.wait(timeout)
+            if self.closed:
+                return None
+            deltas, self.pending = list(self.pending.values()), {}
+            return deltas
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+
+class ProgressBroadcaster:
+    """Turns engine state into coalesced deltas for the event stream.
+
+    Every interval the values of downloading downloads, and of downloads
+    that had an engine event since the last tick, are compared to what was
+    last sent. Only changed fields go out ({'id': ..., field: new value});
+    a download seen for the first time is sent in full and an evicted one
+    as {'id': ..., 'evicted': True}. One tick's deltas are shared by all
+    subscribers, so the cost doesn't grow with the number of clients.
+    """
+
+    def __init__(self, download_engine, interval=0.5):
+        self.download_engine = download_engine
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.subscriptions = []
+        self.dirty_ids = set()
+        self.evicted_ids = set()
+        self.last_sent = {}
+        self.stop_event = threading.Event()
+        self.thread = None
+        for event_type in STREAM_EVENTS:
+            download_engine.register_batch_callback(event_type, self._mark_dirty)
+        download_engine.register_batch_callback('evicted', self._mark_evicted)
+
+    def _mark_dirty(self, download_items):
+        if not self.subscriptions:
+            return
+        with self.lock:
+            self.dirty_ids.update(download_item.id for download_item in download_items)
+
+    def _mark_evicted(self, download_items):
+        if not self.subscriptions:
+            return
+        with self.lock:
+            self.evicted_ids.update(download_item.id for download_item in download_items)
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        with self.lock:
+            subscriptions, self.subscriptions = self.subscriptions, []
+        for subscription in subscriptions:
+            subscription.close()
+
+    def subscribe(self):
+        """New subscription and a snapshot of the downloads that aren't finished"""
+        subscription = Subscription()
+        with self.lock:
+            self.subscriptions.append(subscription)
+        _, downloads = self.download_engine.get_downloads(
+            status=(DownloadStatus.DOWNLOADING, DownloadStatus.PAUSED, DownloadStatus.QUEUED))
+        return subscription, [download_to_json(download_item) for download_item in downloads]
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            with self.lock:
+                dirty_ids, self.dirty_ids = self.dirty_ids, set()
+                evicted_ids, self.evicted_ids = self.evicted_ids, set()
+                subscriptions = list(self.subscriptions)
+            if not subscriptions:
+                # Nobody listens: deltas restart from full records for the next subscriber
+                self.last_sent.clear()
+                continue
+            deltas = self.collect(dirty_ids, evicted_ids)
+            if deltas:
+                for subscription in subscriptions:
+                    subscription.push(deltas)
+
+    def collect(self, dirty_ids, evicted_ids):
+        """Deltas of the downloads that changed since they were last sent"""
+        downloads = self.download_engine.downloads
+        _, active = self.download_engine.get_downloads(status=DownloadStatus.DOWNLOADING)
+        deltas = []
+        for download_item in chain(active, filter(None, map(downloads.get, dirty_ids))):
+            values = download_values(download_item)
+            last = self.last_sent.get(download_item.id)
+            if last == values:
+                continue
+            if last is None:
+                delta = download_to_json(download_item)
+            else:
+                delta = {field: value for field, value, old in zip(DOWNLOAD_FIELDS, values, last) if value != old}
+                delta['id'] = download_item.id
+            deltas.append(delta)
+            if download_item.status in FINISHED_STATES:
+                # Finished downloads don't change any more
+                self.last_sent.pop(download_item.id, None)
+            else:
+                self.last_sent[download_item.id] = values
+        for download_id in evicted_ids:
+            self.last_sent.pop(download_id, None)
+            deltas.append({'id': download_id, 'evicted': True})
+        return deltas
+
+
+class ControlAPI:
+    """REST-style control of the download engine.
+
+    GET  /downloads?status=&host=&offset=&limit=   page of downloads, newest first
+    GET  /downloads/<id>                           one download
+    POST /downloads/<id>/pause|resume|cancel
+    POST /downloads/<id>/priority {"priority": n}  higher starts first among queued downloads
+
+    Requests return (HTTP status, JSON-ready body). metrics() renders the
+    engine's metrics for GET /metrics, profile() answers
+    POST /profile?seconds=&mode= with collapsed stacks.
+    """
+
+    def __init__(self, download_engine):
+        self.download_engine = download_engine
+
+    def handle(self, method, path, query='', body=None):
+        parts = [part for part in path.split('/') if part]
+        if not parts or parts[0] != 'downloads' or len(parts) > 3:
+            return 404, {'status': 'error', 'message': 'Not found'}
+        if method == 'GET' and len(parts) == 1:
+            return self.list_downloads(parse_qs(query))
+        if method == 'GET' and len(parts) == 2:
+            download_item = self.download_engine.get_download_info(parts[1])
+            if download_item is None:
+                return 404, {'status': 'error', 'message': 'Unknown download'}
+            return 200, download_to_json(download_item)
+        if method == 'POST' and len(parts) == 3:
+            return self.control(parts[1], parts[2], body)
+        return 405, {'status': 'error', 'message': 'Method not allowed'}
+
+    def metrics(self):
+        """Prometheus text exposition of the engine metrics and download counts"""
+        return render_metrics(self.download_engine.metrics_snapshot(), self.download_engine.get_status_counts())
+
+    def profile(self, query):
+        """Profile the engine for ?seconds= (default 30) in ?mode= (see profiling.PROFILE_MODES).
+
+        Returns (HTTP status, collapsed stack text), or a JSON-ready error body.
+        """
+        params = parse_qs(query)
+        mode = params.get('mode', ['sample'])[0]
+        try:
+            seconds = float(params.get('seconds', ['30'])[0])
+            started = self.download_engine.start_profile(seconds, mode)
+        except ValueError as e:
+            return 400, {'status': 'error', 'message': str(e)}
+        if not started:
+            return 409, {'status': 'error', 'message': 'A profile is already running'}
+        return 200, render_collapsed(self.download_engine.profile_stacks())
+
+    def list_downloads(self, params):
+        try:
+            status = DownloadStatus(params['status'][0]) if 'status' in params else None
+            offset = int(params.get('offset', ['0'])[0])
+            limit = int(params.get('limit', ['100'])[0])
+        except ValueError as e:
+            return 400, {'status': 'error', 'message': str(e)}
+        host = params['host'][0] if 'host' in params else None
+        total, downloads = self.download_engine.get_downloads(status=status, host=host, offset=max(offset, 0),
+                                                              limit=max(limit, 0), newest_first=True)
+        return 200, {'total': total, 'downloads': [download_to_json(download_item) for download_item in downloads]}
+
+    def control(self, download_id, action, body):
+        if self.download_engine.get_download_info(download_id) is None:
+            return 404, {'status': 'error', 'message': 'Unknown download'}
+        if action in ACTIONS:
+            done = getattr(self.download_engine, f'{action}_download')(download_id)
+        elif action == 'priority':
+            priority = body.get('priority') if isinstance(body, dict) else None
+            if not isinstance(priority, int):
+                return 400, {'status': 'error', 'message': 'priority must be an integer'}
+            done = self.download_engine.set_priority(download_id, priority)
+        else:
+            return 404, {'status': 'error', 'message': 'Unknown action'}
+        if not done:
+            return 409, {'status': 'error', 'message': f'Cannot {action} this download now'}
+        return 200, {'status': 'success'}
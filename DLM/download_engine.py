@@ -1,13 +1,117 @@
 import os
+import errno
+import shutil
 import time
 import threading
 import queue
-import requests
+import itertools
+from array import array
+from email.utils import parsedate_to_datetime
 from urllib.parse import urlparse
-from dataclasses import dataclass
 from enum import Enum
 from typing import List, Dict, Optional, Callable
 
+from registry import DownloadRegistry, get_host
+from history import estimate_item_size
+from metrics import EngineMetrics
+from scheduling import QUEUE_POLL_INTERVAL, queue_order, use_segments, plan_segments
+from snapshot import SnapshotTable
+from speed import SpeedSampler, SAMPLE_INTERVAL
+from profiling import Profiler
+from tracing import Tracer, traced_adapter, write_trace, STALL_THRESHOLD, SLOW_WRITE_THRESHOLD
+from utils import is_valid_url, make_unique_filenames
+
+# (connect, read) timeout of HTTP requests in seconds
+REQUEST_TIMEOUT = (10, 60)
+
+# Times a segment request is retried after a network error, the first wait in seconds (doubles per retry)
+SEGMENT_RETRIES = 3
+RETRY_BACKOFF = 0.5
+
+# Statuses asking the client to come back later, retried after their Retry-After
+RETRY_LATER_STATUSES = (429, 503)
+
+# Longest Retry-After waited for, in seconds
+MAX_RETRY_AFTER = 60
+
+# Hosts with a kept-alive connection pool
+MAX_SESSIONS = 32
+
+# Methods timed by a 'functions' profile, see DownloadEngine.start_profile
+PROFILED_FUNCTIONS = ('_download_thread', '_trigger_callback')
+
+
+class IncompleteBody(IOError):
+    """A response body ended before all bytes of its range arrived"""
+
+
+class UnexpectedRange(IOError):
+    """A response doesn't start at the requested byte, or ignored the Range header"""
+
+
+class RetryLater(IOError):
+    """The server answered 429 or 503; retry_after is the wait it asked for in seconds, None if it didn't say"""
+    
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delay or HTTP date), None if missing or invalid"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def content_range_start(value):
+    """First byte of a 'bytes first-last/total' Content-Range header, None if there is none"""
+    try:
+        unit, _, byte_range = (value or '').partition(' ')
+        if unit != 'bytes':
+            return None
+        return int(byte_range.split('-', 1)[0])
+    except ValueError:
+        return None
+
+
+def retry_delay(error, retries):
+    """Seconds to wait before retrying after error: the server's Retry-After, else RETRY_BACKOFF doubled per retry"""
+    if isinstance(error, RetryLater) and error.retry_after is not None:
+        return min(error.retry_after, MAX_RETRY_AFTER)
+    return RETRY_BACKOFF * 2 ** retries
+
+
+def check_response(response, first_byte=None):
+    """Raise unless response carries the requested bytes, before anything of its body is used.
+    
+    first_byte is the start of the range asked for with a Range header,
+    None if the request had none: a ranged request needs a 206 starting at
+    first_byte, one without a Range header a 200.
+    """
+    if response.status_code in RETRY_LATER_STATUSES:
+        response.close()
+        raise RetryLater(f"Server answered {response.status_code}",
+                         parse_retry_after(response.headers.get('Retry-After')))
+    if response.status_code >= 400:
+        response.close()
+        response.raise_for_status()
+    if first_byte is None:
+        if response.status_code != 200:
+            response.close()
+            raise UnexpectedRange(f"Expected 200, server answered {response.status_code}")
+    elif response.status_code != 206 or content_range_start(response.headers.get('Content-Range')) != first_byte:
+        response.close()
+        raise UnexpectedRange(f"Asked for bytes from {first_byte}, server answered {response.status_code} "
+                              f"with Content-Range {response.headers.get('Content-Range')!r}")
+
 
 class DownloadStatus(Enum):
     QUEUED = 'queued'
@@ -18,24 +122,64 @@ class DownloadStatus(Enum):
     CANCELED = 'canceled'
 
 
-@dataclass
+ACTIVE_STATES = (DownloadStatus.DOWNLOADING, DownloadStatus.PAUSED)
+FINISHED_STATES = (DownloadStatus.COMPLETED, DownloadStatus.ERROR, DownloadStatus.CANCELED)
+
+
+class SegmentTable:
+    """Byte ranges of a multi-threaded download, kept in flat arrays instead of one dict per segment"""
+    __slots__ = ('starts', 'ends', 'downloaded')
+    
+    def __init__(self):
+        self.starts = array('q')
+        self.ends = array('q')
+        self.downloaded = array('q')
+    
+    def add(self, start_byte, end_byte):
+        """Add a segment and return its index"""
+        self.starts.append(start_byte)
+        self.ends.append(end_byte)
+        self.downloaded.append(0)
+        return len(self.starts) - 1
+    
+    def total_downloaded(self):
+        """Bytes downloaded over all segments"""
+        return sum(self.downloaded)
+    
+    def __len__(self):
+        return len(self.starts)
+
+
 class DownloadItem:
-    url: str
-    save_path: str
-    filename: Optional[str] = None
-    status: DownloadStatus = DownloadStatus.QUEUED
-    progress: float = 0.0
-    total_size: int = 0
-    downloaded_size: int = 0
-    speed: float = 0.0
-    threads: List[threading.Thread] = None
-    chunk_info: List[Dict] = None
-    start_time: float = 0.0
-    error_message: str = ''
-    id: str = ''
-    referrer: Optional[str] = None
-    
-    def __post_init__(self):
+    """A single download. Slotted so that large queues stay small in memory"""
+    __slots__ = ('url', 'save_path', 'filename', 'status', 'progress', 'total_size', 'downloaded_size',
+                 'speed', 'threads', 'segments', 'start_time', 'finish_time', 'error_message', 'id', 'referrer',
+                 'priority', 'queue_ticket')
+    
+    def __init__(self, url: str, save_path: str, filename: Optional[str] = None,
+                 status: DownloadStatus = DownloadStatus.QUEUED, progress: float = 0.0, total_size: int = 0,
+                 downloaded_size: int = 0, speed: float = 0.0, start_time: float = 0.0, finish_time: float = 0.0,
+                 error_message: str = '', id: str = '', referrer: Optional[str] = None, priority: int = 0):
+        self.url = url
+        self.save_path = save_path
+        self.filename = filename
+        self.status = status
+        self.progress = progress
+        self.total_size = total_size
+        self.downloaded_size = downloaded_size
+        self.speed = speed
+        self.start_time = start_time
+        self.finish_time = finish_time
+        self.error_message = error_message
+        self.id = id
+        self.referrer = referrer
+        self.priority = priority  # higher starts first among queued downloads
+        
+        # Runtime-only state, created when the download becomes active
+        self.threads: Optional[List[threading.Thread]] = None
+        self.segments: Optional[SegmentTable] = None
+        self.queue_ticket: Optional[int] = None  # ticket of the current queue entry, None if not queued
+        
         if not self.filename:
             self.filename = os.path.basename(urlparse(self.url).path) or 'download'
             if not self.filename or self.filename == '/':
@@ -43,26 +187,201 @@ class DownloadItem:
         
         if not self.id:
             self.id = str(hash(self.url + self.filename + str(time.time())))
+    
+    def __repr__(self):
+        return f"DownloadItem(id={self.id!r}, url={self.url!r}, filename={self.filename!r}, status={self.status})"
+
+
+class RateLimiter:
+    """Token bucket shared by the segment threads of an engine, rate in bytes per second (0 = unlimited).
+    
+    Reads may overdraw the bucket, the next reader waits until it is positive
+    again. Waits are cut into short sleeps so a changed rate applies at once.
+    """
+    
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.allowance = 0.0
+        self.last_time = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def consume(self, amount):
+        """Account for amount bytes, sleeping while over the rate"""
+        while self.rate > 0:
+            with self.lock:
+                now = time.monotonic()
+                # At most one second of unused rate is saved up
+                self.allowance = min(self.allowance + (now - self.last_time) * self.rate, self.rate)
+                self.last_time = now
+                if self.allowance > 0:
+                    self.allowance -= amount
+                    return
+                wait = -self.allowance / self.rate
+            time.sleep(min(wait, 0.1))
+
+
+def batch_directories(items, save_path=None):
+    """Directories the items of a batch add go to"""
+    return {item.get('save_path') or save_path for item in items if isinstance(item, dict)} - {None, ''}
+
+
+def prepare_batch(registry, items, save_path=None):
+    """Turn the items of a batch add into DownloadItems, see DownloadEngine.add_downloads.
+    
+    Call with registry.lock held and register the returned items before
+    releasing it, so concurrent batches can't add the same URL twice.
+    Returns (download items, download IDs with None for skipped items).
+    """
+    # Per directory: URLs and filenames of downloads that aren't finished yet, and the new items
+    directories = {}
+    download_items = []
+    download_ids = []
+    for item in items:
+        if not isinstance(item, dict):
+            item = {}
+        url = item.get('url')
+        directory = item.get('save_path') or save_path
+        if not isinstance(url, str) or not directory or not is_valid_url(url):
+            download_ids.append(None)
+            continue
+        if directory not in directories:
+            _, pending = registry.query(save_path=directory)
+            pending = [download_item for download_item in pending if download_item.status not in FINISHED_STATES]
+            directories[directory] = ({download_item.url for download_item in pending},
+                                      {download_item.filename for download_item in pending}, [])
+        urls, _, new_items = directories[directory]
+        if url in urls:
+            download_ids.append(None)
+            continue
+        urls.add(url)
+        priority = item.get('priority')
+        download_item = DownloadItem(url=url, save_path=directory, filename=item.get('filename'),
+                                     referrer=item.get('referrer'), id=item.get('id') or '',
+                                     priority=priority if isinstance(priority, int) else 0)
+        new_items.append(download_item)
+        download_items.append(download_item)
+        download_ids.append(download_item.id)
+    
+    for directory, (_, filenames, new_items) in directories.items():
+        # One directory listing per batch instead of an exists() call per file
+        try:
+            filenames.update(os.listdir(directory))
+        except OSError:
+            pass
+        names = make_unique_filenames([download_item.filename for download_item in new_items], filenames)
+        for download_item, filename in zip(new_items, names):
+            download_item.filename = filename
+    return download_items, download_ids
+
+
+def pool_counters(session):
+    """Requests sent and connections opened by the connection pools of a requests Session"""
+    requests = connections = 0
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                requests += pool.num_requests
+                connections += pool.num_connections
+    return requests, connections
+
+
+class DownloadQueries:
+    """Read access to downloads through self.registry, shared by the engine and its process proxies"""
+    
+    def get_download_info(self, download_id):
+        """Get information about a download"""
+        if download_id in self.downloads:
+            return self.downloads[download_id]
+        return None
+    
+    def get_all_downloads(self):
+        """Get all downloads"""
+        with self.registry.lock:
+            return list(self.downloads.values())
+    
+    def snapshot(self, since_version=None):
+        """Progress of all downloads as columns, see snapshot.EngineSnapshot.
         
-        self.threads = []
-        self.chunk_info = []
+        With the version of an earlier snapshot only the downloads added,
+        changed or evicted since then are returned (a full snapshot if that
+        version is too old). Costs time for the changed downloads only, so
+        views can poll it often.
+        """
+        return self.snapshots.take(self.registry, self.changes_lock, self.download_lock, since_version)
+    
+    def get_downloads(self, status=None, host=None, save_path=None, offset=0, limit=None, newest_first=False):
+        """Get a page of downloads matching the filters, returns (total count, downloads)"""
+        return self.registry.query(status, host, save_path, offset, limit, newest_first)
+    
+    def count_downloads(self, status=None, host=None, save_path=None):
+        """Count downloads matching the filters"""
+        return self.registry.count(status, host, save_path)
+    
+    def get_status_counts(self):
+        """Number of downloads for every status"""
+        counts = self.registry.counts_by_status()
+        return {status: counts.get(status, 0) for status in DownloadStatus}
+    
+    def get_host_counts(self):
+        """Number of downloads per host"""
+        return self.registry.counts_by_host()
 
 
-class DownloadEngine:
+class DownloadEngine(DownloadQueries):
     def __init__(self, max_concurrent_downloads=3, max_threads_per_download=3, chunk_size=1024*1024):
-        self.downloads: Dict[str, DownloadItem] = {}
-        self.download_queue = queue.Queue()
+        self.registry = DownloadRegistry()
+        self.downloads: Dict[str, DownloadItem] = self.registry.items  # read-only view, add through the registry
+        # Entries are (-priority, ticket, download_id, time queued); an entry whose ticket isn't the download's
+        # queue_ticket was replaced by set_priority (or the download was canceled) and is skipped
+        self.download_queue = queue.PriorityQueue()
+        self.ticket_counter = itertools.count()
         self.max_concurrent_downloads = max_concurrent_downloads
         self.max_threads_per_download = max_threads_per_download
         self.chunk_size = chunk_size
+        self.rate_limiter = RateLimiter()
         self.active_downloads = 0
         self.queue_lock = threading.Lock()
         self.download_lock = threading.Lock()
         self.stop_event = threading.Event()
-        self.queue_processor = threading.Thread(target=self._process_queue)
-        self.queue_processor.daemon = True
-        self.queue_processor.start()
+        self.reserved_space = {}  # download_id -> (device, bytes promised but not yet allocated)
+        self.queue_processor = None  # started with the first download
+        self.speed_sampler = SpeedSampler()
+        self.speed_thread = None  # started with the queue processor
         self.callbacks = {}
+        self.batch_callbacks = {}
+        
+        # Retention of finished downloads, see set_retention_policy
+        self.retention_policy = None
+        self.history = None
+        self.finished_order = {}  # download_id -> estimated size, oldest finished first
+        self.finished_memory = 0
+        self.last_retention_check = 0.0
+        
+        # Persistent queue/history store, see set_store
+        self.store = None
+        
+        # Ids of downloads whose progress or status changed since the last take_changed_ids()
+        self.changed_ids = set()
+        self.changes_lock = threading.Lock()
+        self.snapshots = SnapshotTable(DownloadStatus)
+        
+        # One requests Session per host, so segments and retries reuse connections
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+        self.metrics = EngineMetrics()
+        self.tracer = Tracer()
+        self.profiler = Profiler()
+    
+    @property
+    def speed_limit(self):
+        """Total download speed limit in bytes per second, 0 for unlimited"""
+        return self.rate_limiter.rate
+    
+    @speed_limit.setter
+    def speed_limit(self, value):
+        self.rate_limiter.rate = value
     
     def register_callback(self, event_type, callback):
         """Register callbacks for different events"""
@@ -70,70 +389,289 @@ class DownloadEngine:
             self.callbacks[event_type] = []
         self.callbacks[event_type].append(callback)
     
+    def register_batch_callback(self, event_type, callback):
+        """Register a callback taking a list of downloads, called once for events that happen in bulk"""
+        self.batch_callbacks.setdefault(event_type, []).append(callback)
+    
     def _trigger_callback(self, event_type, download_item):
         """Trigger registered callbacks"""
         if event_type in self.callbacks:
             for callback in self.callbacks[event_type]:
                 callback(download_item)
+        for callback in self.batch_callbacks.get(event_type, ()):
+            callback([download_item])
     
-    def add_download(self, url, save_path, filename=None, referrer=None) -> str:
+    def _trigger_batch_callback(self, event_type, download_items):
+        """Trigger registered callbacks for several downloads at once"""
+        for callback in self.callbacks.get(event_type, ()):
+            for download_item in download_items:
+                callback(download_item)
+        for callback in self.batch_callbacks.get(event_type, ()):
+            callback(download_items)
+    
+    def _ensure_queue_processor(self):
+        """Start the queue processor and speed sampler threads if they aren't running yet"""
+        with self.queue_lock:
+            if self.queue_processor is None and not self.stop_event.is_set():
+                self.queue_processor = threading.Thread(target=self._process_queue)
+                self.queue_processor.daemon = True
+                self.queue_processor.start()
+                self.speed_thread = threading.Thread(target=self._sample_speeds)
+                self.speed_thread.daemon = True
+                self.speed_thread.start()
+    
+    def add_download(self, url, save_path, filename=None, referrer=None, download_id=None) -> str:
         """Add a new download to the queue"""
-        download_item = DownloadItem(url=url, save_path=save_path, filename=filename, referrer=referrer)
+        download_item = DownloadItem(url=url, save_path=save_path, filename=filename, referrer=referrer,
+                                     id=download_id or '')
         
         # Create directory if it doesn't exist
         os.makedirs(download_item.save_path, exist_ok=True)
         
-        self.downloads[download_item.id] = download_item
-        self.download_queue.put(download_item.id)
+        self.registry.add(download_item)
+        self._mark_added([download_item])
+        if self.store is not None:
+            self.store.record(download_item)
+        self._enqueue(download_item)
+        self._ensure_queue_processor()
         self._trigger_callback('added', download_item)
         return download_item.id
     
+    def add_downloads(self, items, save_path=None):
+        """Add many downloads at once, e.g. all links of a page.
+        
+        items are dicts with a 'url' and optionally 'filename', 'referrer',
+        'save_path' (defaults to save_path) and 'id'. Invalid URLs and URLs
+        that are already waiting or downloading to the same directory (or
+        repeated in items) are skipped. Filenames are made unique against
+        the directory and the other downloads going there. Returns the new
+        download IDs, None for skipped items.
+        """
+        for directory in batch_directories(items, save_path):
+            os.makedirs(directory, exist_ok=True)
+        
+        with self.registry.lock:
+            download_items, download_ids = prepare_batch(self.registry, items, save_path)
+            for download_item in download_items:
+                self.registry.add(download_item)
+        self._mark_added(download_items)
+        for download_item in download_items:
+            if self.store is not None:
+                self.store.record(download_item)
+            self._enqueue(download_item)
+        if download_items:
+            self._ensure_queue_processor()
+            self._trigger_batch_callback('added', download_items)
+        return download_ids
+    
+    def _enqueue(self, download_item):
+        """Put a download in the queue, behind queued downloads of the same or a higher priority"""
+        ticket = next(self.ticket_counter)
+        download_item.queue_ticket = ticket
+        self.download_queue.put((*queue_order(download_item.priority, ticket), download_item.id, time.monotonic()))
+    
+    def set_priority(self, download_id, priority):
+        """Change the priority of a download, moving it in the queue if it is waiting"""
+        download_item = self.downloads.get(download_id)
+        if download_item is None or download_item.status in FINISHED_STATES:
+            return False
+        download_item.priority = priority
+        if download_item.status == DownloadStatus.QUEUED and download_item.queue_ticket is not None:
+            self._enqueue(download_item)
+        self._mark_changed(download_item)
+        self._trigger_callback('priority', download_item)
+        return True
+    
     def _process_queue(self):
         """Process the download queue"""
         while not self.stop_event.is_set():
-            if self.active_downloads < self.max_concurrent_downloads and not self.download_queue.empty():
+            self._apply_retention()
+            if self.active_downloads < self.max_concurrent_downloads:
+                # Block on the queue so a new download starts right away
                 try:
-                    download_id = self.download_queue.get(block=False)
-                    with self.download_lock:
-                        self.active_downloads += 1
-                    self._start_download(download_id)
-                    self.download_queue.task_done()
+                    _, ticket, download_id, queued_time = self.download_queue.get(timeout=QUEUE_POLL_INTERVAL)
                 except queue.Empty:
-                    pass
-            time.sleep(0.5)
+                    continue
+                download_item = self.downloads.get(download_id)
+                if download_item is None or download_item.queue_ticket != ticket:
+                    # Re-queued with another priority, canceled or evicted
+                    self.download_queue.task_done()
+                    continue
+                download_item.queue_ticket = None
+                waited = time.monotonic() - queued_time
+                self.metrics.observe_queue_wait(waited)
+                with self.download_lock:
+                    self.active_downloads += 1
+                self._start_download(download_id, waited)
+                self.download_queue.task_done()
+            else:
+                time.sleep(QUEUE_POLL_INTERVAL)
     
-    def _start_download(self, download_id):
-        """Start a download with the given ID"""
-        download_item = self.downloads[download_id]
-        download_item.status = DownloadStatus.DOWNLOADING
+    def _start_download(self, download_id, waited=0.0):
+        """Start a download with the given ID after it waited in the queue for waited seconds"""
+        download_item = self.downloads.get(download_id)
+        if download_item is None:
+            # Evicted while its queue entry was being taken
+            with self.download_lock:
+                self.active_downloads -= 1
+            return
+        tracer = self.tracer
+        if tracer.enabled:
+            tracer.track(f"{download_item.filename} setup")
+            now = time.perf_counter()
+            tracer.span('queued', 'download', now - waited, now)
+        if download_item.status != DownloadStatus.QUEUED:
+            # Canceled while waiting in the queue
+            with self.download_lock:
+                self.active_downloads -= 1
+            return
+        
+        # Items re-queued while waiting for disk space already know their size
+        if download_item.total_size > 0 and self._check_disk_space(download_item) == 'wait':
+            self._requeue_for_disk_space(download_item)
+            return
+        
         download_item.start_time = time.time()
+        download_item.error_message = ''
+        download_item.threads = []
+        if not self._set_status(download_item, DownloadStatus.DOWNLOADING, expected=(DownloadStatus.QUEUED,)):
+            with self.download_lock:
+                self.active_downloads -= 1
+            return
         
         # Get file size and check if resume is supported
         try:
+            import requests  # imported on first use to keep startup fast
+            
             headers = {}
             if download_item.referrer:
                 headers['Referer'] = download_item.referrer
                 
-            response = requests.head(download_item.url, headers=headers, allow_redirects=True)
-            total_size = int(response.headers.get('content-length', 0))
+            probe_start = time.perf_counter()
+            response = self._probe(download_item, headers)
+            if response is None:
+                # No HEAD support, the size shows up with the body
+                total_size = 0
+                supports_range = False
+            else:
+                total_size = int(response.headers.get('content-length', 0))
+                supports_range = response.headers.get('accept-ranges') == 'bytes'
             download_item.total_size = total_size
-            supports_range = 'accept-ranges' in response.headers and response.headers['accept-ranges'] == 'bytes'
+            if tracer.enabled:
+                tracer.span('probe', 'download', probe_start, size=total_size, ranges=supports_range)
         except Exception as e:
-            download_item.status = DownloadStatus.ERROR
-            download_item.error_message = str(e)
-            with self.download_lock:
-                self.active_downloads -= 1
-            self._trigger_callback('error', download_item)
+            self._fail_download(download_item, e)
             return
         
+        # Make sure the file fits on disk before any byte is transferred
+        if total_size > 0:
+            space = self._check_disk_space(download_item)
+            if space == 'wait':
+                self._requeue_for_disk_space(download_item)
+                return
+            try:
+                if space == 'fail':
+                    raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+                preallocate_start = time.perf_counter()
+                self._preallocate(download_item)
+                if tracer.enabled:
+                    tracer.span('preallocate', 'disk', preallocate_start, size=total_size)
+            except OSError as e:
+                self._fail_download(download_item, e, f"Not enough disk space: {e.strerror or str(e)}")
+                return
+        
         # Start download thread
-        if supports_range and total_size > 0 and self.max_threads_per_download > 1:
+        if use_segments(supports_range, total_size, self.max_threads_per_download):
             self._start_multi_threaded_download(download_item)
         else:
             self._start_single_threaded_download(download_item)
         
         self._trigger_callback('started', download_item)
     
+    def _probe(self, download_item, headers):
+        """HEAD response of a download's URL, None if the server doesn't allow HEAD.
+        
+        Error answers raise instead of passing their Content-Length off as
+        the size; 429 and 503 are retried like segment requests.
+        """
+        import requests
+        retries = 0
+        while True:
+            response = self._session(download_item.url).head(download_item.url, headers=headers,
+                                                             allow_redirects=True, timeout=REQUEST_TIMEOUT)
+            try:
+                check_response(response)
+                return response
+            except requests.HTTPError:
+                if response.status_code in (405, 501):
+                    return None
+                raise
+            except RetryLater as e:
+                if retries >= SEGMENT_RETRIES or self.stop_event.wait(retry_delay(e, retries)):
+                    raise
+                retries += 1
+    
+    def _check_disk_space(self, download_item):
+        """Check free space for a download against all in-flight reservations.
+        
+        Returns 'ok' and records a reservation if the file fits, 'wait' if it only
+        fits once other downloads have allocated their space, or 'fail' if it can
+        never fit on the device.
+        """
+        output_path = os.path.join(download_item.save_path, download_item.filename)
+        needed = download_item.total_size
+        if os.path.exists(output_path):
+            needed -= os.path.getsize(output_path)
+        
+        with self.download_lock:
+            try:
+                device = os.stat(download_item.save_path).st_dev
+                free = shutil.disk_usage(download_item.save_path).free
+            except OSError:
+                # Can't tell, let the write itself report the problem
+                return 'ok'
+            pending = sum(size for download_id, (dev, size) in self.reserved_space.items()
+                          if dev == device and download_id != download_item.id)
+            if needed > free:
+                return 'fail'
+            if needed > free - pending:
+                return 'wait'
+            self.reserved_space[download_item.id] = (device, max(needed, 0))
+        return 'ok'
+    
+    def _requeue_for_disk_space(self, download_item):
+        """Put a download back in the queue until other downloads free their reservations"""
+        self._set_status(download_item, DownloadStatus.QUEUED)
+        download_item.error_message = 'Waiting for disk space'
+        with self.download_lock:
+            self.active_downloads -= 1
+        self._enqueue(download_item)
+        # Don't spin on the queue while nothing has changed on disk
+        self.stop_event.wait(0.5)
+    
+    def _preallocate(self, download_item):
+        """Reserve the blocks of the output file up front"""
+        output_path = os.path.join(download_item.save_path, download_item.filename)
+        with open(output_path, 'ab') as f:
+            if os.path.getsize(output_path) > download_item.total_size:
+                f.truncate(download_item.total_size)
+            if hasattr(os, 'posix_fallocate'):
+                try:
+                    os.posix_fallocate(f.fileno(), 0, download_item.total_size)
+                    # Blocks are allocated now, free space already reflects them
+                    self._release_disk_space(download_item)
+                    return
+                except OSError as e:
+                    if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+                        raise
+            # Filesystem can't allocate up front; size the file and keep the reservation
+            f.truncate(download_item.total_size)
+    
+    def _release_disk_space(self, download_item):
+        """Drop the disk space reservation of a download"""
+        with self.download_lock:
+            self.reserved_space.pop(download_item.id, None)
+    
     def _start_single_threaded_download(self, download_item):
         """Start a single-threaded download"""
         thread = threading.Thread(
@@ -146,144 +684,326 @@ class DownloadEngine:
     
     def _start_multi_threaded_download(self, download_item):
         """Start a multi-threaded download"""
-        total_size = download_item.total_size
-        chunk_size = total_size // min(self.max_threads_per_download, total_size // self.chunk_size or 1)
-        
-        for i in range(min(self.max_threads_per_download, total_size // self.chunk_size or 1)):
-            start_byte = i * chunk_size
-            end_byte = start_byte + chunk_size - 1 if i < self.max_threads_per_download - 1 else total_size - 1
-            
-            # Create chunk info
-            chunk_info = {
-                'start': start_byte,
-                'end': end_byte,
-                'downloaded': 0,
-                'file_path': os.path.join(download_item.save_path, f"{download_item.filename}.part{i}")
-            }
-            download_item.chunk_info.append(chunk_info)
+        download_item.segments = SegmentTable()
+        for i, (start_byte, end_byte) in enumerate(plan_segments(download_item.total_size,
+                                                                 self.max_threads_per_download, self.chunk_size)):
+            # Every segment writes into its own range of the preallocated file
+            download_item.segments.add(start_byte, end_byte)
             
-            # Start thread for this chunk
             thread = threading.Thread(
                 target=self._download_thread,
                 args=(download_item, i, start_byte, end_byte)
             )
             thread.daemon = True
             download_item.threads.append(thread)
+        # Started once all are listed, so a segment finishing early doesn't complete the download
+        for thread in download_item.threads:
             thread.start()
     
     def _download_thread(self, download_item, chunk_index, start_byte, end_byte):
         """Download thread function"""
+        # Counters of this thread, updated without locks (see EngineMetrics)
+        cell = self.metrics.cell(get_host(download_item.url))
+        tracer = self.tracer
+        segment_start = time.perf_counter()
+        if tracer.enabled:
+            tracer.track(f"{download_item.filename} #{chunk_index}")
         try:
-            headers = {}
-            if start_byte > 0 or end_byte < download_item.total_size - 1:
-                headers['Range'] = f'bytes={start_byte}-{end_byte}'
-            
-            # Add referrer header if available
-            if download_item.referrer:
-                headers['Referer'] = download_item.referrer
-            
-            response = requests.get(download_item.url, headers=headers, stream=True)
+            import requests
+            retryable_errors = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                                IncompleteBody, UnexpectedRange, RetryLater)
+            session = self._session(download_item.url)
             
             # Determine file path
-            if len(download_item.chunk_info) > 0:
-                file_path = download_item.chunk_info[chunk_index]['file_path']
-            else:
-                file_path = os.path.join(download_item.save_path, download_item.filename)
+            file_path = os.path.join(download_item.save_path, download_item.filename)
+            segments = download_item.segments
             
-            # Open file for writing
-            with open(file_path, 'wb') as f:
+            # Preallocated files are written in place at the chunk's offset
+            preallocated = download_item.total_size > 0 and os.path.exists(file_path)
+            # Bytes this thread must receive, the file is already that long when preallocated
+            expected = min(end_byte, download_item.total_size - 1) - start_byte + 1
+            with open(file_path, 'r+b' if preallocated else 'wb') as f:
                 downloaded = 0
-                last_update_time = time.time()
-                last_downloaded = 0
+                retries = 0
                 
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk and download_item.status != DownloadStatus.PAUSED and download_item.status != DownloadStatus.CANCELED:
-                        f.write(chunk)
-                        downloaded += len(chunk)
-                        
-                        # Update chunk info if multi-threaded
-                        if len(download_item.chunk_info) > 0:
-                            download_item.chunk_info[chunk_index]['downloaded'] = downloaded
+                while True:
+                    # Retries continue where the failed attempt stopped
+                    first_byte = start_byte + downloaded
+                    headers = {}
+                    ranged = first_byte > 0 or end_byte < download_item.total_size - 1
+                    if ranged:
+                        headers['Range'] = f'bytes={first_byte}-{end_byte}'
+                    
+                    # Add referrer header if available
+                    if download_item.referrer:
+                        headers['Referer'] = download_item.referrer
+                    
+                    transfer_start = None
+                    try:
+                        request_time = time.perf_counter()
+                        response = session.get(download_item.url, headers=headers, stream=True,
+                                               timeout=REQUEST_TIMEOUT)
+                        transfer_start = last_chunk_time = time.perf_counter()
+                        cell.ttfb.observe(transfer_start - request_time)
+                        cell.streaming = True
+                        if tracer.enabled:
+                            tracer.span('request', 'segment', request_time, transfer_start,
+                                        first_byte=first_byte, status=response.status_code)
+                        # Error pages and shifted ranges must not reach the file or count as downloaded
+                        check_response(response, first_byte if ranged else None)
+                        if preallocated:
+                            f.seek(first_byte)
                         
-                        # Calculate total progress
-                        with self.download_lock:
-                            if len(download_item.chunk_info) > 0:
-                                total_downloaded = sum(chunk['downloaded'] for chunk in download_item.chunk_info)
-                            else:
-                                total_downloaded = downloaded
-                            
-                            download_item.downloaded_size = total_downloaded
-                            if download_item.total_size > 0:
-                                download_item.progress = total_downloaded / download_item.total_size * 100
-                            
-                            # Calculate download speed
-                            current_time = time.time()
-                            if current_time - last_update_time >= 1.0:  # Update speed every second
-                                download_item.speed = (total_downloaded - last_downloaded) / (current_time - last_update_time)
-                                last_update_time = current_time
-                                last_downloaded = total_downloaded
-                        
-                        # Trigger progress callback
-                        self._trigger_callback('progress', download_item)
-                    elif download_item.status == DownloadStatus.PAUSED:
-                        # Wait while paused
-                        while download_item.status == DownloadStatus.PAUSED and not self.stop_event.is_set():
-                            time.sleep(0.5)
-                    elif download_item.status == DownloadStatus.CANCELED:
+                        for chunk in response.iter_content(chunk_size=8192):
+                            if chunk and download_item.status != DownloadStatus.PAUSED and download_item.status != DownloadStatus.CANCELED:
+                                write_time = time.perf_counter()
+                                f.write(chunk)
+                                written_time = time.perf_counter()
+                                cell.write_latency.observe(written_time - write_time)
+                                cell.bytes += len(chunk)
+                                downloaded += len(chunk)
+                                self.rate_limiter.consume(len(chunk))
+                                if tracer.enabled:
+                                    if write_time - last_chunk_time > STALL_THRESHOLD:
+                                        tracer.span('stall', 'segment', last_chunk_time, write_time)
+                                    if written_time - write_time > SLOW_WRITE_THRESHOLD:
+                                        tracer.span('slow write', 'disk', write_time, written_time)
+                                    # Time spent in the speed limit isn't a stall
+                                    written_time = time.perf_counter()
+                                last_chunk_time = written_time
+                                
+                                # Update segment state if multi-threaded
+                                if segments is not None:
+                                    segments.downloaded[chunk_index] = downloaded
+                                
+                                # Calculate total progress
+                                with self.download_lock:
+                                    if segments is not None:
+                                        total_downloaded = segments.total_downloaded()
+                                    else:
+                                        total_downloaded = downloaded
+                                    
+                                    download_item.downloaded_size = total_downloaded
+                                    if download_item.total_size > 0:
+                                        download_item.progress = total_downloaded / download_item.total_size * 100
+                                self._mark_changed(download_item)
+                                
+                                # Trigger progress callback
+                                self._trigger_callback('progress', download_item)
+                            elif download_item.status == DownloadStatus.PAUSED:
+                                # Wait while paused
+                                pause_start = time.perf_counter()
+                                while download_item.status == DownloadStatus.PAUSED and not self.stop_event.is_set():
+                                    time.sleep(0.5)
+                                last_chunk_time = time.perf_counter()
+                                if tracer.enabled:
+                                    tracer.span('paused', 'segment', pause_start, last_chunk_time)
+                            elif download_item.status == DownloadStatus.CANCELED:
+                                break
+                        if (download_item.total_size > 0 and downloaded < expected
+                                and download_item.status != DownloadStatus.CANCELED):
+                            # A body closed early would leave zeros in the preallocated file
+                            raise IncompleteBody(f"Response ended after {downloaded} of {expected} bytes")
                         break
+                    except retryable_errors as e:
+                        # Only ranged requests can pick up after bytes were written
+                        if (retries >= SEGMENT_RETRIES or (segments is None and downloaded > 0)
+                                or download_item.status not in ACTIVE_STATES):
+                            raise
+                        error_class = type(e).__name__
+                        cell.retries[error_class] = cell.retries.get(error_class, 0) + 1
+                        backoff_start = time.perf_counter()
+                        if tracer.enabled:
+                            tracer.instant('retry', 'segment', error=error_class, attempt=retries + 1)
+                        if self.stop_event.wait(retry_delay(e, retries)):
+                            raise
+                        if tracer.enabled:
+                            tracer.span('backoff', 'segment', backoff_start)
+                        retries += 1
+                    finally:
+                        cell.streaming = False
+                        if transfer_start is not None and tracer.enabled:
+                            tracer.span('transfer', 'segment', transfer_start, bytes=start_byte + downloaded - first_byte)
             
             # Check if all threads are done for multi-threaded downloads
-            if len(download_item.chunk_info) > 0:
+            if segments is not None:
                 all_done = True
                 for thread in download_item.threads:
-                    if thread != threading.current_thread() and thread.is_alive():
+                    # Threads not started yet (ident None) still have their segment ahead of them
+                    if thread != threading.current_thread() and (thread.ident is None or thread.is_alive()):
                         all_done = False
                         break
                 
                 if all_done:
-                    self._merge_chunks(download_item)
+                    self._finish_download(download_item, DownloadStatus.COMPLETED)
             else:
                 # Single-threaded download completed
-                download_item.status = DownloadStatus.COMPLETED
-                with self.download_lock:
-                    self.active_downloads -= 1
-                self._trigger_callback('completed', download_item)
+                self._finish_download(download_item, DownloadStatus.COMPLETED)
         
         except Exception as e:
-            download_item.status = DownloadStatus.ERROR
-            download_item.error_message = str(e)
-            with self.download_lock:
-                self.active_downloads -= 1
-            self._trigger_callback('error', download_item)
+            self._fail_download(download_item, e)
+        finally:
+            self.metrics.release(cell)
+            if tracer.enabled:
+                tracer.span('segment', 'segment', segment_start, range=f"{start_byte}-{end_byte}")
     
-    def _merge_chunks(self, download_item):
-        """Merge downloaded chunks into a single file"""
-        try:
+    def _fail_download(self, download_item, error, error_message=None):
+        """Finish a download with an error, counting the error's class once per download"""
+        if self._finish_download(download_item, DownloadStatus.ERROR, error_message or str(error)):
+            self.metrics.count_error(type(error).__name__)
+    
+    def _session(self, url):
+        """requests Session for the host of url, the least recently used one is closed past MAX_SESSIONS"""
+        host = get_host(url)
+        with self.sessions_lock:
+            session = self.sessions.pop(host, None)
+            if session is None:
+                import requests
+                session = requests.Session()
+                adapter = traced_adapter(self.tracer, pool_maxsize=max(self.max_threads_per_download, 10))
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+            self.sessions[host] = session
+            if len(self.sessions) <= MAX_SESSIONS:
+                return session
+            oldest = next(iter(self.sessions))
+            closed = self.sessions.pop(oldest)
+        self.metrics.count_pool(*pool_counters(closed))
+        closed.close()
+        return session
+    
+    def set_tracing(self, enabled):
+        """Start or stop recording download spans, see tracing.Tracer"""
+        self.tracer.enabled = enabled
+    
+    def trace_events(self):
+        """Recorded download spans as Chrome trace events"""
+        return self.tracer.snapshot()
+    
+    def export_trace(self, path):
+        """Write the recorded spans as a Chrome trace file, returns the number of events"""
+        return write_trace(path, self.trace_events())
+    
+    def start_profile(self, duration, mode='sample', targets=()):
+        """Profile this process for duration seconds in the background, see profiling.Profiler.
+        
+        A 'functions' profile times PROFILED_FUNCTIONS and the (object,
+        method name) targets. Returns False if a profile is running already.
+        """
+        return self.profiler.start(duration, mode, [(self, name) for name in PROFILED_FUNCTIONS] + list(targets))
+    
+    def profile_stacks(self, timeout=None):
+        """Collapsed stacks of the last profile, None if it is still running after timeout seconds"""
+        return self.profiler.stacks(timeout)
+    
+    def profile(self, duration, mode='sample', targets=()):
+        """Profile for duration seconds and return the collapsed stacks, None if a profile is running already"""
+        if not self.start_profile(duration, mode, targets):
+            return None
+        return self.profile_stacks()
+    
+    def metrics_snapshot(self):
+        """Current metrics as plain data, see metrics.render_metrics"""
+        with self.sessions_lock:
+            sessions = list(self.sessions.values())
+        requests = connections = 0
+        for session in sessions:
+            session_requests, session_connections = pool_counters(session)
+            requests += session_requests
+            connections += session_connections
+        return self.metrics.snapshot(requests, connections)
+    
+    def total_speed(self):
+        """Smoothed speed of all downloads together in bytes per second"""
+        return self.speed_sampler.total_speed
+    
+    def speed_history(self, download_id=None):
+        """Speed per second of a running download, or of all downloads with None, oldest first"""
+        return self.speed_sampler.history(download_id)
+    
+    def _sample_speeds(self):
+        """Set the smoothed speed of the running downloads every SAMPLE_INTERVAL"""
+        while not self.stop_event.wait(SAMPLE_INTERVAL):
+            _, running = self.registry.query(status=DownloadStatus.DOWNLOADING)
+            for download_item in self.speed_sampler.sample(running, time.monotonic()):
+                # Final statuses were published already
+                if download_item.status not in FINISHED_STATES:
+                    self._mark_changed(download_item)
+    
+    def _set_status(self, download_item, status, expected=None):
+        """Change the status of a download, keeping the registry indexes and the store in step"""
+        changed = self.registry.set_status(download_item, status, expected)
+        if changed:
+            self._mark_changed(download_item)
+            if self.store is not None:
+                self.store.record(download_item)
+        return changed
+    
+    def _mark_changed(self, download_item):
+        """Publish a download in the next take_changed_ids()"""
+        with self.changes_lock:
+            self.changed_ids.add(download_item.id)
+            self.snapshots.mark_changed((download_item.id,))
+    
+    def _mark_added(self, download_items):
+        """Publish new downloads in the next snapshot() (take_changed_ids() reports status changes only)"""
+        with self.changes_lock:
+            self.snapshots.mark_changed([download_item.id for download_item in download_items])
+    
+    def take_changed_ids(self):
+        """Ids of the downloads that changed since the last call.
+        
+        Lets views refresh only what changed instead of polling every download;
+        finished downloads never show up again once their final status was taken.
+        """
+        with self.changes_lock:
+            changed, self.changed_ids = self.changed_ids, set()
+        return changed
+    
+    def _finish_download(self, download_item, status, error_message=None):
+        """Move an active download to a final status.
+        
+        Only the first caller wins, so a download finished by several segment
+        threads (or canceled while they run) is counted and reported once.
+        """
+        if not self._set_status(download_item, status, expected=ACTIVE_STATES):
+            return False
+        finalize_start = time.perf_counter()
+        if error_message is not None:
+            download_item.error_message = error_message
+        self._track_finished(download_item)
+        
+        if status == DownloadStatus.COMPLETED:
+            # Runtime state is no longer needed once the file is complete
+            download_item.threads = None
+            download_item.segments = None
+            elapsed = download_item.finish_time - download_item.start_time
+            if elapsed > 0:
+                self.metrics.observe_throughput(download_item.downloaded_size / elapsed)
+        elif status == DownloadStatus.CANCELED and download_item.total_size > 0:
+            # Clean up the partial (preallocated) file
             output_path = os.path.join(download_item.save_path, download_item.filename)
-            with open(output_path, 'wb') as output_file:
-                for chunk_info in download_item.chunk_info:
-                    with open(chunk_info['file_path'], 'rb') as chunk_file:
-                        output_file.write(chunk_file.read())
-                    # Delete chunk file
-                    os.remove(chunk_info['file_path'])
-            
-            download_item.status = DownloadStatus.COMPLETED
-            with self.download_lock:
-                self.active_downloads -= 1
-            self._trigger_callback('completed', download_item)
-        except Exception as e:
-            download_item.status = DownloadStatus.ERROR
-            download_item.error_message = f"Error merging chunks: {str(e)}"
-            with self.download_lock:
-                self.active_downloads -= 1
-            self._trigger_callback('error', download_item)
+            if os.path.exists(output_path):
+                try:
+                    os.remove(output_path)
+                except:
+                    pass
+        
+        self._release_disk_space(download_item)
+        with self.download_lock:
+            self.active_downloads -= 1
+        if self.store is not None:
+            self.store.record(download_item)  # with final size, message and finish time
+        self._trigger_callback(status.value, download_item)
+        if self.tracer.enabled:
+            self.tracer.span('finalize', 'download', finalize_start, status=status.value)
+        return True
     
     def pause_download(self, download_id):
         """Pause a download"""
         if download_id in self.downloads:
             download_item = self.downloads[download_id]
-            if download_item.status == DownloadStatus.DOWNLOADING:
-                download_item.status = DownloadStatus.PAUSED
+            if self._set_status(download_item, DownloadStatus.PAUSED, expected=(DownloadStatus.DOWNLOADING,)):
                 self._trigger_callback('paused', download_item)
                 return True
         return False
@@ -292,8 +1012,7 @@ class DownloadEngine:
         """Resume a paused download"""
         if download_id in self.downloads:
             download_item = self.downloads[download_id]
-            if download_item.status == DownloadStatus.PAUSED:
-                download_item.status = DownloadStatus.DOWNLOADING
+            if self._set_status(download_item, DownloadStatus.DOWNLOADING, expected=(DownloadStatus.PAUSED,)):
                 self._trigger_callback('resumed', download_item)
                 return True
         return False
@@ -302,46 +1021,129 @@ class DownloadEngine:
         """Cancel a download"""
         if download_id in self.downloads:
             download_item = self.downloads[download_id]
-            if download_item.status in [DownloadStatus.DOWNLOADING, DownloadStatus.PAUSED, DownloadStatus.QUEUED]:
-                download_item.status = DownloadStatus.CANCELED
-                
-                # If download was active, decrease active count
-                if download_item.status == DownloadStatus.DOWNLOADING:
-                    with self.download_lock:
-                        self.active_downloads -= 1
-                
-                # Clean up partial files
-                if len(download_item.chunk_info) > 0:
-                    for chunk_info in download_item.chunk_info:
-                        if os.path.exists(chunk_info['file_path']):
-                            try:
-                                os.remove(chunk_info['file_path'])
-                            except:
-                                pass
-                
+            
+            # Queued downloads don't hold a slot or any file yet
+            if self._set_status(download_item, DownloadStatus.CANCELED, expected=(DownloadStatus.QUEUED,)):
+                # Its queue entry is skipped, it may be evicted before it comes up
+                download_item.queue_ticket = None
+                self._track_finished(download_item)
+                if self.store is not None:
+                    self.store.record(download_item)
+                self._release_disk_space(download_item)
                 self._trigger_callback('canceled', download_item)
                 return True
+            
+            return self._finish_download(download_item, DownloadStatus.CANCELED)
         return False
     
-    def get_download_info(self, download_id):
-        """Get information about a download"""
-        if download_id in self.downloads:
-            return self.downloads[download_id]
-        return None
+    def set_store(self, store):
+        """Persist every download and status change to store (a DownloadStore)"""
+        self.store = store
     
-    def get_all_downloads(self):
-        """Get all downloads"""
-        return list(self.downloads.values())
+    def restore_from_store(self):
+        """Queue the downloads that were queued or active when the store was last written"""
+        if self.store is None:
+            return 0
+        # Downloads added since startup are already registered (and stored)
+        records = [record for record in self.store.load_pending() if record['id'] not in self.registry]
+        for record in records:
+            # Interrupted downloads start over, they go back to the queue
+            download_item = DownloadItem(url=record['url'], save_path=record['save_path'],
+                                         filename=record['filename'], id=record['id'],
+                                         referrer=record['referrer'], total_size=record['total_size'] or 0)
+            self.registry.add(download_item)
+            self._mark_added([download_item])
+            self._enqueue(download_item)
+            self._trigger_callback('added', download_item)
+        if records:
+            self._ensure_queue_processor()
+        return len(records)
+    
+    def set_retention_policy(self, retention_policy, history=None):
+        """Evict finished downloads from memory according to retention_policy, archiving them to history"""
+        self.retention_policy = retention_policy
+        self.history = history
+        self.last_retention_check = 0.0
+    
+    def _track_finished(self, download_item):
+        """Remember when a download reached a final status, oldest first"""
+        download_item.finish_time = time.time()
+        size = estimate_item_size(download_item)
+        with self.download_lock:
+            self.finished_order[download_item.id] = size
+            self.finished_memory += size
+    
+    def _apply_retention(self, interval=1.0):
+        """Move finished downloads that exceed the retention policy to the history"""
+        now = time.time()
+        if self.retention_policy is None or now - self.last_retention_check < interval:
+            return
+        self.last_retention_check = now
+        
+        evicted = []
+        with self.download_lock:
+            for download_id, size in self.finished_order.items():
+                download_item = self.downloads.get(download_id)
+                if download_item is not None and not self.retention_policy.should_evict(
+                        download_item, len(self.finished_order) - len(evicted),
+                        self.finished_memory, now):
+                    break
+                evicted.append(download_id)
+                self.finished_memory -= size
+            for download_id in evicted:
+                del self.finished_order[download_id]
+        
+        evicted_items = [item for item in map(self.registry.remove, evicted) if item is not None]
+        if not evicted_items:
+            return
+        with self.changes_lock:
+            self.snapshots.mark_removed([download_item.id for download_item in evicted_items])
+        if self.history is not None:
+            try:
+                self.history.append(evicted_items)
+            except OSError as e:
+                print(f"Error archiving downloads: {str(e)}")
+        for download_item in evicted_items:
+            self._trigger_callback('evicted', download_item)
+    
+    def search_history(self, text=None, status=None, offset=0, limit=100):
+        """Search archived downloads, newest first"""
+        if self.history is None:
+            return []
+        return self.history.search(text, status, offset, limit)
+    
+    def get_history_record(self, download_id):
+        """Archived record of a download, None if it isn't in the history"""
+        return self.history.get(download_id) if self.history is not None else None
+    
+    def requeue_from_history(self, download_id, save_path=None):
+        """Add an archived download to the queue again, returns the new download ID"""
+        record = self.get_history_record(download_id)
+        if record is None:
+            return None
+        return self.add_download(record['url'], save_path or record['save_path'],
+                                 record['filename'], record['referrer'])
     
     def shutdown(self):
         """Shutdown the download engine"""
         self.stop_event.set()
         
+        # Interrupted downloads stay queued in the store, so detach it before canceling
+        store, self.store = self.store, None
+        
         # Cancel all active downloads
-        for download_id, download_item in self.downloads.items():
-            if download_item.status in [DownloadStatus.DOWNLOADING, DownloadStatus.PAUSED]:
-                self.cancel_download(download_id)
+        _, active = self.get_downloads(status=ACTIVE_STATES)
+        for download_item in active:
+            self.cancel_download(download_item.id)
         
         # Wait for queue processor to finish
-        if self.queue_processor.is_alive():
-            self.queue_processor.join(timeout=2.0)
\ No newline at end of file
+        if self.queue_processor is not None and self.queue_processor.is_alive():
+            self.queue_processor.join(timeout=2.0)
+        
+        with self.sessions_lock:
+            sessions, self.sessions = list(self.sessions.values()), {}
+        for session in sessions:
+            session.close()
+        
+        if store is not None:
+            store.close()
@@ -0,0 +1,345 @@
+from PyQt5.QtWidgets import QApplication, QStyle, QStyledItemDelegate, QStyleOptionButton, QStyleOptionProgressBar
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex, QEvent, QRect, pyqtSignal
+
+from download_engine import DownloadStatus, FINISHED_STATES
+from registry import get_host
+from utils import format_size, format_speed, estimate_time_remaining
+
+# Columns of the download table
+COLUMN_NAME, COLUMN_STATUS, COLUMN_PROGRESS, COLUMN_SIZE, COLUMN_SPEED, COLUMN_ETA, COLUMN_HOST, COLUMN_ACTIONS = \
+    range(8)
+COLUMN_TITLES = ("Name", "Status", "Progress", "Size", "Speed", "ETA", "Host", "")
+
+# Role giving the download id of a row
+DownloadIdRole = Qt.UserRole
+
+SORT_KEYS = {
+    COLUMN_NAME: lambda download_item: (download_item.filename or '').lower(),
+    COLUMN_STATUS: lambda download_item: download_item.status.value,
+    COLUMN_PROGRESS: lambda download_item: download_item.progress,
+    COLUMN_SIZE: lambda download_item: download_item.total_size,
+    COLUMN_SPEED: lambda download_item: download_item.speed,
+    COLUMN_ETA: lambda download_item: ((download_item.total_size - download_item.downloaded_size) / download_item.speed
+                                       if download_item.speed > 0 else float('inf')),
+    COLUMN_HOST: lambda download_item: get_host(download_item.url),
+}
+
+
+class DownloadTableModel(QAbstractTableModel):
+    """Table model over the engine's downloads.
+
+    Rows hold references to the engine's DownloadItems, so data() reads
+    the live values and the view only asks for the rows it shows. The
+    status and host filters are answered by the registry indexes, and
+    sorting is a single list sort instead of a proxy calling back into
+    Python for every comparison.
+
+    self.items is kept in ascending order (add order when unsorted) and
+    shown reversed when self.descending is set, so the default view has
+    the newest download on top and new downloads are appended in O(1).
+    Speed, ETA and the other live keys change all the time, so refreshed
+    rows that moved out of order are sorted back into place.
+    """
+
+    def __init__(self, download_engine, parent=None):
+        super().__init__(parent)
+        self.download_engine = download_engine
+        self.items = []
+        self.row_of = {}
+        self.status_filter = None
+        self.host_filter = None
+        self.sort_column = None
+        self.descending = True
+
+    # Qt model interface
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.items)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(COLUMN_TITLES)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return COLUMN_TITLES[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        download_item = self.item_at(index.row())
+        column = index.column()
+        if role == Qt.DisplayRole:
+            if column == COLUMN_NAME:
+                return download_item.filename
+            if column == COLUMN_STATUS:
+                return download_item.status.value
+            if column == COLUMN_PROGRESS:
+                return int(download_item.progress)
+            if column == COLUMN_SIZE:
+                return f"{format_size(download_item.downloaded_size)} / {format_size(download_item.total_size)}"
+            if column == COLUMN_SPEED:
+                return format_speed(download_item.speed) if download_item.status == DownloadStatus.DOWNLOADING else ""
+            if column == COLUMN_ETA:
+                if download_item.status != DownloadStatus.DOWNLOADING or download_item.total_size <= 0:
+                    return ""
+                return estimate_time_remaining(download_item.downloaded_size, download_item.total_size,
+                                               download_item.speed)
+            if column == COLUMN_HOST:
+                return get_host(download_item.url)
+        elif role == Qt.ToolTipRole:
+            if column == COLUMN_STATUS and download_item.error_message:
+                return download_item.error_message
+            return download_item.url
+        elif role == DownloadIdRole:
+            return download_item.id
+        return None
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        """Sort the rows by a column (called by the view when a header is clicked)"""
+        def reorder():
+            self.sort_column = column if column in SORT_KEYS else None
+            self.descending = order == Qt.DescendingOrder
+            self._sort_items()
+        self._change_layout(reorder)
+
+    # Rows
+
+    def item_at(self, row):
+        """DownloadItem shown in a row"""
+        return self.items[len(self.items) - 1 - row if self.descending else row]
+
+    def row_for(self, download_id):
+        """Row showing a download, None if it is filtered out"""
+        position = self.row_of.get(download_id)
+        if position is None:
+            return None
+        return len(self.items) - 1 - position if self.descending else position
+
+    def _sort_items(self):
+        if self.sort_column is None:
+            # The registry returns downloads in add order
+            _, self.items = self.download_engine.get_downloads(status=self.status_filter, host=self.host_filter)
+        else:
+            self.items.sort(key=SORT_KEYS[self.sort_column])
+        self.row_of = {}
+        self._reindex()
+
+    def _change_layout(self, reorder):
+        """Run reorder() as a layout change, the selection and current row stay on their downloads"""
+        self.layoutAboutToBeChanged.emit()
+        persistent = self.persistentIndexList()
+        locations = [(self.item_at(index.row()).id, index.column()) for index in persistent]
+        reorder()
+        moved = []
+        for download_id, column in locations:
+            row = self.row_for(download_id)
+            moved.append(self.index(row, column) if row is not None else QModelIndex())
+        self.changePersistentIndexList(persistent, moved)
+        self.layoutChanged.emit()
+
+    def _keep_sorted(self, download_ids):
+        """Sort again if any of the downloads no longer sits between its neighbours"""
+        if self.sort_column is None:
+            return
+        key = SORT_KEYS[self.sort_column]
+        items = self.items
+        last = len(items) - 1
+        for download_id in download_ids:
+            position = self.row_of.get(download_id)
+            if position is None:
+                continue
+            value = key(items[position])
+            if position > 0 and key(items[position - 1]) > value:
+                break
+            if position < last and value > key(items[position + 1]):
+                break
+        else:
+            return
+
+        def reorder():
+            self.items.sort(key=key)
+            self._reindex()
+        self._change_layout(reorder)
+
+    def _reindex(self, start=0):
+        row_of = self.row_of
+        for position in range(start, len(self.items)):
+            row_of[self.items[position].id] = position
+
+    def matches(self, download_item):
+        """Check a download against the status and host filters"""
+        if self.status_filter is not None and download_item.status != self.status_filter:
+            return False
+        if self.host_filter is not None and get_host(download_item.url) != self.host_filter:
+            return False
+        return True
+
+    def set_filter(self, status=None, host=None):
+        """Show only downloads with the given status and/or host"""
+        self.status_filter = status
+        self.host_filter = host
+        self.reload()
+
+    def reload(self):
+        """Fetch the rows from the engine again"""
+        self.beginResetModel()
+        if self.sort_column is not None:
+            _, self.items = self.download_engine.get_downloads(status=self.status_filter, host=self.host_filter)
+        self._sort_items()
+        self.endResetModel()
+
+    def add_item(self, download_item):
+        """Show a new download if it passes the filters"""
+        if download_item.id in self.row_of or not self.matches(download_item):
+            return
+        if self.sort_column is None:
+            position = len(self.items)
+        else:
+            position = self._insert_position(download_item)
+        row = len(self.items) - position if self.descending else position
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.items.insert(position, download_item)
+        self._reindex(position)
+        self.endInsertRows()
+
+    def add_items(self, download_items):
+        """Show new downloads, unsorted views insert them as one block of rows"""
+        download_items = [download_item for download_item in download_items
+                          if download_item.id not in self.row_of and self.matches(download_item)]
+        if self.sort_column is not None or len(download_items) < 2:
+            for download_item in download_items:
+                self.add_item(download_item)
+            return
+        # Newest on top: appended items become the first rows
+        position = len(self.items)
+        if self.descending:
+            first, last = 0, len(download_items) - 1
+        else:
+            first, last = position, position + len(download_items) - 1
+        self.beginInsertRows(QModelIndex(), first, last)
+        self.items.extend(download_items)
+        self._reindex(position)
+        self.endInsertRows()
+
+    def _insert_position(self, download_item):
+        # Keys changed since the last refresh can leave the spot slightly off, the next refresh fixes it
+        key = SORT_KEYS[self.sort_column]
+        value = key(download_item)
+        low, high = 0, len(self.items)
+        while low < high:
+            middle = (low + high) // 2
+            if key(self.items[middle]) <= value:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def remove_items(self, download_ids):
+        """Drop downloads from the table"""
+        positions = sorted((self.row_of[download_id] for download_id in download_ids if download_id in self.row_of),
+                           reverse=True)
+        if not positions:
+            return
+        for position in positions:
+            row = len(self.items) - 1 - position if self.descending else position
+            self.beginRemoveRows(QModelIndex(), row, row)
+            del self.row_of[self.items[position].id]
+            del self.items[position]
+            self.endRemoveRows()
+        self._reindex(positions[-1])
+
+    def update_item(self, download_item):
+        """Refresh the row of a download, adding or dropping it when it enters or leaves the filter"""
+        row = self.row_for(download_item.id)
+        if row is None:
+            # Events of a download that was evicted in the meantime don't bring it back
+            if download_item.id in self.download_engine.registry:
+                self.add_item(download_item)
+        elif not self.matches(download_item):
+            self.remove_items([download_item.id])
+        else:
+            self._keep_sorted((download_item.id,))
+            row = self.row_for(download_item.id)
+            self.dataChanged.emit(self.index(row, 0), self.index(row, COLUMN_ACTIONS))
+
+    def refresh_items(self, download_ids):
+        """Repaint the rows of downloads that changed since the last refresh.
+
+        Rows are repainted in contiguous runs, one dataChanged per run.
+        Status changes come through update_item, so rows of finished
+        downloads are skipped here.
+        """
+        self._keep_sorted(download_ids)
+        rows = []
+        for download_id in download_ids:
+            row = self.row_for(download_id)
+            if row is not None and self.item_at(row).status not in FINISHED_STATES:
+                rows.append(row)
+        rows.sort()
+        start = 0
+        for i in range(1, len(rows) + 1):
+            if i == len(rows) or rows[i] != rows[i - 1] + 1:
+                self.dataChanged.emit(self.index(rows[start], COLUMN_STATUS), self.index(rows[i - 1], COLUMN_ACTIONS))
+                start = i
+
+
+class ProgressBarDelegate(QStyledItemDelegate):
+    """Paints the progress column as a progress bar"""
+
+    def paint(self, painter, option, index):
+        progress_option = QStyleOptionProgressBar()
+        progress_option.rect = option.rect.adjusted(2, 4, -2, -4)
+        progress_option.minimum = 0
+        progress_option.maximum = 100
+        progress_option.progress = index.data() or 0
+        progress_option.text = f"{progress_option.progress}%"
+        progress_option.textVisible = True
+        progress_option.state = option.state
+        QApplication.style().drawControl(QStyle.CE_ProgressBar, progress_option, painter)
+
+
+class DownloadActionsDelegate(QStyledItemDelegate):
+    """Paints Pause/Resume and Cancel buttons and turns clicks on them into signals"""
+
+    pause_resume_clicked = pyqtSignal(str)
+    cancel_clicked = pyqtSignal(str)
+
+    BUTTON_WIDTH = 70
+
+    def button_rects(self, rect):
+        pause_rect = QRect(rect.left() + 2, rect.top() + 2, self.BUTTON_WIDTH, rect.height() - 4)
+        cancel_rect = QRect(pause_rect.right() + 4, rect.top() + 2, self.BUTTON_WIDTH, rect.height() - 4)
+        return pause_rect, cancel_rect
+
+    def paint(self, painter, option, index):
+        download_item = index.model().item_at(index.row())
+        enabled = download_item.status not in FINISHED_STATES
+        pause_rect, cancel_rect = self.button_rects(option.rect)
+        labels = ("Resume" if download_item.status == DownloadStatus.PAUSED else "Pause", "Cancel")
+        for rect, label in zip((pause_rect, cancel_rect), labels):
+            button_option = QStyleOptionButton()
+            button_option.rect = rect
+            button_option.text = label
+            button_option.state = QStyle.State_Enabled if enabled else QStyle.State_None
+            QApplication.style().drawControl(QStyle.CE_PushButton, button_option, painter)
+
+    def sizeHint(self, option, index):
+        size = super().sizeHint(option, index)
+        size.setWidth(2 * self.BUTTON_WIDTH + 8)
+        return size
+
+    def editorEvent(self, event, model, option, index):
+        if event.type() != QEvent.MouseButtonRelease or event.button() != Qt.LeftButton:
+            return False
+        download_item = model.item_at(index.row())
+        if download_item.status in FINISHED_STATES:
+            return False
+        pause_rect, cancel_rect = self.button_rects(option.rect)
+        if pause_rect.contains(event.pos()):
+            self.pause_resume_clicked.emit(download_item.id)
+            return True
+        if cancel_rect.contains(event.pos()):
+            self.cancel_clicked.emit(download_item.id)
+            return True
+        return False
@@ -0,0 +1,817 @@
+import itertools
+import threading
+from array import array
+import multiprocessing
+from multiprocessing import shared_memory
+
+from download_engine import (DownloadEngine, DownloadItem, DownloadStatus, DownloadQueries, ACTIVE_STATES, FINISHED_STATES,
+                             prepare_batch)
+from registry import DownloadRegistry
+from history import RetentionPolicy, item_to_record
+from metrics import merge_snapshots
+from tracing import write_trace
+from snapshot import SnapshotTable
+from profiling import Profiler, prefix_stacks
+from speed import HISTORY_SECONDS
+
+# Engine events forwarded over the pipe; progress goes through the shared table instead
+FORWARDED_EVENTS = ('added', 'started', 'paused', 'resumed', 'completed', 'error', 'canceled', 'evicted')
+
+# Sent by the engine process for downloads that left its queue, ahead of their 'started' event
+CLAIMED_EVENT = 'claimed'
+
+# Engine methods the parent may call in the engine process
+ENGINE_CALLS = ('add_download', 'add_downloads', 'pause_download', 'resume_download', 'cancel_download',
+                'set_priority', 'restore_from_store', 'set_retention_policy', 'search_history',
+                'get_history_record', 'requeue_from_history', 'metrics_snapshot',
+                'set_tracing', 'trace_events', 'speed_history', 'start_profile', 'profile_stacks')
+
+
+class ProgressTable:
+    """Progress of active downloads in a fixed-layout shared memory block.
+
+    The block is a struct of arrays: an int64 version counter, then one
+    column per field with an entry per slot (int64 sequence, generation,
+    downloaded_size and total_size, float64 speed and progress). The engine
+    process bumps a slot's sequence to an odd value before writing the row
+    and to the next even value after, so readers retry instead of taking a
+    half-written row. A slot's generation changes every time it is given to
+    another download.
+
+    After the columns come the speeds of the whole engine process, guarded
+    the same way by their own sequence: an int64 sequence and history
+    length, the float64 total speed and HISTORY_SECONDS float64 per-second
+    speeds, oldest first.
+    """
+
+    INT_COLUMNS = ('sequence', 'generation', 'downloaded_size', 'total_size')
+    FLOAT_COLUMNS = ('speed', 'progress')
+
+    def __init__(self, buffer, slots):
+        self.slots = slots
+        self.views = [buffer[0:8].cast('q')]
+        self.version = self.views[0]
+        offset = 8
+        for name in self.INT_COLUMNS + self.FLOAT_COLUMNS:
+            view = buffer[offset:offset + 8 * slots].cast('q' if name in self.INT_COLUMNS else 'd')
+            setattr(self, name, view)
+            self.views.append(view)
+            offset += 8 * slots
+        self.speed_header = buffer[offset:offset + 16].cast('q')  # sequence, history length
+        self.total_speed = buffer[offset + 16:offset + 24].cast('d')
+        self.history = buffer[offset + 24:offset + 24 + 8 * HISTORY_SECONDS].cast('d')
+        self.views += [self.speed_header, self.total_speed, self.history]
+
+    @classmethod
+    def size(cls, slots):
+        return 8 + 8 * slots * (len(cls.INT_COLUMNS) + len(cls.FLOAT_COLUMNS)) + 24 + 8 * HISTORY_SECONDS
+
+    def write(self, slot, download_item):
+        """Publish the progress of a download (engine process only)"""
+        sequence = self.sequence[slot]
+        self.sequence[slot] = sequence + 1
+        self.downloaded_size[slot] = download_item.downloaded_size
+        self.total_size[slot] = download_item.total_size
+        self.speed[slot] = download_item.speed
+        self.progress[slot] = download_item.progress
+        self.sequence[slot] = sequence + 2
+
+    def read(self, slot, retries=100):
+        """Consistent (sequence, generation, downloaded_size, total_size, speed, progress) of a slot, None if busy"""
+        for _ in range(retries):
+            sequence = self.sequence[slot]
+            if sequence & 1:
+                continue
+            row = (sequence, self.generation[slot], self.downloaded_size[slot], self.total_size[slot],
+                   self.speed[slot], self.progress[slot])
+            if self.sequence[slot] == sequence:
+                return row
+        return None
+
+    def write_speeds(self, total_speed, history):
+        """Publish the total speed and per-second history of the engine process (engine process only)"""
+        history = history[-len(self.history):]
+        sequence = self.speed_header[0]
+        self.speed_header[0] = sequence + 1
+        self.total_speed[0] = total_speed
+        self.history[:len(history)] = array('d', history)
+        self.speed_header[1] = len(history)
+        self.speed_header[0] = sequence + 2
+
+    def read_speeds(self, retries=100):
+        """Consistent (total speed, history) of the engine process, None if busy"""
+        for _ in range(retries):
+            sequence = self.speed_header[0]
+            if sequence & 1:
+                continue
+            speeds = (self.total_speed[0], self.history[:self.speed_header[1]].tolist())
+            if self.speed_header[0] == sequence:
+                return speeds
+        return None
+
+    def release(self):
+        """Drop the views so the shared memory can be closed"""
+        for view in self.views:
+            view.release()
+        self.views = []
+
+
+class EngineHost:
+    """Runs a DownloadEngine for a parent process (the engine process side).
+
+    Commands arrive over the pipe, events go back over it with the record
+    of the download, and progress is published to the ProgressTable.
+    """
+
+    def __init__(self, download_engine, connection, table, publish_interval=1 / 60):
+        self.download_engine = download_engine
+        self.connection = connection
+        self.table = table
+        self.publish_interval = publish_interval
+        self.send_lock = threading.Lock()
+        self.events_lock = threading.Lock()  # records go out in the order they were taken
+        self.slots_lock = threading.Lock()
+        self.free_slots = list(range(table.slots - 1, -1, -1))
+        self.slot_of = {}
+        self.stop_event = threading.Event()
+        for event_type in FORWARDED_EVENTS:
+            download_engine.register_batch_callback(event_type, self._make_event_handler(event_type))
+
+    def _make_event_handler(self, event_type):
+        def handler(download_items):
+            self.on_events(event_type, download_items)
+        return handler
+
+    def send(self, message):
+        with self.send_lock:
+            try:
+                self.connection.send(message)
+            except (OSError, ValueError):
+                pass
+
+    def on_events(self, event_type, download_items):
+        """Forward engine events in one message, giving active downloads a progress slot"""
+        with self.events_lock:
+            events = []
+            for download_item in download_items:
+                with self.slots_lock:
+                    slot = self.slot_of.get(download_item.id)
+                    if slot is None and download_item.status in (DownloadStatus.DOWNLOADING, DownloadStatus.PAUSED):
+                        if self.free_slots:
+                            slot = self.free_slots.pop()
+                            self.table.generation[slot] += 1
+                            self.table.write(slot, download_item)
+                            self.slot_of[download_item.id] = slot
+                    elif slot is not None and (download_item.status in FINISHED_STATES or event_type == 'evicted'):
+                        # The final values travel with the event
+                        del self.slot_of[download_item.id]
+                        self.free_slots.append(slot)
+                        slot = None
+                    location = None if slot is None else (slot, self.table.generation[slot])
+                record = item_to_record(download_item)
+                record['progress'] = download_item.progress
+                record['speed'] = download_item.speed
+                events.append((record, location))
+            self.send(('events', event_type, events))
+
+    def publish_progress(self):
+        """Copy changed downloads, and the speeds after every sample, into the progress table"""
+        sampled = None
+        while not self.stop_event.wait(self.publish_interval):
+            speed_sampler = self.download_engine.speed_sampler
+            if speed_sampler.last_time != sampled:
+                sampled = speed_sampler.last_time
+                self.table.write_speeds(speed_sampler.total_speed, speed_sampler.history())
+            changed_ids = self.download_engine.take_changed_ids()
+            if not changed_ids:
+                continue
+            downloads = self.download_engine.downloads
+            claimed = []
+            with self.slots_lock:
+                for download_id in changed_ids:
+                    slot = self.slot_of.get(download_id)
+                    download_item = downloads.get(download_id)
+                    if slot is not None and download_item is not None:
+                        self.table.write(slot, download_item)
+                    elif download_item is not None and download_item.status == DownloadStatus.DOWNLOADING:
+                        claimed.append(download_item)
+                self.table.version[0] += 1
+            if claimed:
+                # The parent counts their concurrency slots before their size is probed
+                self.on_events(CLAIMED_EVENT, claimed)
+
+    def call(self, method, args, kwargs):
+        if method not in ENGINE_CALLS:
+            raise ValueError(f"Unknown engine call: {method}")
+        if method == 'set_retention_policy':
+            # Evicted downloads are archived to the engine process's own store
+            args = (args[0], self.download_engine.store)
+        return getattr(self.download_engine, method)(*args, **kwargs)
+
+    def run(self):
+        """Serve commands until the parent asks to stop or goes away"""
+        publisher = threading.Thread(target=self.publish_progress)
+        publisher.daemon = True
+        publisher.start()
+        while True:
+            try:
+                message = self.connection.recv()
+            except (EOFError, OSError):
+                break
+            kind = message[0]
+            if kind == 'shutdown':
+                break
+            if kind == 'set':
+                setattr(self.download_engine, message[1], message[2])
+            elif kind == 'call':
+                _, request_id, method, args, kwargs = message
+                try:
+                    result, error = self.call(method, args, kwargs), None
+                except Exception as e:
+                    result, error = None, str(e)
+                if request_id is not None:
+                    self.send(('result', request_id, result, error))
+
+        self.download_engine.shutdown()
+        self.stop_event.set()
+        publisher.join()
+        self.send(('stopped',))
+
+
+def run_engine_process(connection, table_name, slots, options):
+    """Entry point of the engine process"""
+    table_memory = shared_memory.SharedMemory(name=table_name)
+    table = ProgressTable(table_memory.buf, slots)
+    download_engine = DownloadEngine(max_concurrent_downloads=options['max_concurrent_downloads'],
+                                     max_threads_per_download=options['max_threads_per_download'])
+    download_engine.speed_limit = options.get('speed_limit', 0)
+    if options.get('store_path'):
+        from store import DownloadStore
+        download_engine.set_store(DownloadStore(options['store_path']))
+    try:
+        EngineHost(download_engine, connection, table).run()
+    finally:
+        table.release()
+        table_memory.close()
+        connection.close()
+
+
+def split_budget(total, demands, held=None):
+    """Split total units between consumers one unit at a time, nobody getting more than it asks for.
+
+    Consumers keep the units in held (units they are using), only what is
+    left of total after them is split, each unit going to the consumer with
+    the smallest share. The shares can add up to more than total until the
+    held units are given back.
+    """
+    shares = list(held) if held is not None else [0] * len(demands)
+    remaining = total - sum(shares)
+    while remaining > 0:
+        wanting = [i for i, demand in enumerate(demands) if shares[i] < demand]
+        if not wanting:
+            break
+        shares[min(wanting, key=shares.__getitem__)] += 1
+        remaining -= 1
+    return shares
+
+
+class EngineWorker:
+    """Parent side of one engine process: its pipe, progress table and pending calls"""
+
+    def __init__(self, index, options, slots, on_event, call_timeout=10.0):
+        self.index = index
+        self.on_event = on_event
+        self.call_timeout = call_timeout
+
+        self.table_memory = shared_memory.SharedMemory(create=True, size=ProgressTable.size(slots))
+        self.table = ProgressTable(self.table_memory.buf, slots)
+        self.table_version = 0
+        self.speeds = (0.0, [])
+        self.slots_lock = threading.Lock()
+        self.slot_of = {}  # download_id -> (slot, generation)
+        self.seen_sequence = {}
+
+        self.send_lock = threading.Lock()
+        self.request_ids = itertools.count()
+        self.pending_calls = {}
+        self.stopped = threading.Event()
+
+        # spawn, not fork: the GUI process has Qt and threads running
+        context = multiprocessing.get_context('spawn')
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=run_engine_process,
+                                       args=(child_connection, self.table_memory.name, slots, options))
+        self.process.daemon = True
+        self.process.start()
+        child_connection.close()
+
+        self.reader = threading.Thread(target=self._read_messages)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def send(self, message):
+        with self.send_lock:
+            self.connection.send(message)
+
+    def set(self, name, value):
+        """Set an engine attribute in the engine process"""
+        self.send(('set', name, value))
+
+    def call(self, method, *args, **kwargs):
+        """Call an engine method in the engine process and wait for its result"""
+        request_id = next(self.request_ids)
+        done = threading.Event()
+        self.pending_calls[request_id] = [done, None, None]
+        self.send(('call', request_id, method, args, kwargs))
+        if not done.wait(self.call_timeout):
+            self.pending_calls.pop(request_id, None)
+            raise TimeoutError(f"Engine process did not answer {method}")
+        _, result, error = self.pending_calls.pop(request_id)
+        if error is not None:
+            raise RuntimeError(error)
+        return result
+
+    def cast(self, method, *args, **kwargs):
+        """Call an engine method in the engine process without waiting"""
+        self.send(('call', None, method, args, kwargs))
+
+    def _read_messages(self):
+        while True:
+            try:
+                message = self.connection.recv()
+            except (EOFError, OSError):
+                break
+            kind = message[0]
+            if kind == 'events':
+                _, event_type, events = message
+                for record, location in events:
+                    with self.slots_lock:
+                        if location is None:
+                            self.slot_of.pop(record['id'], None)
+                            self.seen_sequence.pop(record['id'], None)
+                        else:
+                            self.slot_of[record['id']] = location
+                    self.on_event(self, event_type, record)
+            elif kind == 'result':
+                _, request_id, result, error = message
+                call = self.pending_calls.get(request_id)
+                if call is not None:
+                    call[1], call[2] = result, error
+                    call[0].set()
+            elif kind == 'stopped':
+                break
+        self.stopped.set()
+
+    def read_progress(self):
+        """(download_id, row) for every active download whose table row changed since the last call"""
+        version = self.table.version[0]
+        if version == self.table_version:
+            return []
+        self.table_version = version
+        with self.slots_lock:
+            locations = list(self.slot_of.items())
+        changed = []
+        for download_id, (slot, generation) in locations:
+            row = self.table.read(slot)
+            if row is None or row[1] != generation or row[0] == self.seen_sequence.get(download_id):
+                continue
+            self.seen_sequence[download_id] = row[0]
+            changed.append((download_id, row))
+        return changed
+
+    def read_speeds(self):
+        """(total speed, history) last published by the engine process, without waiting for it"""
+        speeds = self.table.read_speeds()
+        if speeds is not None:
+            self.speeds = speeds
+        return self.speeds
+
+    def request_stop(self):
+        try:
+            self.send(('shutdown',))
+        except (OSError, ValueError):
+            pass
+
+    def join(self, timeout=10.0):
+        """Wait for the engine process to stop and free the shared table"""
+        self.stopped.wait(timeout)
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.connection.close()
+        self.table.release()
+        self.table_memory.close()
+        self.table_memory.unlink()
+
+
+class ProcessDownloadEngine(DownloadQueries):
+    """DownloadEngine running in one or more child processes, with the engine's interface.
+
+    Keeps the segment threads' GIL contention out of the GUI process, and
+    with several workers spreads socket reads and file writes over several
+    interpreters (cores). The parent holds mirror DownloadItems in its own
+    registry, so queries never leave the process. Commands go over a pipe
+    without waiting for an answer (except search_history and
+    requeue_from_history), status events come back over it, and progress of
+    active downloads is read from each worker's shared memory ProgressTable
+    in take_changed_ids() and snapshot(). 'progress' callbacks fire from
+    there.
+
+    New downloads go to the worker with the fewest unfinished downloads.
+    The global concurrency limit and speed limit are budgets split between
+    the workers: concurrency by unfinished downloads, bandwidth by running
+    downloads. They are rebalanced whenever a download is added or changes
+    status; a worker keeps the slots of its running and paused downloads
+    (counted from the moment they leave its queue), only the free slots
+    move.
+
+    With a store_path every engine process writes to that DownloadStore and
+    archives evicted downloads to it; the retention limits are split
+    between the workers.
+    """
+
+    def __init__(self, max_concurrent_downloads=3, max_threads_per_download=3, store_path=None, workers=1,
+                 slots=1024, call_timeout=10.0):
+        self.registry = DownloadRegistry()
+        self.downloads = self.registry.items
+        self.callbacks = {}
+        self.batch_callbacks = {}
+        self.store = None  # every engine process opens its own, see store_path
+        self.store_path = store_path
+        self._max_concurrent_downloads = max_concurrent_downloads
+        self._max_threads_per_download = max_threads_per_download
+        self._speed_limit = 0
+
+        self.changed_ids = set()
+        self.changes_lock = threading.Lock()
+        # Guards the progress fields of the mirrors, see snapshot()
+        self.download_lock = threading.Lock()
+        self.progress_lock = threading.Lock()  # one reader of the shared tables at a time
+        self.profiler = Profiler()
+        self.snapshots = SnapshotTable(DownloadStatus)
+
+        # Scheduler state, per worker
+        self.schedule_lock = threading.RLock()
+        self.worker_of = {}
+        self.backlog = [0] * workers  # queued, downloading and paused downloads
+        self.running = [0] * workers  # downloading
+        self.active = [0] * workers  # downloading and paused, each holding a slot of its worker
+        self.concurrency_shares = [None] * workers
+        self.bandwidth_shares = [None] * workers
+
+        options = {'max_concurrent_downloads': 0,
+                   'max_threads_per_download': max_threads_per_download,
+                   'store_path': store_path}
+        self.workers = [EngineWorker(index, options, slots, self._apply_event, call_timeout)
+                        for index in range(workers)]
+
+    # Engine settings, split between or forwarded to the engine processes
+
+    @property
+    def max_concurrent_downloads(self):
+        return self._max_concurrent_downloads
+
+    @max_concurrent_downloads.setter
+    def max_concurrent_downloads(self, value):
+        self._max_concurrent_downloads = value
+        self._rebalance()
+
+    @property
+    def max_threads_per_download(self):
+        return self._max_threads_per_download
+
+    @max_threads_per_download.setter
+    def max_threads_per_download(self, value):
+        self._max_threads_per_download = value
+        for worker in self.workers:
+            worker.set('max_threads_per_download', value)
+
+    @property
+    def speed_limit(self):
+        """Total download speed limit in bytes per second, 0 for unlimited"""
+        return self._speed_limit
+
+    @speed_limit.setter
+    def speed_limit(self, value):
+        self._speed_limit = value
+        self._rebalance()
+
+    # Callbacks
+
+    def register_callback(self, event_type, callback):
+        """Register callbacks for different events"""
+        self.callbacks.setdefault(event_type, []).append(callback)
+
+    def register_batch_callback(self, event_type, callback):
+        """Register a callback taking a list of downloads, called once for events that happen in bulk"""
+        self.batch_callbacks.setdefault(event_type, []).append(callback)
+
+    def _trigger_callback(self, event_type, download_item):
+        for callback in self.callbacks.get(event_type, ()):
+            callback(download_item)
+        for callback in self.batch_callbacks.get(event_type, ()):
+            callback([download_item])
+
+    def _trigger_batch_callback(self, event_type, download_items):
+        for callback in self.callbacks.get(event_type, ()):
+            for download_item in download_items:
+                callback(download_item)
+        for callback in self.batch_callbacks.get(event_type, ()):
+            callback(download_items)
+
+    # Scheduling
+
+    def _rebalance(self):
+        """Send every worker its share of the concurrency and bandwidth budgets"""
+        with self.schedule_lock:
+            # Running downloads keep their slots, a lower limit takes effect as they finish
+            concurrency = split_budget(self._max_concurrent_downloads, self.backlog, self.active)
+            if self._speed_limit > 0:
+                # Workers about to start their first download get a share right away
+                weights = [running or (1 if backlog else 0) for running, backlog in zip(self.running, self.backlog)]
+                total_weight = sum(weights) or 1
+                bandwidth = [self._speed_limit * weight // total_weight for weight in weights]
+            else:
+                bandwidth = [0] * len(self.workers)
+            for worker in self.workers:
+                index = worker.index
+                if concurrency[index] != self.concurrency_shares[index]:
+                    self.concurrency_shares[index] = concurrency[index]
+                    worker.set('max_concurrent_downloads', concurrency[index])
+                if bandwidth[index] != self.bandwidth_shares[index]:
+                    self.bandwidth_shares[index] = bandwidth[index]
+                    worker.set('speed_limit', bandwidth[index])
+
+    def _account(self, worker, old_status, new_status):
+        """Update a worker's counters for a download moving from old_status to new_status"""
+        unfinished = lambda status: status is not None and status not in FINISHED_STATES
+        self.backlog[worker.index] += unfinished(new_status) - unfinished(old_status)
+        self.running[worker.index] += (new_status == DownloadStatus.DOWNLOADING) - (old_status == DownloadStatus.DOWNLOADING)
+        self.active[worker.index] += (new_status in ACTIVE_STATES) - (old_status in ACTIVE_STATES)
+
+    def _apply_event(self, worker, event_type, record):
+        """Update the mirror of a download from an engine event (called on the worker's reader thread)"""
+        download_id = record['id']
+        if event_type == 'evicted':
+            with self.schedule_lock:
+                self.worker_of.pop(download_id, None)
+            download_item = self.registry.remove(download_id)
+            if download_item is not None:
+                with self.changes_lock:
+                    self.snapshots.mark_removed((download_id,))
+                self._trigger_callback('evicted', download_item)
+            return
+
+        status = DownloadStatus(record['status'])
+        download_item = self.registry.get(download_id)
+        known = download_item is not None
+        if not known:
+            download_item = DownloadItem(url=record['url'], save_path=record['save_path'],
+                                         filename=record['filename'], id=download_id, referrer=record['referrer'],
+                                         status=status)
+            self.registry.add(download_item)
+            with self.schedule_lock:
+                self.worker_of[download_id] = worker
+        with self.download_lock:
+            for field in ('filename', 'total_size', 'downloaded_size', 'error_message', 'start_time', 'finish_time',
+                          'progress', 'speed'):
+                setattr(download_item, field, record[field])
+
+        with self.schedule_lock:
+            old_status = download_item.status if known else None
+            self.registry.set_status(download_item, status)
+            if old_status != status:
+                self._account(worker, old_status, status)
+                self._rebalance()
+        self._mark_changed(download_id)
+        # Downloads added here were already reported when add_download was called, claims only move slots
+        if (event_type != 'added' or not known) and event_type != CLAIMED_EVENT:
+            self._trigger_callback(event_type, download_item)
+
+    # Engine interface
+
+    def add_download(self, url, save_path, filename=None, referrer=None, download_id=None) -> str:
+        """Add a new download, queued in the least loaded engine process"""
+        download_item = DownloadItem(url=url, save_path=save_path, filename=filename, referrer=referrer,
+                                     id=download_id or '')
+        self.registry.add(download_item)
+        self._mark_added([download_item])
+        with self.schedule_lock:
+            worker = min(self.workers, key=lambda worker: self.backlog[worker.index])
+            self.worker_of[download_item.id] = worker
+            self._account(worker, None, DownloadStatus.QUEUED)
+            # The worker's share covers the new download before it arrives
+            self._rebalance()
+            worker.cast('add_download', url, save_path, filename, referrer, download_id=download_item.id)
+        self._trigger_callback('added', download_item)
+        return download_item.id
+
+    def add_downloads(self, items, save_path=None):
+        """Add many downloads at once, spread over the engine processes (see DownloadEngine.add_downloads)"""
+        with self.registry.lock:
+            download_items, download_ids = prepare_batch(self.registry, items, save_path)
+            for download_item in download_items:
+                self.registry.add(download_item)
+        self._mark_added(download_items)
+        with self.schedule_lock:
+            batches = {}
+            for download_item in download_items:
+                worker = min(self.workers, key=lambda worker: self.backlog[worker.index])
+                self.worker_of[download_item.id] = worker
+                self._account(worker, None, DownloadStatus.QUEUED)
+                batches.setdefault(worker, []).append({
+                    'url': download_item.url, 'save_path': download_item.save_path,
+                    'filename': download_item.filename, 'referrer': download_item.referrer, 'id': download_item.id,
+                    'priority': download_item.priority})
+            self._rebalance()
+            # Filenames are already unique, one message per engine process
+            for worker, worker_items in batches.items():
+                worker.cast('add_downloads', worker_items)
+        if download_items:
+            self._trigger_batch_callback('added', download_items)
+        return download_ids
+
+    def _worker_call(self, method, download_id, *args):
+        worker = self.worker_of.get(download_id)
+        if worker is None:
+            return False
+        worker.cast(method, download_id, *args)
+        return True
+
+    def pause_download(self, download_id):
+        """Pause a download"""
+        return self._worker_call('pause_download', download_id)
+
+    def resume_download(self, download_id):
+        """Resume a paused download"""
+        return self._worker_call('resume_download', download_id)
+
+    def cancel_download(self, download_id):
+        """Cancel a download"""
+        return self._worker_call('cancel_download', download_id)
+
+    def set_priority(self, download_id, priority):
+        """Change the priority of a download, it only orders the queue of its own engine process"""
+        download_item = self.downloads.get(download_id)
+        if download_item is None or download_item.status in FINISHED_STATES:
+            return False
+        download_item.priority = priority
+        self._mark_changed(download_id)
+        self._trigger_callback('priority', download_item)
+        return self._worker_call('set_priority', download_id, priority)
+
+    def restore_from_store(self):
+        """Queue the downloads that were queued or active when the store was last written"""
+        if not self.store_path:
+            return 0
+        from store import DownloadStore
+        store = DownloadStore(self.store_path)
+        try:
+            records = [record for record in store.load_pending() if record['id'] not in self.registry]
+        finally:
+            store.close()
+        for record in records:
+            self.add_download(record['url'], record['save_path'], record['filename'], record['referrer'],
+                              download_id=record['id'])
+        return len(records)
+
+    def set_retention_policy(self, retention_policy, history=None):
+        """Evict finished downloads according to retention_policy, archived to the engine processes' store.
+
+        history is ignored, it can't be shared with the engine processes.
+        """
+        workers = len(self.workers)
+        share = RetentionPolicy(
+            max_items=None if retention_policy.max_items is None else -(-retention_policy.max_items // workers),
+            max_age=retention_policy.max_age,
+            max_memory=None if retention_policy.max_memory is None else retention_policy.max_memory // workers)
+        for worker in self.workers:
+            worker.cast('set_retention_policy', share)
+
+    def search_history(self, text=None, status=None, offset=0, limit=100):
+        """Search archived downloads, newest first"""
+        return self.workers[0].call('search_history', text, getattr(status, 'value', status), offset, limit)
+
+    def get_history_record(self, download_id):
+        """Archived record of a download, None if it isn't in the history"""
+        return self.workers[0].call('get_history_record', download_id)
+
+    def requeue_from_history(self, download_id, save_path=None):
+        """Add an archived download to the queue again, returns the new download ID"""
+        record = self.get_history_record(download_id)
+        if record is None:
+            return None
+        return self.add_download(record['url'], save_path or record['save_path'],
+                                 record['filename'], record['referrer'])
+
+    def metrics_snapshot(self):
+        """Metrics of all engine processes added up, see metrics.render_metrics"""
+        return merge_snapshots([worker.call('metrics_snapshot') for worker in self.workers])
+
+    def total_speed(self):
+        """Smoothed speed of all downloads together in bytes per second, read from the shared tables"""
+        return sum(worker.read_speeds()[0] for worker in self.workers)
+
+    def speed_history(self, download_id=None):
+        """Speed per second of a running download, or of all downloads with None, oldest first.
+
+        The total history is read from the shared tables; a download's history
+        is asked from its engine process, which waits for the answer.
+        """
+        if download_id is not None:
+            worker = self.worker_of.get(download_id)
+            return worker.call('speed_history', download_id) if worker is not None else []
+        # The engine processes sample at their own pace; line their histories up at the newest sample
+        histories = [worker.read_speeds()[1] for worker in self.workers]
+        length = max(map(len, histories), default=0)
+        total = [0.0] * length
+        for history in histories:
+            for i, speed in enumerate(history, length - len(history)):
+                total[i] += speed
+        return total
+
+    def start_profile(self, duration, mode='sample', targets=()):
+        """Profile this process and every engine process for duration seconds (see DownloadEngine.start_profile).
+        
+        targets are profiled in this process only.
+        """
+        if not self.profiler.start(duration, mode, targets):
+            return False
+        for worker in self.workers:
+            worker.cast('start_profile', duration, mode)
+        return True
+
+    def profile_stacks(self, timeout=None):
+        """Collapsed stacks of the last profile of all processes, each under its own root"""
+        stacks = self.profiler.stacks(timeout)
+        if stacks is None:
+            return None
+        stacks = prefix_stacks('main process', stacks)
+        for worker in self.workers:
+            # The engine processes started at about the same time, they are done or about to be
+            worker_stacks = worker.call('profile_stacks', worker.call_timeout / 2)
+            if worker_stacks:
+                stacks.update(prefix_stacks(f'engine process {worker.index}', worker_stacks))
+        return stacks
+
+    def profile(self, duration, mode='sample', targets=()):
+        """Profile for duration seconds and return the collapsed stacks, None if a profile is running already"""
+        if not self.start_profile(duration, mode, targets):
+            return None
+        return self.profile_stacks()
+
+    def set_tracing(self, enabled):
+        """Start or stop recording download spans in all engine processes"""
+        for worker in self.workers:
+            worker.cast('set_tracing', enabled)
+
+    def trace_events(self):
+        """Recorded download spans of all engine processes, one trace process each"""
+        return [event for worker in self.workers for event in worker.call('trace_events')]
+
+    def export_trace(self, path):
+        """Write the recorded spans as a Chrome trace file, returns the number of events"""
+        return write_trace(path, self.trace_events())
+
+    def _mark_changed(self, download_id):
+        with self.changes_lock:
+            self.changed_ids.add(download_id)
+            self.snapshots.mark_changed((download_id,))
+
+    def _mark_added(self, download_items):
+        with self.changes_lock:
+            self.snapshots.mark_changed([download_item.id for download_item in download_items])
+
+    def _read_progress(self):
+        """Copy the progress of active downloads from the shared tables to their mirrors"""
+        with self.progress_lock:
+            updates = [(download_id, row) for worker in self.workers for download_id, row in worker.read_progress()]
+        for download_id, row in updates:
+            download_item = self.downloads.get(download_id)
+            if download_item is None or download_item.status in FINISHED_STATES:
+                continue
+            with self.download_lock:
+                _, _, download_item.downloaded_size, download_item.total_size, download_item.speed, \
+                    download_item.progress = row
+            self._mark_changed(download_id)
+            self._trigger_callback('progress', download_item)
+
+    def take_changed_ids(self):
+        """Ids of the downloads that changed since the last call, with progress read from the shared tables"""
+        self._read_progress()
+        with self.changes_lock:
+            changed, self.changed_ids = self.changed_ids, set()
+        return changed
+
+    def snapshot(self, since_version=None):
+        """Progress of all downloads as columns, with progress read from the shared tables first"""
+        self._read_progress()
+        return super().snapshot(since_version)
+
+    def shutdown(self, timeout=10.0):
+        """Stop the engine processes and free the shared tables"""
+        for worker in self.workers:
+            worker.request_stop()
+        for worker in self.workers:
+            worker.join(timeout)
@@ -0,0 +1,55 @@
+import threading
+
+from PyQt5.QtCore import QObject, Qt, pyqtSignal
+
+
+class EngineEventBridge(QObject):
+    """Delivers download engine callbacks in the Qt (GUI) thread.
+
+    The engine calls back on its worker threads, where widgets must not be
+    touched. The bridge only appends the event to a list there and, for the
+    first event of a batch, posts a queued signal. When the event loop gets
+    to it, all events collected so far are handed out at once: runs of the
+    same event type go to the handler as one list, in the order they
+    happened. Worker threads never wait for the GUI, and the GUI thread only
+    holds the lock long enough to swap the list.
+    """
+
+    events_ready = pyqtSignal()
+
+    def __init__(self, download_engine, parent=None):
+        super().__init__(parent)
+        self.download_engine = download_engine
+        self.handlers = {}
+        self.pending = []
+        self.lock = threading.Lock()
+        self.events_ready.connect(self.dispatch, Qt.QueuedConnection)
+
+    def register_callback(self, event_type, handler):
+        """Call handler(download_items) in the GUI thread for engine events of event_type"""
+        if event_type not in self.handlers:
+            self.handlers[event_type] = []
+            self.download_engine.register_batch_callback(
+                event_type, lambda download_items: self.post(event_type, download_items))
+        self.handlers[event_type].append(handler)
+
+    def post(self, event_type, download_items):
+        """Queue an event of one or more downloads (called on engine threads)"""
+        with self.lock:
+            self.pending.append((event_type, download_items))
+            first = len(self.pending) == 1
+        if first:
+            self.events_ready.emit()
+
+    def dispatch(self):
+        """Hand the collected events to their handlers (runs in the GUI thread)"""
+        with self.lock:
+            events, self.pending = self.pending, []
+        start = 0
+        for i in range(1, len(events) + 1):
+            if i == len(events) or events[i][0] != events[start][0]:
+                event_type = events[start][0]
+                download_items = [download_item for _, batch in events[start:i] for download_item in batch]
+                for handler in self.handlers.get(event_type, ()):
+                    handler(download_items)
+                start = i
@@ -1,137 +1,249 @@
 import sys
 import os
-import time
 import threading
-import webbrowser
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
-                             QPushButton, QLabel, QLineEdit, QFileDialog, QProgressBar,
-                             QTableWidget, QTableWidgetItem, QHeaderView, QMenu, QAction,
-                             QMessageBox, QSystemTrayIcon, QStyle, QTabWidget, QComboBox,
-                             QSpinBox, QCheckBox, QGroupBox, QFormLayout, QSplitter)
-from PyQt5.QtCore import Qt, QTimer, pyqtSignal, QUrl, QThread, QSize
-from PyQt5.QtGui import QIcon, QClipboard, QDesktopServices
+                             QPushButton, QLabel, QLineEdit, QFileDialog,
+                             QMessageBox, QTabWidget, QSpinBox, QCheckBox, QGroupBox, QFormLayout,
+                             QListWidget, QListWidgetItem, QComboBox, QTableView, QHeaderView,
+                             QAbstractItemView, QDialog, QDialogButtonBox)
+from PyQt5.QtCore import Qt, QObject, QTimer, QPointF, pyqtSignal
+from PyQt5.QtGui import QPainter, QPolygonF, QPalette
 
 from download_engine import DownloadEngine, DownloadStatus
-from browser_integration import BrowserIntegration
+from event_bridge import EngineEventBridge
+from download_model import (DownloadTableModel, ProgressBarDelegate, DownloadActionsDelegate,
+                            COLUMN_NAME, COLUMN_PROGRESS, COLUMN_ACTIONS)
+from history import RetentionPolicy
+from speed import HISTORY_SECONDS
+from profiling import MAX_PROFILE_DURATION, write_collapsed
+from utils import extract_urls, format_speed
 
 
-class ClipboardMonitor(QThread):
-    url_detected = pyqtSignal(str)
+class ClipboardMonitor(QObject):
+    """Reports URLs copied to the clipboard.
     
-    def __init__(self, parent=None):
+    Listens to QClipboard.dataChanged in the GUI thread instead of polling.
+    Changes are debounced, since applications often set the clipboard
+    several times in a row, and every URL in the copied text is reported
+    in one signal.
+    """
+    urls_detected = pyqtSignal(list)
+    
+    def __init__(self, parent=None, debounce_ms=300):
         super().__init__(parent)
         self.clipboard = QApplication.clipboard()
         self.last_text = self.clipboard.text()
-        self.running = True
-    
-    def run(self):
-        while self.running:
-            current_text = self.clipboard.text()
-            if current_text != self.last_text:
-                self.last_text = current_text
-                # Check if text is a URL
-                if current_text.startswith(('http://', 'https://', 'ftp://')):
-                    self.url_detected.emit(current_text)
-            time.sleep(0.5)
+        self.debounce_timer = QTimer(self)
+        self.debounce_timer.setSingleShot(True)
+        self.debounce_timer.setInterval(debounce_ms)
+        self.debounce_timer.timeout.connect(self.check_clipboard)
+    
+    def start(self):
+        self.clipboard.dataChanged.connect(self.debounce_timer.start)
     
     def stop(self):
-        self.running = False
+        self.clipboard.dataChanged.disconnect(self.debounce_timer.start)
+        self.debounce_timer.stop()
+    
+    def check_clipboard(self):
+        current_text = self.clipboard.text()
+        if current_text == self.last_text:
+            return
+        self.last_text = current_text
+        urls = extract_urls(current_text)
+        if urls:
+            self.urls_detected.emit(urls)
 
 
-class DownloadItemWidget(QWidget):
-    def __init__(self, download_item, parent=None):
-        super().__init__(parent)
-        self.download_item = download_item
-        self.init_ui()
+class BatchAddDialog(QDialog):
+    """Lets the user pick which of several detected URLs to download"""
     
-    def init_ui(self):
+    def __init__(self, urls, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("URLs Detected")
         layout = QVBoxLayout(self)
-        
-        # Top row: Filename and status
-        top_layout = QHBoxLayout()
-        self.filename_label = QLabel(self.download_item.filename)
-        self.filename_label.setStyleSheet("font-weight: bold;")
-        self.status_label = QLabel(self.download_item.status.value)
-        
-        top_layout.addWidget(self.filename_label)
-        top_layout.addStretch()
-        top_layout.addWidget(self.status_label)
-        
-        # Middle row: Progress bar
-        self.progress_bar = QProgressBar()
-        self.progress_bar.setRange(0, 100)
-        self.progress_bar.setValue(int(self.download_item.progress))
-        
-        # Bottom row: Size, speed, and buttons
-        bottom_layout = QHBoxLayout()
-        self.size_label = QLabel(f"0 MB / {self.format_size(self.download_item.total_size)}")
-        self.speed_label = QLabel("0 KB/s")
-        
-        self.pause_resume_btn = QPushButton("Pause")
-        self.cancel_btn = QPushButton("Cancel")
-        
-        bottom_layout.addWidget(self.size_label)
-        bottom_layout.addWidget(self.speed_label)
-        bottom_layout.addStretch()
-        bottom_layout.addWidget(self.pause_resume_btn)
-        bottom_layout.addWidget(self.cancel_btn)
-        
-        # Add all rows to main layout
-        layout.addLayout(top_layout)
-        layout.addWidget(self.progress_bar)
-        layout.addLayout(bottom_layout)
-        
-        # Set fixed height for the widget
-        self.setFixedHeight(100)
-    
-    def update_info(self):
-        self.filename_label.setText(self.download_item.filename)
-        self.status_label.setText(self.download_item.status.value)
-        self.progress_bar.setValue(int(self.download_item.progress))
-        self.size_label.setText(
-            f"{self.format_size(self.download_item.downloaded_size)} / {self.format_size(self.download_item.total_size)}"
-        )
-        self.speed_label.setText(self.format_speed(self.download_item.speed))
-        
-        # Update button text based on status
-        if self.download_item.status == DownloadStatus.PAUSED:
-            self.pause_resume_btn.setText("Resume")
-        elif self.download_item.status == DownloadStatus.DOWNLOADING:
-            self.pause_resume_btn.setText("Pause")
-        
-        # Disable buttons if completed or error
-        if self.download_item.status in [DownloadStatus.COMPLETED, DownloadStatus.ERROR, DownloadStatus.CANCELED]:
-            self.pause_resume_btn.setEnabled(False)
-            self.cancel_btn.setEnabled(False)
-    
-    @staticmethod
-    def format_size(size_bytes):
-        if size_bytes == 0:
-            return "0 B"
-        size_names = ["B", "KB", "MB", "GB", "TB"]
-        i = 0
-        while size_bytes >= 1024 and i < len(size_names) - 1:
-            size_bytes /= 1024
-            i += 1
-        return f"{size_bytes:.2f} {size_names[i]}"
-    
-    @staticmethod
-    def format_speed(speed_bytes):
-        return f"{DownloadItemWidget.format_size(speed_bytes)}/s"
+        layout.addWidget(QLabel(f"Download {len(urls)} URL(s) from the clipboard?"))
+        
+        self.url_list = QListWidget()
+        for url in urls:
+            item = QListWidgetItem(url)
+            item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+            item.setCheckState(Qt.Checked)
+            self.url_list.addItem(item)
+        layout.addWidget(self.url_list)
+        
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        buttons.button(QDialogButtonBox.Ok).setText("Download")
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        layout.addWidget(buttons)
+    
+    def selected_urls(self):
+        return [self.url_list.item(row).text() for row in range(self.url_list.count())
+                if self.url_list.item(row).checkState() == Qt.Checked]
+
+
+class HostFilterComboBox(QComboBox):
+    """Host filter that lists the hosts currently known to the engine when opened"""
+    
+    def __init__(self, download_engine, parent=None):
+        super().__init__(parent)
+        self.download_engine = download_engine
+        self.addItem("All hosts", None)
+    
+    def showPopup(self):
+        current = self.currentData()
+        self.blockSignals(True)
+        self.clear()
+        self.addItem("All hosts", None)
+        for host in sorted(self.download_engine.get_host_counts()):
+            self.addItem(host, host)
+        self.setCurrentIndex(max(self.findData(current), 0))
+        self.blockSignals(False)
+        super().showPopup()
+
+
+class SpeedGraph(QWidget):
+    """Line graph of the total download speed over the last HISTORY_SECONDS seconds"""
+    
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.speeds = []
+        self.speed = 0.0
+        self.setFixedHeight(60)
+    
+    def set_speeds(self, speeds, speed):
+        """Show the per-second speeds (oldest first) and the current smoothed speed"""
+        self.speeds = speeds
+        self.speed = speed
+        self.update()
+    
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        palette = self.palette()
+        rect = self.rect().adjusted(0, 0, -1, -1)
+        painter.fillRect(rect, palette.color(QPalette.Base))
+        painter.setPen(palette.color(QPalette.Mid))
+        painter.drawRect(rect)
+        
+        peak = max(self.speeds, default=0.0)
+        if len(self.speeds) > 1 and peak > 0:
+            # Newest sample at the right edge, one step per second
+            step = rect.width() / (HISTORY_SECONDS - 1)
+            left = rect.right() - (len(self.speeds) - 1) * step
+            # Headroom above the peak keeps the line clear of the label
+            height = (rect.height() - 4) / 1.25
+            points = QPolygonF([QPointF(left + i * step, rect.bottom() - 2 - speed / peak * height)
+                                for i, speed in enumerate(self.speeds)])
+            painter.setRenderHint(QPainter.Antialiasing)
+            painter.setPen(palette.color(QPalette.Highlight))
+            painter.drawPolyline(points)
+        
+        painter.setPen(palette.color(QPalette.Text))
+        painter.drawText(rect.adjusted(6, 4, -6, -4), Qt.AlignLeft | Qt.AlignTop,
+                         f"{format_speed(self.speed)} (peak {format_speed(peak)})")
 
 
 class DownloadManagerGUI(QMainWindow):
-    def __init__(self):
+    # Requests forwarded by other processes, delivered in the GUI thread
+    instance_request = pyqtSignal(object)
+    # Status bar messages from other threads
+    status_message = pyqtSignal(str)
+    # Result message of a profile, sent from its writer thread
+    profile_finished = pyqtSignal(str)
+    # (search number, records) of a history page, sent from its search thread
+    history_loaded = pyqtSignal(int, list)
+    
+    def __init__(self, engine_process=False):
         super().__init__()
-        self.download_engine = DownloadEngine(max_concurrent_downloads=3, max_threads_per_download=5)
-        self.download_widgets = {}
+        if engine_process:
+            # Downloads run in a child process, away from the GUI's interpreter lock
+            from engine_process import ProcessDownloadEngine
+            from store import DEFAULT_STORE_PATH
+            self.download_engine = ProcessDownloadEngine(max_concurrent_downloads=3, max_threads_per_download=5,
+                                                         store_path=DEFAULT_STORE_PATH)
+        else:
+            self.download_engine = DownloadEngine(max_concurrent_downloads=3, max_threads_per_download=5)
+        # Opened with the secondary subsystems; engine processes open their own
+        self.store = None
+        self.local_store = not engine_process
+        self.retention_policy = RetentionPolicy(max_items=200)
+        self.download_engine.set_retention_policy(self.retention_policy, self.store)
+        self.download_model = DownloadTableModel(self.download_engine, self)
+        self.engine_events = EngineEventBridge(self.download_engine, self)
         self.clipboard_monitor = None
-        self.browser_integration = BrowserIntegration(self)
+        self.clipboard_dialog = None
+        self._browser_integration = None  # created on first use
+        self.instance_server = None
+        # The history is searched in the background; results of older searches are dropped
+        self.history_search_number = 0
+        self.history_loading = False
         self.init_ui()
         self.register_callbacks()
         self.update_timer = QTimer()
-        self.update_timer.timeout.connect(self.update_download_items)
+        # Looked up on every tick, so a 'functions' profile can time it
+        self.update_timer.timeout.connect(lambda: self.update_download_items())
         self.update_timer.start(500)  # Update every 500ms
+        self.speed_timer = QTimer()
+        self.speed_timer.timeout.connect(self.update_speed_graph)
+        self.speed_timer.start(1000)  # the engine samples speeds once a second
+        
+        # Secondary subsystems start once the window is on screen
+        QTimer.singleShot(0, self.init_secondary_subsystems)
+    
+    @property
+    def browser_integration(self):
+        """Browser integration, imported and created on first use"""
+        if self._browser_integration is None:
+            from browser_integration import BrowserIntegration
+            self._browser_integration = BrowserIntegration(self)
+        return self._browser_integration
+    
+    def init_secondary_subsystems(self):
+        """Start subsystems that aren't needed to show the window"""
+        if self.local_store:
+            from store import DownloadStore  # sqlite3 is imported on first use
+            self.store = DownloadStore()
+            self.download_engine.set_store(self.store)
+            self.download_engine.set_retention_policy(self.retention_policy, self.store)
+        # Only queued and interrupted downloads are loaded, the history is paged on demand
+        restored = self.download_engine.restore_from_store()
+        if restored:
+            self.statusBar().showMessage(f"Restored {restored} downloads")
+        self.start_instance_server()
+        self.start_clipboard_monitor()
+    
+    def start_instance_server(self):
+        """Accept requests from the native messaging shim and later launches"""
+        from instance import InstanceServer
+        self.instance_request.connect(self.on_instance_request)
+        self.instance_server = InstanceServer(self._forward_instance_request)
+        if not self.instance_server.start():
+            self.instance_server = None
+    
+    def _forward_instance_request(self, message):
+        """Called on the instance server thread, checks the request and hands it to the GUI thread"""
+        from instance import check_download_request
+        if not (isinstance(message, dict) and message.get('action') in ('show', 'ping')):
+            try:
+                check_download_request(message)
+            except ValueError as e:
+                return {'status': 'error', 'message': str(e)}
+        self.instance_request.emit(message)
+        return {'status': 'success'}
+    
+    def on_instance_request(self, message):
+        """Handle a request forwarded from another process"""
+        try:
+            if message.get('action') == 'show':
+                self.showNormal()
+                self.raise_()
+                self.activateWindow()
+                return
+            from instance import handle_download_request
+            handle_download_request(message, self.add_download_from_browser, self.add_downloads_from_browser)
+        except Exception as e:
+            self.statusBar().showMessage(f"Error handling forwarded request: {str(e)}")
     
     def init_ui(self):
         self.setWindowTitle("PyDownload Manager")
@@ -166,18 +278,51 @@ class DownloadManagerGUI(QMainWindow):
         
         downloads_layout.addLayout(url_layout)
         
-        # Downloads area
-        self.downloads_container = QWidget()
-        self.downloads_layout = QVBoxLayout(self.downloads_container)
-        self.downloads_layout.setAlignment(Qt.AlignTop)
-        
-        # Create a scroll area for downloads
-        scroll_area = QWidget()
-        scroll_layout = QVBoxLayout(scroll_area)
-        scroll_layout.addWidget(self.downloads_container)
-        scroll_layout.addStretch()
-        
-        downloads_layout.addWidget(scroll_area)
+        # Filters
+        filter_layout = QHBoxLayout()
+        self.status_filter_combo = QComboBox()
+        self.status_filter_combo.addItem("All", None)
+        for status in DownloadStatus:
+            self.status_filter_combo.addItem(status.value.capitalize(), status)
+        self.status_filter_combo.currentIndexChanged.connect(self.update_download_filter)
+        self.host_filter_combo = HostFilterComboBox(self.download_engine)
+        self.host_filter_combo.currentIndexChanged.connect(self.update_download_filter)
+        
+        filter_layout.addWidget(QLabel("Status:"))
+        filter_layout.addWidget(self.status_filter_combo)
+        filter_layout.addWidget(QLabel("Host:"))
+        filter_layout.addWidget(self.host_filter_combo)
+        filter_layout.addStretch()
+        
+        downloads_layout.addLayout(filter_layout)
+        
+        # Downloads table, only the visible rows are painted
+        self.downloads_view = QTableView()
+        self.downloads_view.setModel(self.download_model)
+        self.downloads_view.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.downloads_view.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.downloads_view.setWordWrap(False)
+        self.downloads_view.verticalHeader().hide()
+        self.downloads_view.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.downloads_view.verticalHeader().setDefaultSectionSize(30)
+        header = self.downloads_view.horizontalHeader()
+        header.setSectionResizeMode(COLUMN_NAME, QHeaderView.Stretch)
+        header.setSortIndicator(-1, Qt.DescendingOrder)
+        self.downloads_view.setSortingEnabled(True)
+        
+        self.progress_delegate = ProgressBarDelegate(self.downloads_view)
+        self.actions_delegate = DownloadActionsDelegate(self.downloads_view)
+        self.actions_delegate.pause_resume_clicked.connect(self.toggle_pause_resume)
+        self.actions_delegate.cancel_clicked.connect(self.cancel_download)
+        self.downloads_view.setItemDelegateForColumn(COLUMN_PROGRESS, self.progress_delegate)
+        self.downloads_view.setItemDelegateForColumn(COLUMN_ACTIONS, self.actions_delegate)
+        header.resizeSection(COLUMN_PROGRESS, 120)
+        header.resizeSection(COLUMN_ACTIONS, 2 * DownloadActionsDelegate.BUTTON_WIDTH + 8)
+        
+        downloads_layout.addWidget(self.downloads_view)
+        
+        self.speed_graph = SpeedGraph()
+        downloads_layout.addWidget(self.speed_graph)
         
         # Settings tab
         settings_tab = QWidget()
@@ -203,8 +348,15 @@ class DownloadManagerGUI(QMainWindow):
         self.clipboard_monitor_check.setChecked(True)
         self.clipboard_monitor_check.stateChanged.connect(self.toggle_clipboard_monitor)
         
+        self.keep_finished_spin = QSpinBox()
+        self.keep_finished_spin.setRange(0, 100000)
+        self.keep_finished_spin.setValue(self.retention_policy.max_items)
+        self.keep_finished_spin.setToolTip("Older finished downloads move to the History tab")
+        self.keep_finished_spin.valueChanged.connect(self.update_keep_finished)
+        
         general_layout.addRow("Default save path:", save_path_layout)
         general_layout.addRow("Max concurrent downloads:", self.max_downloads_spin)
+        general_layout.addRow("Finished downloads to keep:", self.keep_finished_spin)
         general_layout.addRow("", self.clipboard_monitor_check)
         
         # Connection settings group
@@ -223,13 +375,52 @@ class DownloadManagerGUI(QMainWindow):
         self.speed_limit_spin.setSuffix(" KB/s")
         self.speed_limit_spin.setEnabled(False)
         self.speed_limit_check.stateChanged.connect(self.toggle_speed_limit)
+        self.speed_limit_spin.valueChanged.connect(self.update_speed_limit)
         
         connection_layout.addRow("Threads per download:", self.threads_per_download_spin)
         connection_layout.addRow("Speed limit:", self.speed_limit_check)
         connection_layout.addRow("", self.speed_limit_spin)
         
+        # Diagnostics group
+        diagnostics_group = QGroupBox("Diagnostics")
+        diagnostics_layout = QVBoxLayout(diagnostics_group)
+        
+        self.tracing_check = QCheckBox("Record download timeline")
+        self.tracing_check.setToolTip("Probe, connect, first byte, transfer, stalls and retries of every segment")
+        self.tracing_check.stateChanged.connect(self.toggle_tracing)
+        export_trace_btn = QPushButton("Export Timeline...")
+        export_trace_btn.clicked.connect(self.export_trace)
+        tracing_layout = QHBoxLayout()
+        tracing_layout.addWidget(self.tracing_check)
+        tracing_layout.addWidget(export_trace_btn)
+        tracing_layout.addStretch()
+        
+        self.profile_mode_combo = QComboBox()
+        self.profile_mode_combo.addItem("CPU samples", 'sample')
+        self.profile_mode_combo.addItem("Hot functions", 'functions')
+        self.profile_mode_combo.setToolTip("CPU samples: CPU time of every thread by stack\n"
+                                           "Hot functions: time spent in the download threads, callbacks and "
+                                           "table updates")
+        self.profile_seconds_spin = QSpinBox()
+        self.profile_seconds_spin.setRange(1, MAX_PROFILE_DURATION)
+        self.profile_seconds_spin.setValue(30)
+        self.profile_seconds_spin.setSuffix(" s")
+        self.profile_btn = QPushButton("Profile...")
+        self.profile_btn.clicked.connect(self.start_profile)
+        self.profile_finished.connect(self.on_profile_finished)
+        profile_layout = QHBoxLayout()
+        profile_layout.addWidget(QLabel("Profile:"))
+        profile_layout.addWidget(self.profile_mode_combo)
+        profile_layout.addWidget(self.profile_seconds_spin)
+        profile_layout.addWidget(self.profile_btn)
+        profile_layout.addStretch()
+        
+        diagnostics_layout.addLayout(tracing_layout)
+        diagnostics_layout.addLayout(profile_layout)
+        
         settings_layout.addWidget(general_group)
         settings_layout.addWidget(connection_group)
+        settings_layout.addWidget(diagnostics_group)
         settings_layout.addStretch()
         
         # Browser Integration tab
@@ -291,27 +482,54 @@ class DownloadManagerGUI(QMainWindow):
         browser_layout.addWidget(help_group)
         browser_layout.addStretch()
         
+        # History tab
+        history_tab = QWidget()
+        history_layout = QVBoxLayout(history_tab)
+        
+        history_search_layout = QHBoxLayout()
+        self.history_search_input = QLineEdit()
+        self.history_search_input.setPlaceholderText("Search finished downloads by URL or filename")
+        self.history_search_input.returnPressed.connect(self.search_history)
+        history_search_btn = QPushButton("Search")
+        history_search_btn.clicked.connect(self.search_history)
+        history_search_layout.addWidget(self.history_search_input)
+        history_search_layout.addWidget(history_search_btn)
+        
+        self.history_list = QListWidget()
+        history_buttons_layout = QHBoxLayout()
+        history_more_btn = QPushButton("Load More")
+        history_more_btn.clicked.connect(self.load_more_history)
+        history_requeue_btn = QPushButton("Download Again")
+        history_requeue_btn.clicked.connect(self.requeue_from_history)
+        history_buttons_layout.addWidget(history_more_btn)
+        history_buttons_layout.addStretch()
+        history_buttons_layout.addWidget(history_requeue_btn)
+        
+        history_layout.addLayout(history_search_layout)
+        history_layout.addWidget(self.history_list)
+        history_layout.addLayout(history_buttons_layout)
+        
         # Add tabs to tab widget
         tab_widget.addTab(downloads_tab, "Downloads")
+        tab_widget.addTab(history_tab, "History")
         tab_widget.addTab(settings_tab, "Settings")
         tab_widget.addTab(browser_tab, "Browser Integration")
         
         # Status bar
         self.statusBar().showMessage("Ready")
-        
-        # Start clipboard monitor
-        self.start_clipboard_monitor()
+        self.status_message.connect(self.statusBar().showMessage)
+        self.history_loaded.connect(self.on_history_loaded)
     
     def register_callbacks(self):
-        """Register callbacks with the download engine"""
-        self.download_engine.register_callback('added', self.on_download_added)
-        self.download_engine.register_callback('started', self.on_download_started)
-        self.download_engine.register_callback('progress', self.on_download_progress)
-        self.download_engine.register_callback('paused', self.on_download_paused)
-        self.download_engine.register_callback('resumed', self.on_download_resumed)
-        self.download_engine.register_callback('completed', self.on_download_completed)
-        self.download_engine.register_callback('error', self.on_download_error)
-        self.download_engine.register_callback('canceled', self.on_download_canceled)
+        """Register callbacks with the download engine, delivered in the GUI thread in batches"""
+        self.engine_events.register_callback('added', self.on_downloads_added)
+        self.engine_events.register_callback('started', self.on_downloads_changed)
+        self.engine_events.register_callback('paused', self.on_downloads_changed)
+        self.engine_events.register_callback('resumed', self.on_downloads_changed)
+        self.engine_events.register_callback('completed', self.on_downloads_completed)
+        self.engine_events.register_callback('error', self.on_downloads_error)
+        self.engine_events.register_callback('canceled', self.on_downloads_changed)
+        self.engine_events.register_callback('evicted', self.on_downloads_evicted)
     
     def start_download(self):
         """Start a new download"""
@@ -332,53 +550,92 @@ class DownloadManagerGUI(QMainWindow):
         self.url_input.clear()
         self.statusBar().showMessage(f"Download added: {url}")
     
-    def on_download_added(self, download_item):
-        """Callback when a download is added"""
-        # Create a widget for this download
-        widget = DownloadItemWidget(download_item)
-        widget.pause_resume_btn.clicked.connect(lambda: self.toggle_pause_resume(download_item.id))
-        widget.cancel_btn.clicked.connect(lambda: self.cancel_download(download_item.id))
-        
-        # Add to layout and store reference
-        self.downloads_layout.insertWidget(0, widget)
-        self.download_widgets[download_item.id] = widget
-    
-    def on_download_started(self, download_item):
-        """Callback when a download is started"""
-        if download_item.id in self.download_widgets:
-            self.download_widgets[download_item.id].update_info()
-    
-    def on_download_progress(self, download_item):
-        """Callback when download progress is updated"""
-        if download_item.id in self.download_widgets:
-            self.download_widgets[download_item.id].update_info()
-    
-    def on_download_paused(self, download_item):
-        """Callback when a download is paused"""
-        if download_item.id in self.download_widgets:
-            self.download_widgets[download_item.id].update_info()
-    
-    def on_download_resumed(self, download_item):
-        """Callback when a download is resumed"""
-        if download_item.id in self.download_widgets:
-            self.download_widgets[download_item.id].update_info()
-    
-    def on_download_completed(self, download_item):
-        """Callback when a download is completed"""
-        if download_item.id in self.download_widgets:
-            self.download_widgets[download_item.id].update_info()
-            self.statusBar().showMessage(f"Download completed: {download_item.filename}")
-    
-    def on_download_error(self, download_item):
-        """Callback when a download encounters an error"""
-        if download_item.id in self.download_widgets:
-            self.download_widgets[download_item.id].update_info()
-            self.statusBar().showMessage(f"Download error: {download_item.error_message}")
-    
-    def on_download_canceled(self, download_item):
-        """Callback when a download is canceled"""
-        if download_item.id in self.download_widgets:
-            self.download_widgets[download_item.id].update_info()
+    def on_downloads_added(self, download_items):
+        """Callback when downloads are added"""
+        self.download_model.add_items(download_items)
+    
+    def on_downloads_changed(self, download_items):
+        """Callback when downloads are started, paused, resumed or canceled"""
+        for download_item in download_items:
+            self.download_model.update_item(download_item)
+    
+    def on_downloads_completed(self, download_items):
+        """Callback when downloads are completed"""
+        self.on_downloads_changed(download_items)
+        self.statusBar().showMessage(f"Download completed: {download_items[-1].filename}")
+    
+    def on_downloads_error(self, download_items):
+        """Callback when downloads encounter an error"""
+        self.on_downloads_changed(download_items)
+        self.statusBar().showMessage(f"Download error: {download_items[-1].error_message}")
+    
+    def on_downloads_evicted(self, download_items):
+        """Callback when finished downloads were moved to the history"""
+        self.download_model.remove_items([download_item.id for download_item in download_items])
+    
+    def update_download_filter(self):
+        """Show only the downloads matching the status and host filters"""
+        self.download_model.set_filter(self.status_filter_combo.currentData(), self.host_filter_combo.currentData())
+    
+    def search_history(self):
+        """Search the archived downloads"""
+        self.history_search_number += 1
+        self.history_loading = False
+        self.history_list.clear()
+        self.load_more_history()
+    
+    def load_more_history(self):
+        """Append the next page of history search results, searched in the background"""
+        if self.history_loading:
+            return
+        self.history_loading = True
+        search_number = self.history_search_number
+        text = self.history_search_input.text().strip()
+        offset = self.history_list.count()
+        
+        def search():
+            try:
+                records = self.download_engine.search_history(text, offset=offset, limit=200)
+            except (OSError, RuntimeError) as e:
+                self.status_message.emit(f"History search failed: {e}")
+                records = []
+            self.history_loaded.emit(search_number, records)
+        
+        searcher = threading.Thread(target=search)
+        searcher.daemon = True
+        searcher.start()
+    
+    def on_history_loaded(self, search_number, records):
+        if search_number != self.history_search_number:
+            return
+        self.history_loading = False
+        for record in records:
+            item = QListWidgetItem(f"[{record['status']}] {record['filename']} - {record['url']}")
+            item.setData(Qt.UserRole, record['id'])
+            self.history_list.addItem(item)
+    
+    def requeue_from_history(self):
+        """Download the selected archived download again, looked up in the background"""
+        item = self.history_list.currentItem()
+        if item is None:
+            return
+        download_id, text, save_path = item.data(Qt.UserRole), item.text(), self.save_path_input.text()
+        
+        def requeue():
+            try:
+                if self.download_engine.requeue_from_history(download_id, save_path):
+                    self.status_message.emit(f"Download added: {text}")
+            except (OSError, RuntimeError) as e:
+                self.status_message.emit(f"Could not download again: {e}")
+        
+        requeuer = threading.Thread(target=requeue)
+        requeuer.daemon = True
+        requeuer.start()
+    
+    def update_keep_finished(self):
+        """Update how many finished downloads stay in the list"""
+        self.retention_policy.max_items = self.keep_finished_spin.value()
+        self.download_engine.set_retention_policy(self.retention_policy, self.store)
     
     def toggle_pause_resume(self, download_id):
         """Toggle pause/resume for a download"""
@@ -394,9 +651,14 @@ class DownloadManagerGUI(QMainWindow):
         self.download_engine.cancel_download(download_id)
     
     def update_download_items(self):
-        """Update all download items"""
-        for download_id, widget in self.download_widgets.items():
-            widget.update_info()
+        """Repaint the downloads that changed since the last tick"""
+        changed_ids = self.download_engine.take_changed_ids()
+        if changed_ids:
+            self.download_model.refresh_items(changed_ids)
+    
+    def update_speed_graph(self):
+        """Redraw the total speed graph"""
+        self.speed_graph.set_speeds(self.download_engine.speed_history(), self.download_engine.total_speed())
     
     def browse_save_path(self):
         """Browse for default save path"""
@@ -415,20 +677,79 @@ class DownloadManagerGUI(QMainWindow):
     def toggle_speed_limit(self, state):
         """Toggle speed limit"""
         self.speed_limit_spin.setEnabled(state == Qt.Checked)
-        # TODO: Implement speed limiting in download engine
+        self.update_speed_limit()
+    
+    def update_speed_limit(self):
+        """Apply the speed limit to all downloads together"""
+        if self.speed_limit_check.isChecked():
+            self.download_engine.speed_limit = self.speed_limit_spin.value() * 1024
+        else:
+            self.download_engine.speed_limit = 0
+    
+    def toggle_tracing(self, state):
+        """Start or stop recording the download timeline"""
+        self.download_engine.set_tracing(state == Qt.Checked)
+    
+    def export_trace(self):
+        """Save the recorded download timeline as a Chrome trace, written in the background"""
+        path, _ = QFileDialog.getSaveFileName(self, "Export Timeline", "pdm-trace.json",
+                                              "Chrome trace (*.json)")
+        if not path:
+            return
+        
+        def write_trace():
+            try:
+                events = self.download_engine.export_trace(path)
+            except (OSError, RuntimeError) as e:
+                self.status_message.emit(f"Could not write {path}: {e}")
+                return
+            self.status_message.emit(f"{events} timeline events written to {path}")
+        
+        writer = threading.Thread(target=write_trace)
+        writer.daemon = True
+        writer.start()
+    
+    def start_profile(self):
+        """Profile the download engine (and this window) in the background and save the collapsed stacks"""
+        path, _ = QFileDialog.getSaveFileName(self, "Save Profile", "pdm-profile.txt", "Collapsed stacks (*.txt)")
+        if not path:
+            return
+        seconds = self.profile_seconds_spin.value()
+        if not self.download_engine.start_profile(seconds, self.profile_mode_combo.currentData(),
+                                                  [(self, 'update_download_items')]):
+            QMessageBox.information(self, "Profile", "A profile is already running")
+            return
+        self.profile_btn.setEnabled(False)
+        self.statusBar().showMessage(f"Profiling for {seconds} s...")
+        
+        def write_profile():
+            try:
+                count = write_collapsed(path, self.download_engine.profile_stacks())
+            except (OSError, RuntimeError) as e:
+                self.profile_finished.emit(f"Profile failed: {e}")
+                return
+            self.profile_finished.emit(f"{count} stacks written to {path}")
+        
+        writer = threading.Thread(target=write_profile)
+        writer.daemon = True
+        writer.start()
+    
+    def on_profile_finished(self, message):
+        self.profile_btn.setEnabled(True)
+        self.statusBar().showMessage(message)
     
     def start_clipboard_monitor(self):
-        """Start the clipboard monitor thread"""
+        """Start watching the clipboard"""
         if self.clipboard_monitor is None and self.clipboard_monitor_check.isChecked():
-            self.clipboard_monitor = ClipboardMonitor()
-            self.clipboard_monitor.url_detected.connect(self.on_url_detected)
+            self.clipboard_monitor = ClipboardMonitor(self)
+            self.clipboard_monitor.urls_detected.connect(self.on_urls_detected)
             self.clipboard_monitor.start()
     
     def stop_clipboard_monitor(self):
-        """Stop the clipboard monitor thread"""
+        """Stop watching the clipboard"""
         if self.clipboard_monitor is not None:
             self.clipboard_monitor.stop()
-            self.clipboard_monitor.wait()
+            self.clipboard_monitor.deleteLater()
             self.clipboard_monitor = None
     
     def toggle_clipboard_monitor(self, state):
@@ -438,17 +759,29 @@ class DownloadManagerGUI(QMainWindow):
         else:
             self.stop_clipboard_monitor()
     
-    def on_url_detected(self, url):
-        """Handle detected URL from clipboard"""
-        # Ask user if they want to download this URL
-        reply = QMessageBox.question(
-            self, "URL Detected", f"Do you want to download this URL?\n\n{url}",
-            QMessageBox.Yes | QMessageBox.No, QMessageBox.No
-        )
-        
-        if reply == QMessageBox.Yes:
-            self.url_input.setText(url)
-            self.start_download()
+    def on_urls_detected(self, urls):
+        """Offer the URLs found in the clipboard as one batch"""
+        if self.clipboard_dialog is not None:
+            # Still asking about the previous copy
+            return
+        self.clipboard_dialog = BatchAddDialog(urls, self)
+        try:
+            if self.clipboard_dialog.exec_() == QDialog.Accepted:
+                self.add_urls(self.clipboard_dialog.selected_urls())
+        finally:
+            self.clipboard_dialog = None
+    
+    def add_urls(self, urls):
+        """Download several URLs to the default save path"""
+        try:
+            download_ids = self.download_engine.add_downloads([{'url': url} for url in urls],
+                                                              self.save_path_input.text())
+        except OSError as e:
+            QMessageBox.warning(self, "Error", f"Could not create save directory: {str(e)}")
+            return
+        added = sum(1 for download_id in download_ids if download_id is not None)
+        if added:
+            self.statusBar().showMessage(f"{added} download(s) added")
     
     def install_chrome_extension(self):
         """Install Chrome extension"""
@@ -469,6 +802,7 @@ class DownloadManagerGUI(QMainWindow):
             )
             
             # Open Chrome extensions page
+            import webbrowser
             webbrowser.open('chrome://extensions/')
             
         except Exception as e:
@@ -491,19 +825,34 @@ class DownloadManagerGUI(QMainWindow):
             except Exception as e:
                 QMessageBox.warning(self, "Server Error", f"Failed to start server: {str(e)}")
     
+    def add_initial_downloads(self, urls):
+        """Add downloads passed on the command line"""
+        self.add_urls(urls)
+    
     def add_download_from_browser(self, url, filename=None, referrer=None):
-        """Add a download from browser integration"""
+        """Add a download from browser integration (called from the integration server thread)"""
         save_path = self.save_path_input.text()
         if not os.path.exists(save_path):
             try:
                 os.makedirs(save_path, exist_ok=True)
             except Exception as e:
-                self.statusBar().showMessage(f"Error creating save directory: {str(e)}")
+                self.status_message.emit(f"Error creating save directory: {str(e)}")
                 return False
         
         # Add the download
         download_id = self.download_engine.add_download(url, save_path, filename, referrer)
-        self.statusBar().showMessage(f"Download added from browser: {url}")
+        self.status_message.emit(f"Download added from browser: {url}")
+        return True
+    
+    def add_downloads_from_browser(self, items):
+        """Add a batch of downloads from browser integration, e.g. all links of a page"""
+        try:
+            download_ids = self.download_engine.add_downloads(items, self.save_path_input.text())
+        except OSError as e:
+            self.status_message.emit(f"Error creating save directory: {str(e)}")
+            return False
+        added = sum(1 for download_id in download_ids if download_id is not None)
+        self.status_message.emit(f"{added} download(s) added from browser")
         return True
     
     def closeEvent(self, event):
@@ -511,11 +860,17 @@ class DownloadManagerGUI(QMainWindow):
         # Stop clipboard monitor
         self.stop_clipboard_monitor()
         
+        # Stop accepting forwarded requests
+        if self.instance_server is not None:
+            self.instance_server.stop()
+        
         # Stop browser integration server
-        if self.browser_integration.is_server_running():
+        if self._browser_integration is not None and self._browser_integration.is_server_running():
             self.browser_integration.stop_server()
         
-        # Shutdown download engine
+        # Stop polling the engine, then shut it down
+        self.update_timer.stop()
+        self.speed_timer.stop()
         self.download_engine.shutdown()
         
         # Accept the close event
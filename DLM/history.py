@@ -0,0 +1,103 @@
+import os
+import sys
+import json
+import threading
+from collections import deque
+
+
+DATA_DIR = os.path.join(os.path.expanduser('~'), '.pydownloadmanager')
+DEFAULT_HISTORY_PATH = os.path.join(DATA_DIR, 'history.jsonl')
+
+# Fields of a DownloadItem that are kept in the history
+HISTORY_FIELDS = ('id', 'url', 'save_path', 'filename', 'total_size', 'downloaded_size',
+                  'error_message', 'referrer', 'start_time', 'finish_time')
+
+
+def item_to_record(download_item):
+    """Compact dict describing a finished download"""
+    record = {field: getattr(download_item, field) for field in HISTORY_FIELDS}
+    record['status'] = download_item.status.value
+    return record
+
+
+def estimate_item_size(download_item):
+    """Rough number of bytes a finished download keeps alive in memory"""
+    return (sys.getsizeof(download_item) + sys.getsizeof(download_item.url) + sys.getsizeof(download_item.id)
+            + sys.getsizeof(download_item.filename) + sys.getsizeof(download_item.error_message))
+
+
+class RetentionPolicy:
+    """How many finished downloads to keep in memory.
+
+    max_items: keep at most this many finished downloads
+    max_age: evict downloads that finished more than this many seconds ago
+    max_memory: evict once finished downloads use more than this many bytes (estimated)
+    """
+
+    def __init__(self, max_items=None, max_age=None, max_memory=None):
+        self.max_items = max_items
+        self.max_age = max_age
+        self.max_memory = max_memory
+
+    def should_evict(self, download_item, finished_count, finished_memory, now):
+        """Check the oldest finished download against the limits"""
+        if self.max_items is not None and finished_count > self.max_items:
+            return True
+        if self.max_memory is not None and finished_memory > self.max_memory:
+            return True
+        if self.max_age is not None and now - download_item.finish_time > self.max_age:
+            return True
+        return False
+
+
+class DownloadHistory:
+    """Append-only on-disk archive of finished downloads (one JSON object per line)"""
+
+    def __init__(self, path=DEFAULT_HISTORY_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def append(self, download_items):
+        """Archive finished downloads"""
+        lines = ''.join(json.dumps(item_to_record(download_item)) + '\n' for download_item in download_items)
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(lines)
+
+    def _records(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+    def search(self, text=None, status=None, offset=0, limit=100):
+        """Find archived downloads, newest first.
+
+        text is matched case-insensitively against the URL and the filename.
+        """
+        text = text.lower() if text else None
+        status = getattr(status, 'value', status)
+        matches = deque(maxlen=offset + limit)
+        with self.lock:
+            for record in self._records():
+                if status is not None and record['status'] != status:
+                    continue
+                if text and text not in record['url'].lower() and text not in (record['filename'] or '').lower():
+                    continue
+                matches.append(record)
+        newest_first = list(reversed(matches))
+        return newest_first[offset:offset + limit]
+
+    def get(self, download_id):
+        """Get the archived record of a download"""
+        found = None
+        with self.lock:
+            for record in self._records():
+                if record['id'] == download_id:
+                    found = record
+        return found
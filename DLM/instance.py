@@ -0,0 +1,265 @@
+import os
+import sys
+import json
+import stat
+import time
+import socket
+import struct
+import logging
+import tempfile
+import threading
+import subprocess
+
+from utils import is_valid_url
+
+logger = logging.getLogger('instance')
+
+# Fallback for platforms without Unix domain sockets
+INSTANCE_TCP_ADDRESS = ('127.0.0.1', 8766)
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+
+def get_instance_address():
+    """Get the local address the running instance listens on"""
+    if hasattr(socket, 'AF_UNIX'):
+        runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+        if not runtime_dir:
+            # Everyone can create files in the shared temp directory, so the socket goes in a directory of our own
+            runtime_dir = os.path.join(tempfile.gettempdir(), f'pydownloadmanager-{os.getuid()}')
+        user = os.environ.get('USER') or os.environ.get('USERNAME') or str(os.getuid())
+        return os.path.join(runtime_dir, f'pydownloadmanager-{user}.sock')
+    return INSTANCE_TCP_ADDRESS
+
+
+def _check_socket_directory(address):
+    """Create the directory of a socket address if needed, raises PermissionError unless only this user can use it"""
+    directory = os.path.dirname(address)
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise PermissionError(f"{directory} must be a directory only the current user can access")
+
+
+def _create_socket(address):
+    family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+    return socket.socket(family, socket.SOCK_STREAM)
+
+
+def send_message(sock, message):
+    """Send a length-prefixed JSON message"""
+    data = json.dumps(message).encode('utf-8')
+    sock.sendall(struct.pack('<I', len(data)) + data)
+
+
+def recv_message(sock):
+    """Receive a length-prefixed JSON message, None when the peer closed the connection"""
+    header = _recv_exactly(sock, 4)
+    if header is None:
+        return None
+    length = struct.unpack('<I', header)[0]
+    if length > MAX_MESSAGE_SIZE:
+        raise ValueError(f"Message too large: {length} bytes")
+    data = _recv_exactly(sock, length)
+    if data is None:
+        return None
+    return json.loads(data.decode('utf-8'))
+
+
+def _recv_exactly(sock, size):
+    buffer = b''
+    while len(buffer) < size:
+        data = sock.recv(size - len(buffer))
+        if not data:
+            return None
+        buffer += data
+    return buffer
+
+
+class InstanceClient:
+    """Connection to the running instance"""
+
+    def __init__(self, address=None, timeout=5.0):
+        self.address = address or get_instance_address()
+        if isinstance(self.address, str):
+            # Another user's socket would receive our URLs
+            _check_socket_directory(self.address)
+        self.sock = _create_socket(self.address)
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect(self.address)
+        except OSError:
+            self.sock.close()
+            raise
+
+    def request(self, message):
+        """Send a message and wait for the reply"""
+        send_message(self.sock, message)
+        response = recv_message(self.sock)
+        if response is None:
+            raise ConnectionError("Instance closed the connection")
+        return response
+
+    def close(self):
+        self.sock.close()
+
+
+def is_instance_running(address=None):
+    """Check if another instance is listening"""
+    try:
+        InstanceClient(address, timeout=1.0).close()
+        return True
+    except OSError:
+        return False
+
+
+def connect_or_launch(launch_command, address=None, timeout=15.0):
+    """Connect to the running instance, starting one with launch_command if none is running"""
+    try:
+        return InstanceClient(address)
+    except OSError:
+        pass
+
+    logger.info(f"No running instance, launching: {launch_command}")
+    kwargs = {'stdin': subprocess.DEVNULL, 'stdout': subprocess.DEVNULL, 'stderr': subprocess.DEVNULL}
+    if os.name == 'nt':
+        kwargs['creationflags'] = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs['start_new_session'] = True
+    subprocess.Popen(launch_command, **kwargs)
+
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return InstanceClient(address)
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def get_launch_command():
+    """Command that starts the full application"""
+    if getattr(sys, 'frozen', False):
+        return [sys.executable]
+    return [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')]
+
+
+class InstanceServer:
+    """Accepts requests forwarded from the native messaging shim and other processes"""
+
+    def __init__(self, request_handler, address=None):
+        self.request_handler = request_handler
+        self.address = address or get_instance_address()
+        self.sock = None
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        """Start listening, returns False if another instance already owns the address"""
+        if self.running:
+            return True
+
+        sock = None
+        umask = None
+        try:
+            if isinstance(self.address, str):
+                _check_socket_directory(self.address)
+                if os.path.exists(self.address):
+                    if is_instance_running(self.address):
+                        return False
+                    # Stale socket left behind by a crashed instance
+                    os.unlink(self.address)
+                # The socket file is created by bind, only accessible to us from the start
+                umask = os.umask(0o177)
+            sock = _create_socket(self.address)
+            sock.bind(self.address)
+            sock.listen(16)
+        except OSError as e:
+            if sock is not None:
+                sock.close()
+            logger.error(f"Failed to start instance server: {str(e)}")
+            return False
+        finally:
+            if umask is not None:
+                os.umask(umask)
+
+        self.sock = sock
+        self.running = True
+        self.thread = threading.Thread(target=self._accept_loop)
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info(f"Instance server listening on {self.address}")
+        return True
+
+    def stop(self):
+        """Stop listening and remove the socket file"""
+        if not self.running:
+            return
+        self.running = False
+        self.sock.close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+
+    def _accept_loop(self):
+        while self.running:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                break
+            thread = threading.Thread(target=self._serve_connection, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve_connection(self, conn):
+        try:
+            while self.running:
+                message = recv_message(conn)
+                if message is None:
+                    break
+                try:
+                    response = self.request_handler(message)
+                except Exception as e:
+                    logger.error(f"Error handling instance request: {str(e)}")
+                    response = {'status': 'error', 'message': str(e)}
+                send_message(conn, response or {'status': 'success'})
+        except (OSError, ValueError) as e:
+            logger.debug(f"Instance connection closed: {str(e)}")
+        finally:
+            conn.close()
+
+
+def check_download_request(message):
+    """Items of a forwarded download request, raises ValueError if the request or any item is invalid"""
+    if not isinstance(message, dict):
+        raise ValueError("Invalid request")
+    items = [message] if 'url' in message else message.get('items')
+    if not isinstance(items, list) or not items:
+        raise ValueError("Invalid request")
+    for number, item in enumerate(items, 1):
+        if not isinstance(item, dict) or not isinstance(item.get('url'), str) or not is_valid_url(item['url']):
+            raise ValueError(f"Invalid URL in item {number}")
+        if any(item.get(key) is not None and not isinstance(item[key], str) for key in ('filename', 'referrer')):
+            raise ValueError(f"Invalid filename or referrer in item {number}")
+    return items
+
+
+def handle_download_request(message, add_download, add_downloads=None):
+    """Dispatch a forwarded request to add_download(url, filename, referrer), or add_downloads(items) for lists"""
+    if isinstance(message, dict) and message.get('action') == 'ping':
+        return {'status': 'success', 'pid': os.getpid()}
+    try:
+        items = check_download_request(message)
+    except ValueError as e:
+        return {'status': 'error', 'message': str(e)}
+    if add_downloads is not None and len(items) > 1:
+        add_downloads(items)
+    else:
+        for item in items:
+            add_download(item['url'], item.get('filename'), item.get('referrer'))
+    return {'status': 'success', 'count': len(items)}
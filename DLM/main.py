@@ -1,26 +1,98 @@
 import sys
 import os
-from PyQt5.QtWidgets import QApplication
-from PyQt5.QtGui import QIcon
-from gui import DownloadManagerGUI
+import time
 
+# Set PDM_STARTUP_PROFILE=1 to print startup milestones (see benchmarks/startup.py)
+STARTUP_PROFILE = bool(os.environ.get('PDM_STARTUP_PROFILE'))
+
+
+def startup_mark(name):
+    """Report a startup milestone on stderr when profiling"""
+    if STARTUP_PROFILE:
+        sys.stderr.write(f"PDM_STARTUP {name} {time.time():.6f}\n")
+        sys.stderr.flush()
+
+
+def run_gui(urls=(), engine_process=False):
+    # Qt is only imported for the GUI so the headless mode stays light
+    from PyQt5.QtWidgets import QApplication
+    from PyQt5.QtCore import QTimer
+    from PyQt5.QtGui import QIcon
+    from gui import DownloadManagerGUI
+    startup_mark('imports_done')
 
-def main():
     # Create application
     app = QApplication(sys.argv)
     app.setApplicationName("PyDownload Manager")
     app.setStyle("Fusion")  # Use Fusion style for a modern look
-    
+
     # Set application icon
     # app.setWindowIcon(QIcon("icon.png"))  # Uncomment and add icon file if available
-    
+
     # Create and show the main window
-    main_window = DownloadManagerGUI()
+    main_window = DownloadManagerGUI(engine_process=engine_process)
     main_window.show()
-    
+    QTimer.singleShot(0, lambda: startup_mark('first_window'))
+
+    if STARTUP_PROFILE:
+        def on_first_byte(download_item):
+            if not getattr(on_first_byte, 'seen', False):
+                on_first_byte.seen = True
+                startup_mark('first_byte')
+        main_window.download_engine.register_callback('progress', on_first_byte)
+
+    # Downloads given on the command line are added once the event loop runs
+    if urls:
+        QTimer.singleShot(0, lambda: main_window.add_initial_downloads(urls))
+
     # Start the application event loop
     sys.exit(app.exec_())
 
 
+def is_native_messaging_launch(args):
+    """Browsers start the native host with the extension origin (Chrome) or manifest path (Firefox)"""
+    return bool(args) and (args[0].startswith('chrome-extension://') or args[0].endswith('.json'))
+
+
+def forward_to_running_instance(urls):
+    """Hand the request to an already running instance, returns False if there is none"""
+    from instance import InstanceClient
+    try:
+        client = InstanceClient(timeout=2.0)
+    except OSError:
+        return False
+    try:
+        if urls:
+            client.request({'items': [{'url': url} for url in urls]})
+        else:
+            client.request({'action': 'show'})
+    except (OSError, ValueError):
+        return False
+    finally:
+        client.close()
+    return True
+
+
+def main():
+    startup_mark('main')
+    # Frozen builds start the engine process through this executable
+    import multiprocessing
+    multiprocessing.freeze_support()
+    args = sys.argv[1:]
+    if is_native_messaging_launch(args):
+        # Started by the browser (frozen build): act as the Qt-free shim
+        from native_host import main as native_host_main
+        sys.exit(native_host_main())
+    if '--headless' in args:
+        from cli import main as cli_main
+        sys.exit(cli_main([arg for arg in args if arg != '--headless']))
+
+    urls = [arg for arg in args if '://' in arg]
+    if forward_to_running_instance(urls):
+        sys.exit(0)
+    # --engine-process runs the downloads in a child process
+    run_gui(urls, engine_process='--engine-process' in args)
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
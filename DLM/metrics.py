@@ -0,0 +1,228 @@
+import threading
+from bisect import bisect_left
+
+# Histogram bucket upper bounds
+TTFB_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+THROUGHPUT_BUCKETS = (64e3, 256e3, 1e6, 4e6, 16e6, 64e6, 256e6)  # bytes per second
+WRITE_LATENCY_BUCKETS = (1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 0.01, 0.05, 0.1)
+QUEUE_WAIT_BUCKETS = (0.01, 0.1, 1.0, 10.0, 60.0, 300.0, 1800.0)
+
+
+class Histogram:
+    """Bucket counts for a Prometheus histogram, counts[i] holds values <= bounds[i] (last one: +Inf)"""
+    __slots__ = ('bounds', 'counts', 'total')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.total += value
+
+    def copy(self):
+        histogram = Histogram(self.bounds)
+        histogram.add(self)
+        return histogram
+
+    def add(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.total += other.total
+
+    def to_dict(self):
+        return {'bounds': self.bounds, 'counts': list(self.counts), 'total': self.total}
+
+
+class MetricsCell:
+    """Counters of one segment thread.
+
+    Only the owning thread writes to its cell, so the hot path updates
+    plain attributes without taking a lock; scrapes read the cells as they
+    are (a chunk in flight may be missed until the next scrape).
+    """
+    __slots__ = ('host', 'bytes', 'streaming', 'write_latency', 'ttfb', 'retries')
+
+    def __init__(self, host):
+        self.host = host
+        self.bytes = 0
+        self.streaming = False  # holding a connection with a response body in flight
+        self.write_latency = Histogram(WRITE_LATENCY_BUCKETS)
+        self.ttfb = Histogram(TTFB_BUCKETS)
+        self.retries = {}  # error class -> count
+
+
+class EngineMetrics:
+    """Engine counters, gauges and histograms for the /metrics endpoint.
+
+    Segment threads get a MetricsCell from cell() and hand it back with
+    release() when they end, which folds it into the totals. Everything
+    else is counted once per download or request under self.lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cells = set()
+        self.bytes_by_host = {}
+        self.retries = {}
+        self.errors = {}
+        self.write_latency = Histogram(WRITE_LATENCY_BUCKETS)
+        self.ttfb = Histogram(TTFB_BUCKETS)
+        self.throughput = Histogram(THROUGHPUT_BUCKETS)
+        self.queue_wait = Histogram(QUEUE_WAIT_BUCKETS)
+        # Requests and new connections of connection pools that were closed
+        self.pool_requests = 0
+        self.pool_connections = 0
+
+    def cell(self, host):
+        """Counters for a new segment thread"""
+        cell = MetricsCell(host)
+        with self.lock:
+            self.cells.add(cell)
+        return cell
+
+    def release(self, cell):
+        """Fold the counters of an ended segment thread into the totals"""
+        with self.lock:
+            self.cells.discard(cell)
+            self.bytes_by_host[cell.host] = self.bytes_by_host.get(cell.host, 0) + cell.bytes
+            self.write_latency.add(cell.write_latency)
+            self.ttfb.add(cell.ttfb)
+            for error_class, count in cell.retries.items():
+                self.retries[error_class] = self.retries.get(error_class, 0) + count
+
+    def count_error(self, error_class):
+        with self.lock:
+            self.errors[error_class] = self.errors.get(error_class, 0) + 1
+
+    def observe_throughput(self, bytes_per_second):
+        with self.lock:
+            self.throughput.observe(bytes_per_second)
+
+    def observe_queue_wait(self, seconds):
+        with self.lock:
+            self.queue_wait.observe(seconds)
+
+    def count_pool(self, requests, connections):
+        """Remember the counters of a connection pool that is being closed"""
+        with self.lock:
+            self.pool_requests += requests
+            self.pool_connections += connections
+
+    def snapshot(self, pool_requests=0, pool_connections=0):
+        """Plain data copy of all metrics, pool counters of open pools are passed in"""
+        with self.lock:
+            cells = list(self.cells)
+            bytes_by_host = dict(self.bytes_by_host)
+            retries = dict(self.retries)
+            errors = dict(self.errors)
+            write_latency = self.write_latency.copy()
+            ttfb = self.ttfb.copy()
+            throughput = self.throughput.copy()
+            queue_wait = self.queue_wait.copy()
+            pool_requests += self.pool_requests
+            pool_connections += self.pool_connections
+        # Live cells are read without their thread's cooperation
+        connections = 0
+        for cell in cells:
+            bytes_by_host[cell.host] = bytes_by_host.get(cell.host, 0) + cell.bytes
+            connections += cell.streaming
+            for error_class, count in list(cell.retries.items()):
+                retries[error_class] = retries.get(error_class, 0) + count
+            write_latency.add(cell.write_latency)
+            ttfb.add(cell.ttfb)
+        return {
+            'bytes_by_host': bytes_by_host,
+            'retries': retries,
+            'errors': errors,
+            'segments': len(cells),
+            'connections': connections,
+            'pool_requests': pool_requests,
+            'pool_connections': pool_connections,
+            'histograms': {'write_latency': write_latency.to_dict(), 'ttfb': ttfb.to_dict(),
+                           'throughput': throughput.to_dict(), 'queue_wait': queue_wait.to_dict()},
+        }
+
+
+def merge_snapshots(snapshots):
+    """Add up the metrics snapshots of several engines"""
+    merged = {'bytes_by_host': {}, 'retries': {}, 'errors': {}, 'histograms': {},
+              'segments': 0, 'connections': 0, 'pool_requests': 0, 'pool_connections': 0}
+    for snapshot in snapshots:
+        for key in ('bytes_by_host', 'retries', 'errors'):
+            for label, value in snapshot[key].items():
+                merged[key][label] = merged[key].get(label, 0) + value
+        for key in ('segments', 'connections', 'pool_requests', 'pool_connections'):
+            merged[key] += snapshot[key]
+        for name, histogram in snapshot['histograms'].items():
+            total = merged['histograms'].get(name)
+            if total is None:
+                merged['histograms'][name] = {'bounds': histogram['bounds'], 'counts': list(histogram['counts']),
+                                              'total': histogram['total']}
+            else:
+                total['counts'] = [a + b for a, b in zip(total['counts'], histogram['counts'])]
+                total['total'] += histogram['total']
+    return merged
+
+
+HISTOGRAMS = (
+    ('write_latency', 'pdm_disk_write_seconds', 'Time spent in file writes of downloaded chunks'),
+    ('ttfb', 'pdm_time_to_first_byte_seconds', 'Time from sending a segment request to its response headers'),
+    ('throughput', 'pdm_download_throughput_bytes_per_second', 'Average speed of completed downloads'),
+    ('queue_wait', 'pdm_queue_wait_seconds', 'Time downloads waited in the queue before starting'),
+)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_bound(bound):
+    return repr(float(bound))
+
+
+def render_metrics(snapshot, status_counts):
+    """Prometheus text exposition (format 0.0.4) of a metrics snapshot and the download counts by status"""
+    lines = []
+
+    def metric(name, metric_type, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in samples:
+            label_text = ','.join(f'{key}="{_escape(label)}"' for key, label in labels)
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+    metric('pdm_downloaded_bytes_total', 'counter', 'Bytes downloaded, by host',
+           [((('host', host),), value) for host, value in sorted(snapshot['bytes_by_host'].items())])
+    metric('pdm_downloads', 'gauge', 'Downloads in the engine, by status',
+           [((('status', status.value),), count) for status, count in status_counts.items()])
+    metric('pdm_segments_active', 'gauge', 'Segment threads running', [((), snapshot['segments'])])
+    metric('pdm_connections_active', 'gauge', 'Connections streaming a response body',
+           [((), snapshot['connections'])])
+    metric('pdm_retries_total', 'counter', 'Segment requests retried, by error class',
+           [((('class', error_class),), count) for error_class, count in sorted(snapshot['retries'].items())])
+    metric('pdm_errors_total', 'counter', 'Downloads that failed, by error class',
+           [((('class', error_class),), count) for error_class, count in sorted(snapshot['errors'].items())])
+    metric('pdm_pool_requests_total', 'counter', 'HTTP requests sent through the connection pools',
+           [((), snapshot['pool_requests'])])
+    metric('pdm_pool_connections_total', 'counter', 'Connections opened by the connection pools',
+           [((), snapshot['pool_connections'])])
+    requests = snapshot['pool_requests']
+    reuse = 1 - snapshot['pool_connections'] / requests if requests else 0.0
+    metric('pdm_pool_reuse_ratio', 'gauge', 'Share of requests sent over an already open connection',
+           [((), round(max(reuse, 0.0), 4))])
+
+    for key, name, help_text in HISTOGRAMS:
+        histogram = snapshot['histograms'][key]
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        cumulative = 0
+        for bound, count in zip(histogram['bounds'], histogram['counts']):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{_format_bound(bound)}"}} {cumulative}')
+        cumulative += histogram['counts'][-1]
+        lines.append(f'{name}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f"{name}_sum {histogram['total']}")
+        lines.append(f"{name}_count {cumulative}")
+    return '\n'.join(lines) + '\n'
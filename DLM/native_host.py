@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""Native messaging host shim.
+
+Registered with the browsers instead of the full application. It imports
+nothing from Qt: every message from the extension is forwarded to the
+running instance over the local instance socket, and the application is
+only launched when no instance is running.
+"""
+import sys
+import json
+import struct
+import logging
+
+from instance import connect_or_launch, get_launch_command
+
+logger = logging.getLogger('native_host')
+
+
+def read_native_message(stream):
+    """Read one native messaging message, None at end of input"""
+    length_bytes = stream.read(4)
+    if len(length_bytes) < 4:
+        return None
+    message_length = struct.unpack('=I', length_bytes)[0]
+    return json.loads(stream.read(message_length).decode('utf-8'))
+
+
+def write_native_message(stream, message):
+    """Write one native messaging message"""
+    data = json.dumps(message).encode('utf-8')
+    stream.write(struct.pack('=I', len(data)))
+    stream.write(data)
+    stream.flush()
+
+
+def main():
+    client = None
+    while True:
+        try:
+            message = read_native_message(sys.stdin.buffer)
+        except ValueError as e:
+            write_native_message(sys.stdout.buffer, {'status': 'error', 'message': str(e)})
+            continue
+        if message is None:
+            break
+
+        try:
+            if client is None:
+                client = connect_or_launch(get_launch_command())
+            response = client.request(message)
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to forward message to PyDownload Manager: {str(e)}")
+            if client is not None:
+                client.close()
+                client = None
+            response = {'status': 'error', 'message': str(e)}
+        write_native_message(sys.stdout.buffer, response)
+
+    if client is not None:
+        client.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
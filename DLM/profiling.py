@@ -0,0 +1,191 @@
+import os
+import re
+import sys
+import time
+import functools
+import threading
+
+# 'sample': stacks of all threads weighted by the CPU time they used, 'functions': time spent in given functions
+PROFILE_MODES = ('sample', 'functions')
+
+# Seconds between stack samples
+PROFILE_INTERVAL = 0.005
+
+# Longest profile that can be asked for, in seconds
+MAX_PROFILE_DURATION = 600
+
+
+def thread_label(name):
+    """Thread name without its counter, so the threads of one kind share a flame graph root"""
+    return re.sub(r'-\d+', '', name or 'thread').replace(';', ',')
+
+
+def frame_label(code):
+    name = getattr(code, 'co_qualname', code.co_name)
+    return f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(';', ',')
+
+
+def thread_cpu_time(ident):
+    """CPU seconds used by a thread so far, None where per-thread clocks are missing"""
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError, OverflowError):
+        return None
+
+
+def render_collapsed(stacks):
+    """Stacks in the collapsed format read by flamegraph.pl and speedscope, one 'stack value' per line"""
+    return ''.join(f"{stack} {value}\n" for stack, value in sorted(stacks.items()) if value > 0)
+
+
+def write_collapsed(path, stacks):
+    """Write stacks to a collapsed stack file, returns the number of stacks"""
+    text = render_collapsed(stacks)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    return text.count('\n')
+
+
+def prefix_stacks(prefix, stacks):
+    return {f"{prefix};{stack}": value for stack, value in stacks.items()}
+
+
+class Profiler:
+    """Profiles the running process for a while from a background thread.
+
+    'sample' mode reads the stack of every thread each PROFILE_INTERVAL
+    and weights it with the CPU time the thread used since the previous
+    sample (in microseconds), so threads waiting on sockets or locks don't
+    show up; without per-thread CPU clocks every sample weighs the
+    interval. 'functions' mode wraps the given (object, method name)
+    targets for the duration and records the wall time spent in each,
+    in microseconds, nested by the wrapped calls on the stack. Only calls
+    made after the start are seen, calls still running at the end are
+    counted up to the end.
+
+    Results are stacks in collapsed form, 'thread;outer;inner' -> value.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.done = threading.Event()
+        self.done.set()
+        self.result = {}
+
+    def start(self, duration, mode='sample', targets=(), interval=PROFILE_INTERVAL):
+        """Start profiling for duration seconds, returns False if a profile is running already"""
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode: {mode}")
+        if not 0 < duration <= MAX_PROFILE_DURATION:
+            raise ValueError(f"Profile duration must be between 0 and {MAX_PROFILE_DURATION} seconds")
+        with self.lock:
+            if not self.done.is_set():
+                return False
+            self.done = threading.Event()
+            self.result = {}
+            if mode == 'sample':
+                self.thread = threading.Thread(target=self._sample, args=(duration, interval), name='profiler')
+            else:
+                self.thread = threading.Thread(target=self._trace, args=(duration, list(targets)), name='profiler')
+            self.thread.daemon = True
+            self.thread.start()
+        return True
+
+    def stacks(self, timeout=None):
+        """Result of the last profile, waiting for a running one; None if it didn't finish within timeout"""
+        done = self.done
+        if not done.wait(timeout):
+            return None
+        return self.result
+
+    def _sample(self, duration, interval):
+        stacks = {}
+        cpu_times = {}
+        own = threading.get_ident()
+        end = time.monotonic() + duration
+        try:
+            while time.monotonic() < end:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                frames = sys._current_frames()
+                seen = {}
+                for ident, frame in frames.items():
+                    if ident == own:
+                        continue
+                    cpu_time = thread_cpu_time(ident)
+                    if cpu_time is None:
+                        weight = int(interval * 1e6)
+                    else:
+                        seen[ident] = cpu_time
+                        weight = int((cpu_time - cpu_times.get(ident, cpu_time)) * 1e6)
+                    if weight <= 0:
+                        continue
+                    labels = []
+                    while frame is not None:
+                        labels.append(frame_label(frame.f_code))
+                        frame = frame.f_back
+                    labels.append(thread_label(names.get(ident)))
+                    stack = ';'.join(reversed(labels))
+                    stacks[stack] = stacks.get(stack, 0) + weight
+                cpu_times = seen
+                del frames
+                time.sleep(interval)
+        finally:
+            self.result = stacks
+            self.done.set()
+
+    def _trace(self, duration, targets):
+        stacks = {}
+        stacks_lock = threading.Lock()
+        running = {}  # thread ident -> [[stack, start, time in nested calls], ...]
+        recording = [True]
+
+        def record(stack, elapsed, nested):
+            value = int((elapsed - nested) * 1e6)
+            with stacks_lock:
+                stacks[stack] = stacks.get(stack, 0) + value
+
+        def wrap(function, label):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                calls = running.setdefault(threading.get_ident(), [])
+                outer = calls[-1][0] if calls else thread_label(threading.current_thread().name)
+                call = [f"{outer};{label}", time.perf_counter(), 0.0]
+                calls.append(call)
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    elapsed = time.perf_counter() - call[1]
+                    calls.pop()
+                    if calls:
+                        calls[-1][2] += elapsed
+                    if recording[0]:
+                        record(call[0], elapsed, call[2])
+            return wrapper
+
+        replaced = []
+        for target, name in targets:
+            # Instance attributes shadow the methods, threads pick the wrapper up on their next call
+            own = vars(target).get(name)
+            replaced.append((target, name, own))
+            setattr(target, name, wrap(getattr(target, name), frame_label(getattr(target, name).__code__)))
+        try:
+            time.sleep(duration)
+        finally:
+            for target, name, own in replaced:
+                if own is None:
+                    delattr(target, name)
+                else:
+                    setattr(target, name, own)
+            with stacks_lock:
+                recording[0] = False
+            now = time.perf_counter()
+            for calls in list(running.values()):
+                # Calls still running count up to now, innermost first
+                nested = 0.0
+                for stack, start, nested_before in reversed(list(calls)):
+                    elapsed = now - start
+                    record(stack, elapsed, nested_before + nested)
+                    nested = elapsed
+            self.result = stacks
+            self.done.set()
@@ -0,0 +1,153 @@
+import threading
+from itertools import chain, islice
+from urllib.parse import urlparse
+
+
+def get_host(url):
+    """Host part of a URL, used as index key"""
+    return urlparse(url).hostname or ''
+
+
+class DownloadRegistry:
+    """All downloads, with secondary indexes by status, host and save path.
+
+    The primary dict keeps insertion order, so it doubles as the add-time
+    index. Every secondary index maps its key to an insertion-ordered dict of
+    id -> item, which gives O(1) updates and counts, and paged reads that
+    only walk up to the requested slice. Status and host together (the
+    GUI's filter) have their own composite index.
+    """
+
+    def __init__(self):
+        self.items = {}
+        self.by_status = {}
+        self.by_host = {}
+        self.by_save_path = {}
+        self.by_status_host = {}
+        self.lock = threading.RLock()
+
+    def add(self, download_item):
+        """Register a new download"""
+        with self.lock:
+            host = get_host(download_item.url)
+            self.items[download_item.id] = download_item
+            self.by_status.setdefault(download_item.status, {})[download_item.id] = download_item
+            self.by_host.setdefault(host, {})[download_item.id] = download_item
+            self.by_status_host.setdefault((download_item.status, host), {})[download_item.id] = download_item
+            self.by_save_path.setdefault(download_item.save_path, {})[download_item.id] = download_item
+
+    def remove(self, download_id):
+        """Drop a download from the registry and all indexes"""
+        with self.lock:
+            download_item = self.items.pop(download_id, None)
+            if download_item is None:
+                return None
+            host = get_host(download_item.url)
+            self.by_status[download_item.status].pop(download_id, None)
+            self._discard(self.by_host, host, download_id)
+            self._discard(self.by_status_host, (download_item.status, host), download_id)
+            self._discard(self.by_save_path, download_item.save_path, download_id)
+            return download_item
+
+    @staticmethod
+    def _discard(index, key, download_id):
+        bucket = index.get(key)
+        if bucket is not None:
+            bucket.pop(download_id, None)
+            if not bucket:
+                del index[key]
+
+    def set_status(self, download_item, status, expected=None):
+        """Change the status of a download and its index entry in one step.
+
+        If expected is given, the change only happens when the current status
+        is one of expected. Returns True if the status was changed.
+        """
+        with self.lock:
+            old_status = download_item.status
+            if expected is not None and old_status not in expected:
+                return False
+            if old_status != status:
+                if download_item.id in self.items:
+                    host = get_host(download_item.url)
+                    self.by_status[old_status].pop(download_item.id, None)
+                    self.by_status.setdefault(status, {})[download_item.id] = download_item
+                    self._discard(self.by_status_host, (old_status, host), download_item.id)
+                    self.by_status_host.setdefault((status, host), {})[download_item.id] = download_item
+                download_item.status = status
+            return True
+
+    def get(self, download_id):
+        return self.items.get(download_id)
+
+    def __contains__(self, download_id):
+        return download_id in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def _select(self, status=None, host=None, save_path=None):
+        """Pick the smallest index buckets matching the filters and a predicate for the other filters"""
+        candidates = []
+        if status is not None:
+            statuses = tuple(status) if isinstance(status, (list, tuple, set, frozenset)) else (status,)
+            if host is not None:
+                candidates.append(('status_host', [self.by_status_host.get((s, host), {}) for s in statuses]))
+                host = None
+            else:
+                candidates.append(('status', [self.by_status.get(s, {}) for s in statuses]))
+        if host is not None:
+            candidates.append(('host', [self.by_host.get(host, {})]))
+        if save_path is not None:
+            candidates.append(('save_path', [self.by_save_path.get(save_path, {})]))
+        if not candidates:
+            return [self.items], None
+
+        candidates.sort(key=lambda candidate: sum(len(bucket) for bucket in candidate[1]))
+        (_, buckets), others = candidates[0], candidates[1:]
+        if not others:
+            return buckets, None
+
+        other_buckets = [other for _, other in others]
+
+        def matches(download_item):
+            return all(any(download_item.id in bucket for bucket in other) for other in other_buckets)
+        return buckets, matches
+
+    def count(self, status=None, host=None, save_path=None):
+        """Number of downloads matching the filters"""
+        with self.lock:
+            buckets, matches = self._select(status, host, save_path)
+            if matches is None:
+                return sum(len(bucket) for bucket in buckets)
+            return sum(1 for bucket in buckets for download_item in bucket.values() if matches(download_item))
+
+    def query(self, status=None, host=None, save_path=None, offset=0, limit=None, newest_first=False):
+        """Return (total count, page of downloads) matching the filters, in add order.
+
+        status can be a single DownloadStatus or a collection of them; with
+        several statuses the results are grouped by status in the given order.
+        """
+        with self.lock:
+            buckets, matches = self._select(status, host, save_path)
+            if newest_first:
+                values = chain.from_iterable(reversed(bucket.values()) for bucket in reversed(buckets))
+            else:
+                values = chain.from_iterable(bucket.values() for bucket in buckets)
+            if matches is None:
+                total = sum(len(bucket) for bucket in buckets)
+            else:
+                values = filter(matches, values)
+                total = self.count(status, host, save_path)
+            stop = None if limit is None else offset + limit
+            return total, list(islice(values, offset, stop))
+
+    def counts_by_status(self):
+        """Number of downloads per status"""
+        with self.lock:
+            return {status: len(bucket) for status, bucket in self.by_status.items()}
+
+    def counts_by_host(self):
+        """Number of downloads per host"""
+        with self.lock:
+            return {host: len(bucket) for host, bucket in self.by_host.items()}
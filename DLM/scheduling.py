@@ -0,0 +1,31 @@
+# Scheduling decisions of the download engine. They don't touch the network or
+# the disk, so benchmarks/simulate.py replays them in virtual time.
+
+# Seconds the queue processor sleeps while every download slot is busy
+QUEUE_POLL_INTERVAL = 0.5
+
+
+def queue_order(priority, ticket):
+    """Sort key of a queued download: higher priority first, then in the order they were queued"""
+    return (-priority, ticket)
+
+
+def use_segments(supports_range, total_size, max_threads_per_download):
+    """Whether a download is split into ranged segments or fetched in one request"""
+    return supports_range and total_size > 0 and max_threads_per_download > 1
+
+
+def plan_segments(total_size, max_threads_per_download, chunk_size):
+    """(start_byte, end_byte) of the segments of a ranged download.
+
+    At most max_threads_per_download segments of at least chunk_size
+    bytes each, the last one takes the remainder.
+    """
+    num_chunks = min(max_threads_per_download, total_size // chunk_size or 1)
+    segment_size = total_size // num_chunks
+    segments = []
+    for i in range(num_chunks):
+        start_byte = i * segment_size
+        end_byte = start_byte + segment_size - 1 if i < num_chunks - 1 else total_size - 1
+        segments.append((start_byte, end_byte))
+    return segments
@@ -14,11 +14,12 @@ setup(
     entry_points={
         'console_scripts': [
             'pydownloadmanager=main:main',
+            'pydownloadmanager-cli=cli:main',
         ],
     },
     author="Your Name",
     author_email="your.email@example.com",
     description="A multi-threaded download manager with browser integration",
     keywords="download, manager, browser, integration",
-    python_requires=">=3.6",
+    python_requires=">=3.8",
 )
\ No newline at end of file
@@ -0,0 +1,182 @@
+import threading
+from array import array
+from collections import deque
+
+# Versions kept for delta snapshots, older since_version values get a full snapshot
+SNAPSHOT_LOG_SIZE = 256
+
+
+class EngineSnapshot:
+    """Columnar view of the downloads at one version, treat it as read-only.
+
+    Row i is ids[i] with status statuses[status[i]], downloaded_size[i] and
+    total_size[i] in bytes, speed[i] in bytes per second and eta[i] in
+    seconds (-1 if unknown). A full snapshot (since_version is None) has a
+    row for every download; a delta has rows for the downloads that were
+    added or changed after since_version, and removed lists the ids that
+    went away (evicted) since then.
+    """
+    __slots__ = ('version', 'since_version', 'ids', 'status', 'downloaded_size', 'total_size', 'speed', 'eta',
+                 'removed', 'statuses')
+
+    def __init__(self, version, since_version, ids, status, downloaded_size, total_size, speed, eta, removed,
+                 statuses):
+        self.version = version
+        self.since_version = since_version
+        self.ids = ids
+        self.status = status
+        self.downloaded_size = downloaded_size
+        self.total_size = total_size
+        self.speed = speed
+        self.eta = eta
+        self.removed = removed
+        self.statuses = statuses
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def is_full(self):
+        return self.since_version is None
+
+    def rows(self):
+        """(id, status, downloaded_size, total_size, speed, eta) of every row"""
+        statuses = self.statuses
+        return zip(self.ids, (statuses[code] for code in self.status), self.downloaded_size, self.total_size,
+                   self.speed, self.eta)
+
+
+class SnapshotTable:
+    """Columns of all downloads, kept up to date from the ids marked since the last snapshot.
+
+    The owning engine marks ids with mark_changed() and mark_removed()
+    while holding its changes lock, next to its changed_ids, so marking
+    costs the download threads nothing extra. Nothing is recorded before
+    the first take(), which loads every download, so an engine nobody
+    takes snapshots of keeps no marks. take() reads only the marked
+    downloads, under the engine's download lock so sizes and speed aren't
+    torn mid-update, and bumps the version when anything changed. Every
+    version is logged with its ids, which answers delta snapshots without
+    scanning the columns.
+    """
+
+    def __init__(self, statuses):
+        self.statuses = tuple(statuses)
+        self.status_code = {status: code for code, status in enumerate(self.statuses)}
+        self.lock = threading.Lock()
+        self.changed = set()
+        self.removed = set()
+        self.loaded = False
+        self.version = 0
+        self.log = deque(maxlen=SNAPSHOT_LOG_SIZE)  # (version, changed ids, removed ids)
+        self.ids = []
+        self.row_of = {}
+        self.status = array('b')
+        self.downloaded_size = array('q')
+        self.total_size = array('q')
+        self.speed = array('d')
+        self.eta = array('d')
+
+    def mark_changed(self, download_ids):
+        """Update the rows of these downloads in the next take() (hold the changes lock)"""
+        if self.loaded:
+            self.changed.update(download_ids)
+
+    def mark_removed(self, download_ids):
+        """Drop the rows of these downloads in the next take() (hold the changes lock)"""
+        if self.loaded:
+            self.changed.difference_update(download_ids)
+            self.removed.update(download_ids)
+
+    def take(self, registry, changes_lock, read_lock, since_version=None):
+        """Apply the marked changes and return a snapshot, a delta if since_version is still in the log"""
+        downloads = registry.items
+        with self.lock:
+            with changes_lock:
+                changed, self.changed = self.changed, set()
+                removed, self.removed = self.removed, set()
+                first = not self.loaded
+                self.loaded = True
+            if first:
+                # Downloads added before the first snapshot were never marked
+                with registry.lock:
+                    changed.update(downloads)
+            with read_lock:
+                present = set()
+                for download_id in changed:
+                    download_item = downloads.get(download_id)
+                    if download_item is None:
+                        removed.add(download_id)
+                    else:
+                        self._write(download_id, download_item)
+                        present.add(download_id)
+            removed = {download_id for download_id in removed if self._delete(download_id)}
+            if present or removed:
+                self.version += 1
+                self.log.append((self.version, present, removed))
+            if since_version is None or not self.version - len(self.log) <= since_version <= self.version:
+                return self._full()
+            return self._delta(since_version)
+
+    def _write(self, download_id, download_item):
+        downloaded = download_item.downloaded_size
+        total = download_item.total_size
+        speed = download_item.speed
+        if total <= 0:
+            eta = -1.0
+        elif downloaded >= total:
+            eta = 0.0
+        else:
+            eta = (total - downloaded) / speed if speed > 0 else -1.0
+        row = self.row_of.get(download_id)
+        if row is None:
+            self.row_of[download_id] = len(self.ids)
+            self.ids.append(download_id)
+            self.status.append(self.status_code[download_item.status])
+            self.downloaded_size.append(downloaded)
+            self.total_size.append(total)
+            self.speed.append(speed)
+            self.eta.append(eta)
+        else:
+            self.status[row] = self.status_code[download_item.status]
+            self.downloaded_size[row] = downloaded
+            self.total_size[row] = total
+            self.speed[row] = speed
+            self.eta[row] = eta
+
+    def _delete(self, download_id):
+        """Remove a row by moving the last row into its place, returns False if there was none"""
+        row = self.row_of.pop(download_id, None)
+        if row is None:
+            return False
+        last = len(self.ids) - 1
+        for column in (self.ids, self.status, self.downloaded_size, self.total_size, self.speed, self.eta):
+            column[row] = column[last]
+            column.pop()
+        if row != last:
+            self.row_of[self.ids[row]] = row
+        return True
+
+    def _full(self):
+        return EngineSnapshot(self.version, None, tuple(self.ids), array('b', self.status),
+                              array('q', self.downloaded_size), array('q', self.total_size), array('d', self.speed),
+                              array('d', self.eta), (), self.statuses)
+
+    def _delta(self, since_version):
+        changed = set()
+        removed = set()
+        for version, version_changed, version_removed in self.log:
+            if version <= since_version:
+                continue
+            changed -= version_removed
+            removed -= version_changed
+            changed |= version_changed
+            removed |= version_removed
+        rows = sorted(self.row_of[download_id] for download_id in changed)
+        return EngineSnapshot(self.version, since_version, tuple(self.ids[row] for row in rows),
+                              array('b', (self.status[row] for row in rows)),
+                              array('q', (self.downloaded_size[row] for row in rows)),
+                              array('q', (self.total_size[row] for row in rows)),
+                              array('d', (self.speed[row] for row in rows)),
+                              array('d', (self.eta[row] for row in rows)),
+                              tuple(removed), self.statuses)
@@ -0,0 +1,120 @@
+import math
+import threading
+from array import array
+
+# Seconds between speed samples
+SAMPLE_INTERVAL = 1.0
+
+# Seconds after which a sample weighs half as much in the smoothed speed
+SPEED_HALF_LIFE = 3.0
+
+# Per-second speeds kept for graphs
+HISTORY_SECONDS = 120
+
+
+class SpeedHistory:
+    """Ring buffer of the last `size` samples in a flat array of doubles"""
+    __slots__ = ('samples', 'head', 'count')
+
+    def __init__(self, size=HISTORY_SECONDS):
+        self.samples = array('d', bytes(8 * size))
+        self.head = 0
+        self.count = 0
+
+    def append(self, value):
+        self.samples[self.head] = value
+        self.head = (self.head + 1) % len(self.samples)
+        self.count = min(self.count + 1, len(self.samples))
+
+    def values(self):
+        """Samples oldest first"""
+        start = self.head - self.count
+        if start >= 0:
+            return self.samples[start:self.head].tolist()
+        return (self.samples[start:] + self.samples[:self.head]).tolist()
+
+
+class SpeedTrack:
+    """Smoothed speed of one download (or of all of them)"""
+    __slots__ = ('last_size', 'average', 'weight', 'history')
+
+    def __init__(self, size, history_size=HISTORY_SECONDS):
+        self.last_size = size
+        self.average = 0.0
+        self.weight = 0.0
+        self.history = SpeedHistory(history_size)
+
+    def add(self, transferred, elapsed, half_life):
+        """Fold in the bytes transferred over the last elapsed seconds, returns the smoothed speed"""
+        rate = transferred / elapsed
+        alpha = 1.0 - math.pow(0.5, elapsed / half_life)
+        self.average += alpha * (rate - self.average)
+        # Divide out the zero the average started from, so a new download doesn't ramp up slowly
+        self.weight += alpha * (1.0 - self.weight)
+        self.history.append(rate)
+        return self.average / self.weight
+
+
+class SpeedSampler:
+    """Speeds of running downloads, sampled from their downloaded_size every SAMPLE_INTERVAL.
+
+    Segment threads only add to downloaded_size; one sampler turns the
+    size deltas into an exponentially weighted speed per download (with a
+    SPEED_HALF_LIFE), writes it to download_item.speed, and keeps the raw
+    per-interval speeds of every running download and of all of them
+    together in SpeedHistory ring buffers for graphs.
+    """
+
+    def __init__(self, half_life=SPEED_HALF_LIFE, history_size=HISTORY_SECONDS):
+        self.half_life = half_life
+        self.history_size = history_size
+        self.lock = threading.Lock()
+        self.tracks = {}  # download_id -> (DownloadItem, SpeedTrack)
+        self.total = SpeedTrack(0, history_size)
+        self.total_speed = 0.0
+        self.last_time = None
+
+    def sample(self, download_items, now):
+        """Update the speeds from the running downloads, returns the downloads whose speed changed.
+
+        Downloads that stopped running since the last sample get speed 0.
+        """
+        changed = []
+        with self.lock:
+            elapsed = now - self.last_time if self.last_time is not None else 0.0
+            self.last_time = now
+            transferred = 0
+            running = set()
+            for download_item in download_items:
+                running.add(download_item.id)
+                size = download_item.downloaded_size
+                entry = self.tracks.get(download_item.id)
+                if entry is None:
+                    # Measured from the next sample on
+                    self.tracks[download_item.id] = (download_item, SpeedTrack(size, self.history_size))
+                    continue
+                track = entry[1]
+                delta = max(0, size - track.last_size)
+                track.last_size = size
+                transferred += delta
+                if elapsed > 0:
+                    download_item.speed = track.add(delta, elapsed, self.half_life)
+                    changed.append(download_item)
+            for download_id in [download_id for download_id in self.tracks if download_id not in running]:
+                download_item, track = self.tracks.pop(download_id)
+                # Bytes of the last interval still count towards the total
+                transferred += max(0, download_item.downloaded_size - track.last_size)
+                if download_item.speed:
+                    download_item.speed = 0.0
+                    changed.append(download_item)
+            if elapsed > 0:
+                self.total_speed = self.total.add(transferred, elapsed, self.half_life)
+        return changed
+
+    def history(self, download_id=None):
+        """Per-interval speeds of a running download (all downloads with None), oldest first"""
+        with self.lock:
+            if download_id is None:
+                return self.total.history.values()
+            entry = self.tracks.get(download_id)
+            return entry[1].history.values() if entry is not None else []
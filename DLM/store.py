@@ -0,0 +1,184 @@
+import os
+import time
+import queue
+import sqlite3
+import threading
+
+from history import DATA_DIR
+from registry import get_host
+
+DEFAULT_STORE_PATH = os.path.join(DATA_DIR, 'downloads.db')
+
+# Statuses of downloads that still have work to do
+PENDING_STATUSES = ('queued', 'downloading', 'paused')
+
+COLUMNS = ('id', 'url', 'save_path', 'filename', 'status', 'host', 'total_size', 'downloaded_size',
+           'error_message', 'referrer', 'start_time', 'finish_time', 'updated_time')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS downloads (
+    id TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    save_path TEXT NOT NULL,
+    filename TEXT,
+    status TEXT NOT NULL,
+    host TEXT,
+    total_size INTEGER DEFAULT 0,
+    downloaded_size INTEGER DEFAULT 0,
+    error_message TEXT,
+    referrer TEXT,
+    start_time REAL DEFAULT 0,
+    finish_time REAL DEFAULT 0,
+    updated_time REAL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_downloads_status ON downloads (status);
+CREATE INDEX IF NOT EXISTS idx_downloads_host ON downloads (host);
+CREATE INDEX IF NOT EXISTS idx_downloads_finish_time ON downloads (finish_time);
+"""
+
+
+class DownloadStore:
+    """SQLite (WAL) store for the download queue and history.
+
+    record() only puts a row snapshot on an in-memory queue, so it never
+    blocks the caller. A writer thread drains that queue and commits the
+    rows in batches, one transaction per batch. Readers use their own
+    connection and don't wait for the writer thanks to WAL.
+
+    Also serves as the archive for evicted downloads (same interface as
+    DownloadHistory).
+    """
+
+    def __init__(self, path=DEFAULT_STORE_PATH, flush_interval=0.5, batch_size=1000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        connection = self._connect()
+        connection.executescript(SCHEMA)
+        connection.commit()
+        connection.close()
+
+        self.read_connection = self._connect()
+        self.read_lock = threading.Lock()
+        self.pending = queue.SimpleQueue()
+        self.stop_event = threading.Event()
+        self.writer = threading.Thread(target=self._write_loop)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def record(self, download_item):
+        """Queue the current state of a download for writing"""
+        self.pending.put((
+            download_item.id, download_item.url, download_item.save_path, download_item.filename,
+            download_item.status.value, get_host(download_item.url), download_item.total_size,
+            download_item.downloaded_size, download_item.error_message, download_item.referrer,
+            download_item.start_time, download_item.finish_time, time.time(),
+        ))
+
+    def _write_loop(self):
+        connection = self._connect()
+        placeholders = ', '.join('?' for _ in COLUMNS)
+        updates = ', '.join(f'{column} = excluded.{column}' for column in COLUMNS[1:])
+        # Upsert keeps the rowid, so rowid order stays the order downloads were added in
+        statement = (f"INSERT INTO downloads ({', '.join(COLUMNS)}) VALUES ({placeholders}) "
+                     f"ON CONFLICT(id) DO UPDATE SET {updates}")
+        while True:
+            try:
+                entry = self.pending.get(timeout=self.flush_interval)
+            except queue.Empty:
+                if self.stop_event.is_set():
+                    break
+                continue
+
+            # Several transitions of the same download in one batch collapse into the last one
+            batch = {}
+            waiters = []
+            while True:
+                if isinstance(entry, threading.Event):
+                    waiters.append(entry)
+                else:
+                    batch[entry[0]] = entry
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    entry = self.pending.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                try:
+                    with connection:
+                        connection.executemany(statement, batch.values())
+                except sqlite3.Error as e:
+                    print(f"Error writing download store: {str(e)}")
+            for waiter in waiters:
+                waiter.set()
+        connection.close()
+
+    def flush(self, timeout=5.0):
+        """Wait until everything recorded so far has been written"""
+        done = threading.Event()
+        self.pending.put(done)
+        return done.wait(timeout)
+
+    def close(self):
+        """Write outstanding rows and stop the writer thread"""
+        self.flush()
+        self.stop_event.set()
+        self.writer.join(timeout=10.0)
+        with self.read_lock:
+            self.read_connection.close()
+
+    def _query(self, sql, params=()):
+        with self.read_lock:
+            return [dict(row) for row in self.read_connection.execute(sql, params)]
+
+    def load_pending(self):
+        """Downloads that were queued or active when last recorded, in the order they were added"""
+        placeholders = ', '.join('?' for _ in PENDING_STATUSES)
+        return self._query(f"SELECT * FROM downloads WHERE status IN ({placeholders}) ORDER BY rowid",
+                           PENDING_STATUSES)
+
+    # History interface
+
+    def append(self, download_items):
+        """Archive finished downloads (they are already stored, this records their final state)"""
+        for download_item in download_items:
+            self.record(download_item)
+
+    def search(self, text=None, status=None, offset=0, limit=100):
+        """Find finished downloads, most recently finished first"""
+        status = getattr(status, 'value', status)
+        conditions = ['finish_time > 0']
+        params = []
+        if status is not None:
+            conditions.append('status = ?')
+            params.append(status)
+        if text:
+            conditions.append('(url LIKE ? OR filename LIKE ?)')
+            params.extend([f'%{text}%', f'%{text}%'])
+        params.extend([limit, offset])
+        return self._query(f"SELECT * FROM downloads WHERE {' AND '.join(conditions)} "
+                           f"ORDER BY finish_time DESC LIMIT ? OFFSET ?", params)
+
+    def get(self, download_id):
+        """Get the stored record of a download"""
+        rows = self._query("SELECT * FROM downloads WHERE id = ?", (download_id,))
+        return rows[0] if rows else None
+
+    def count(self, status=None):
+        """Number of stored downloads, optionally with the given status"""
+        status = getattr(status, 'value', status)
+        if status is None:
+            rows = self._query("SELECT COUNT(*) AS n FROM downloads")
+        else:
+            rows = self._query("SELECT COUNT(*) AS n FROM downloads WHERE status = ?", (status,))
+        return rows[0]['n']
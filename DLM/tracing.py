@@ -0,0 +1,121 @@
+import os
+import json
+import time
+import itertools
+import threading
+from collections import deque
+
+# Spans kept per engine, the oldest are dropped first
+DEFAULT_CAPACITY = 200000
+
+# Gap between two chunks of a segment that is recorded as a stall, in seconds
+STALL_THRESHOLD = 0.5
+
+# File writes slower than this are recorded, in seconds
+SLOW_WRITE_THRESHOLD = 0.05
+
+
+class Tracer:
+    """Timeline of download spans in a bounded ring buffer, exported as Chrome trace events.
+
+    Callers check self.enabled before measuring anything, so a disabled
+    tracer costs one attribute read. Times are time.perf_counter() values.
+    Every segment (and the setup of every download) gets its own track
+    through track(), spans are recorded on the calling thread's track.
+    Events are plain dicts in the trace_event format, appending to the
+    deque needs no lock.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.enabled = False
+        self.events = deque(maxlen=capacity)
+        self.pid = os.getpid()
+        self.local = threading.local()
+        self.track_ids = itertools.count(1)
+        self.adapter_class = None  # see traced_adapter
+
+    def track(self, name):
+        """Record the following spans of this thread on a new track called name"""
+        track_id = next(self.track_ids)
+        self.local.track_id = track_id
+        self.events.append({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': track_id,
+                            'args': {'name': name}})
+
+    def span(self, name, category, start, end=None, **args):
+        """Record a span from start to end (now if None)"""
+        if end is None:
+            end = time.perf_counter()
+        self.events.append({'name': name, 'cat': category, 'ph': 'X', 'pid': self.pid,
+                            'tid': getattr(self.local, 'track_id', 0),
+                            'ts': start * 1e6, 'dur': (end - start) * 1e6, 'args': args})
+
+    def instant(self, name, category, **args):
+        """Record a point in time, like a retry"""
+        self.events.append({'name': name, 'cat': category, 'ph': 'i', 's': 't', 'pid': self.pid,
+                            'tid': getattr(self.local, 'track_id', 0),
+                            'ts': time.perf_counter() * 1e6, 'args': args})
+
+    def clear(self):
+        self.events.clear()
+
+    def snapshot(self):
+        """Copy of the recorded events"""
+        while True:
+            try:
+                return list(self.events)
+            except RuntimeError:
+                # Appended to while copying
+                continue
+
+
+def write_trace(path, events):
+    """Write events as a Chrome trace (chrome://tracing, Perfetto), returns the number of events"""
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    return len(events)
+
+
+def traced_adapter(tracer, **kwargs):
+    """requests HTTPAdapter whose new connections record 'connect' (DNS and TCP) and 'tls' spans"""
+    if tracer.adapter_class is None:
+        tracer.adapter_class = _traced_adapter_class(tracer)
+    return tracer.adapter_class(**kwargs)
+
+
+def _traced_adapter_class(tracer):
+    from requests.adapters import HTTPAdapter
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+    def traced(connection_class):
+        class TracedConnection(connection_class):
+            def _new_conn(self):
+                if not tracer.enabled:
+                    return super()._new_conn()
+                start = time.perf_counter()
+                try:
+                    return super()._new_conn()
+                finally:
+                    self.traced_connected = time.perf_counter()
+                    tracer.span('connect', 'net', start, self.traced_connected, host=self.host)
+
+            def connect(self):
+                self.traced_connected = None
+                super().connect()
+                if self.traced_connected is not None and connection_class is HTTPSConnection:
+                    tracer.span('tls', 'net', self.traced_connected, host=self.host)
+        return TracedConnection
+
+    class TracedHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = traced(HTTPConnection)
+
+    class TracedHTTPSConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = traced(HTTPSConnection)
+
+    class TracedHTTPAdapter(HTTPAdapter):
+        def init_poolmanager(self, *args, **pool_kwargs):
+            super().init_poolmanager(*args, **pool_kwargs)
+            self.poolmanager.pool_classes_by_scheme = {'http': TracedHTTPConnectionPool,
+                                                       'https': TracedHTTPSConnectionPool}
+
+    return TracedHTTPAdapter
@@ -103,4 +103,38 @@ def is_downloadable_url(url):
     
     # Check if URL ends with a common file extension
     path = urlparse(url).path.lower()
-    return any(path.endswith(ext) for ext in file_extensions)
\ No newline at end of file
+    return any(path.endswith(ext) for ext in file_extensions)
+
+# URLs inside free text, up to whitespace, quotes or angle brackets
+URL_PATTERN = re.compile(r'''(?:https?|ftp)://[^\s<>"']+''', re.IGNORECASE)
+
+
+def extract_urls(text):
+    """Find all URLs in a block of text in one pass, without duplicates and in order"""
+    urls = {}
+    for match in URL_PATTERN.finditer(text):
+        # Punctuation ending a sentence isn't part of the URL
+        url = match.group().rstrip('.,;:!?)]}')
+        if is_valid_url(url):
+            urls[url] = None
+    return list(urls)
+
+
+def make_unique_filenames(filenames, taken):
+    """Give each filename a number suffix where needed so that none is in taken or repeated.
+
+    taken is a set of names already in use and is updated with the new names.
+    """
+    unique = []
+    next_counter = {}  # filename -> first suffix not tried yet, so repeated names don't probe from 1 again
+    for filename in filenames:
+        base_name, extension = os.path.splitext(filename)
+        counter = next_counter.get(filename, 1)
+        new_filename = filename
+        while new_filename in taken:
+            new_filename = f"{base_name}_{counter}{extension}"
+            counter += 1
+        next_counter[filename] = counter
+        taken.add(new_filename)
+        unique.append(new_filename)
+    return unique